@@ -6,11 +6,12 @@ A basic assembler/consensus sequence generator. Takes an overlap graph and merge
 
 import warnings
 import array
+import threading
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
-from dysgu.map_set_utils import timeit, echo
+from dysgu.map_set_utils import timeit, echo, run_chunked
 
 from dysgu.scikitbio._ssw_wrapper import StripedSmithWaterman
 from libcpp.vector cimport vector as cpp_vector
@@ -19,7 +20,8 @@ from libcpp.pair cimport pair as cpp_pair
 
 from libc.math cimport exp
 from libc.stdlib cimport abs as c_abs
-from libc.stdint cimport uint32_t, int32_t, uint64_t
+from libc.string cimport memcmp
+from libc.stdint cimport uint8_t, uint32_t, int32_t, uint64_t, int64_t
 
 from dysgu cimport map_set_utils
 from dysgu.map_set_utils cimport DiGraph, unordered_set, unordered_map, EventResult
@@ -29,6 +31,8 @@ from pysam.libcalignedsegment cimport AlignedSegment
 from pysam.libchtslib cimport bam_seqi, bam_get_seq, bam_get_cigar
 
 import numpy as np
+cimport numpy as np
+from cython.operator cimport dereference
 
 ctypedef cpp_vector[int] int_vec_t
 
@@ -42,6 +46,7 @@ cdef extern from "graph_objects.hpp" nogil:
 
     cdef cppclass TwoWayMap:
         TwoWayMap() nogil
+        void clear() nogil
         uint64_t key_2_64(char, uint64_t, uint64_t, uint64_t) nogil
         void insert_tuple_key(uint64_t, int) nogil
         int has_tuple_key(uint64_t) nogil
@@ -53,8 +58,82 @@ cdef extern from "graph_objects.hpp" nogil:
     cdef void graph_node_2_vec(uint64_t, cpp_vector[int]) nogil
 
 
-basemap = np.array([ '.', 'A', 'C', '.', 'G', '.', '.', '.', 'T', '.', '.', '.', '.', '.', 'N', 'N', 'N'])
-lowermap = np.array([ '.', 'a', 'c', '.', 'g', '.', '.', '.', 't', '.', '.', '.', '.', '.', 'n', 'n', 'n'])
+cdef extern from "zlib.h" nogil:
+    ctypedef unsigned long uLong
+    ctypedef unsigned long uLongf
+    int Z_DEFAULT_COMPRESSION
+    uLong compressBound(uLong)
+    int compress2(unsigned char *, uLongf *, const unsigned char *, uLong, int)
+
+
+cdef int REP_MAX_K = 6
+cdef int REP_MAX_DIFF = 1024
+cdef uint8_t REP_ESCAPE = 255
+cdef uint8_t[256] rep_codes  # 3-bit code of each base, upper and lower case kept apart
+cdef cpp_vector[float] decay_lut  # score of a repeated k-mer, index (k - 2) * REP_MAX_DIFF + distance
+
+
+cdef void fill_rep_tables():
+    cdef int k, d
+    cdef float decay, max_amount
+    for d in range(256):
+        rep_codes[d] = REP_ESCAPE
+    for d, c in enumerate(b"ACGTacgt"):
+        rep_codes[c] = d
+    decay_lut.resize(5 * REP_MAX_DIFF)
+    for k in range(2, REP_MAX_K + 1):
+        decay = 0.25 * 1/k
+        max_amount = exp(-decay) * k  # If last kmer was the same as current kmer
+        for d in range(REP_MAX_DIFF):
+            decay_lut[(k - 2) * REP_MAX_DIFF + d] = (k * exp(-decay * d)) / max_amount
+
+
+fill_rep_tables()
+
+
+# Indexed by the 4-bit htslib base code
+cdef char *basemap = b".AC.G...T.....NNN"
+cdef char *lowermap = b".ac.g...t.....nnn"
+
+
+cdef class AssemblyWorkspace:
+    """Graph, node weights and sequence buffer for get_consensus, plus the k-mer tables and buffers used by
+    compute_rep and sequence_features.
+    Storage is cleared rather than freed between calls, so assembling many candidates does not allocate a new
+    graph for each one"""
+    cdef DiGraph G
+    cdef TwoWayMap ndict_r2
+    cdef cpp_vector[int] node_weights
+    cdef cpp_vector[float] path_qual
+    cdef cpp_vector[char] sequence
+    cdef cpp_vector[int64_t] kmer_last
+    cdef unordered_map[uint64_t, int64_t] kmer_other
+    cdef int64_t kmer_base
+    cdef cpp_vector[unsigned char] upper
+    cdef cpp_vector[unsigned char] compressed
+
+    def __cinit__(self):
+        # Last position of each k-mer, stored as kmer_base + position. Entries below kmer_base are from an
+        # earlier sequence or k, so the table never needs clearing
+        self.kmer_last.assign(1 << (3 * REP_MAX_K), -1)
+        self.kmer_base = 0
+
+    cdef void reset(self):
+        self.G.clear()
+        self.ndict_r2.clear()
+        self.node_weights.clear()
+
+
+_workspaces = threading.local()
+
+
+cdef AssemblyWorkspace get_workspace():
+    # Components can be called from a thread pool, so each thread keeps its own workspace
+    ws = getattr(_workspaces, "ws", None)
+    if ws is None:
+        ws = AssemblyWorkspace()
+        _workspaces.ws = ws
+    return ws
 
 
 cdef trim_cigar(uint32_t cigar_l, uint32_t *cigar_p, int pos, int approx_pos):
@@ -142,20 +221,66 @@ cdef void add_to_graph(DiGraph& G, AlignedSegment r, cpp_vector[int]& nweight, T
         cigar_start, cigar_end, current_pos, i = trim_cigar(cigar_l, cigar_p, pos, approx_position)
     cdef int cigar_index
 
-    for cigar_index in range(cigar_start, cigar_end):
-        cigar_value = cigar_p[cigar_index]
-        opp = <int> cigar_value & 15
-        length = <int> cigar_value >> 4
-        if done:
-            break
-        if opp == 4:
-            if start:
-                for o in range(length, 0, -1):
+    # The walk only touches the C graph and the bam record, so other threads can run meanwhile
+    with nogil:
+        for cigar_index in range(cigar_start, cigar_end):
+            cigar_value = cigar_p[cigar_index]
+            opp = <int> cigar_value & 15
+            length = <int> cigar_value >> 4
+            if done:
+                break
+            if opp == 4:
+                if start:
+                    for o in range(length, 0, -1):
+                        qual = quals[i]
+                        base = bam_seqi(char_ptr_rseq, i)
+                        i += 1
+                        # 0 = left soft clip
+                        key = ndict_r2.key_2_64(base, current_pos, o, <uint64_t>0)
+                        if ndict_r2.has_tuple_key(key):
+                            n = ndict_r2.get_index_prev()
+                        else:
+                            n = G.addNode()
+                            if n >= nweight.size():
+                                nweight.push_back(0)
+                            ndict_r2.insert_tuple_key(key, n)
+                        nweight[n] += qual
+                        if prev_node != -1:
+                            G.updateEdge(prev_node, n, qual)
+                        prev_node = n
+
+                else:
+                    for o in range(1, length + 1, 1):
+                        qual = quals[i]
+                        base = bam_seqi(char_ptr_rseq, i)
+                        i += 1
+                        # 1 = right soft clip
+                        key = ndict_r2.key_2_64(base, current_pos, o, <uint64_t>1)
+                        if ndict_r2.has_tuple_key(key):
+                            n = ndict_r2.get_index_prev()
+                        else:
+                            n = G.addNode()
+                            if n >= nweight.size():
+                                nweight.push_back(0)
+                            ndict_r2.insert_tuple_key(key, n)
+                        nweight[n] += qual
+                        if prev_node != -1:
+                            G.updateEdge(prev_node, n, qual)
+                        prev_node = n
+
+            elif opp == 1:  # Insertion
+                if c_abs(<int32_t>current_pos - approx_position) > max_distance:
+                    i += length
+                    if current_pos > approx_position:
+                        break  # out of range
+                    continue
+
+                for o in range(1, length + 1, 1):
                     qual = quals[i]
                     base = bam_seqi(char_ptr_rseq, i)
                     i += 1
-                    # 0 = left soft clip
-                    key = ndict_r2.key_2_64(base, current_pos, o, <uint64_t>0)
+                    # 2 = insertion
+                    key = ndict_r2.key_2_64(base, current_pos, o, <uint64_t>2)
                     if ndict_r2.has_tuple_key(key):
                         n = ndict_r2.get_index_prev()
                     else:
@@ -167,14 +292,32 @@ cdef void add_to_graph(DiGraph& G, AlignedSegment r, cpp_vector[int]& nweight, T
                     if prev_node != -1:
                         G.updateEdge(prev_node, n, qual)
                     prev_node = n
+                # current_pos += 1  # <-- Reference pos increases 1
 
-            else:
-                for o in range(1, length + 1, 1):
+            elif opp == 2: # deletion
+                current_pos += length # + 1
+
+            elif opp == 0 or opp == 7 or opp == 8 or opp == 3:  # All match, match (=), mis-match (X), N's
+                if current_pos < approx_position and current_pos + length < approx_position - max_distance: # abs(<int32_t>current_pos - approx_position + length) > max_distance:
+                    i += length
+                    current_pos += length
+                    continue
+
+                for p in range(current_pos, current_pos + length):
+                    current_pos = p
+                    if current_pos < approx_position and approx_position - current_pos > max_distance:
+                        i += 1
+                        continue
+                    elif current_pos > approx_position and current_pos - approx_position > max_distance:
+                        break
+                    ref_bases += 1
+                    if ref_bases > target_bases:
+                        done = 1
+                        break
                     qual = quals[i]
                     base = bam_seqi(char_ptr_rseq, i)
                     i += 1
-                    # 1 = right soft clip
-                    key = ndict_r2.key_2_64(base, current_pos, o, <uint64_t>1)
+                    key = ndict_r2.key_2_64(base, current_pos, <uint64_t>0, <uint64_t>4)
                     if ndict_r2.has_tuple_key(key):
                         n = ndict_r2.get_index_prev()
                     else:
@@ -187,71 +330,9 @@ cdef void add_to_graph(DiGraph& G, AlignedSegment r, cpp_vector[int]& nweight, T
                         G.updateEdge(prev_node, n, qual)
                     prev_node = n
 
-        elif opp == 1:  # Insertion
-            if c_abs(<int32_t>current_pos - approx_position) > max_distance:
-                i += length
-                if current_pos > approx_position:
-                    break  # out of range
-                continue
+                current_pos += 1
 
-            for o in range(1, length + 1, 1):
-                qual = quals[i]
-                base = bam_seqi(char_ptr_rseq, i)
-                i += 1
-                # 2 = insertion
-                key = ndict_r2.key_2_64(base, current_pos, o, <uint64_t>2)
-                if ndict_r2.has_tuple_key(key):
-                    n = ndict_r2.get_index_prev()
-                else:
-                    n = G.addNode()
-                    if n >= nweight.size():
-                        nweight.push_back(0)
-                    ndict_r2.insert_tuple_key(key, n)
-                nweight[n] += qual
-                if prev_node != -1:
-                    G.updateEdge(prev_node, n, qual)
-                prev_node = n
-            # current_pos += 1  # <-- Reference pos increases 1
-
-        elif opp == 2: # deletion
-            current_pos += length # + 1
-
-        elif opp == 0 or opp == 7 or opp == 8 or opp == 3:  # All match, match (=), mis-match (X), N's
-            if current_pos < approx_position and current_pos + length < approx_position - max_distance: # abs(<int32_t>current_pos - approx_position + length) > max_distance:
-                i += length
-                current_pos += length
-                continue
-
-            for p in range(current_pos, current_pos + length):
-                current_pos = p
-                if current_pos < approx_position and approx_position - current_pos > max_distance:
-                    i += 1
-                    continue
-                elif current_pos > approx_position and current_pos - approx_position > max_distance:
-                    break
-                ref_bases += 1
-                if ref_bases > target_bases:
-                    done = 1
-                    break
-                qual = quals[i]
-                base = bam_seqi(char_ptr_rseq, i)
-                i += 1
-                key = ndict_r2.key_2_64(base, current_pos, <uint64_t>0, <uint64_t>4)
-                if ndict_r2.has_tuple_key(key):
-                    n = ndict_r2.get_index_prev()
-                else:
-                    n = G.addNode()
-                    if n >= nweight.size():
-                        nweight.push_back(0)
-                    ndict_r2.insert_tuple_key(key, n)
-                nweight[n] += qual
-                if prev_node != -1:
-                    G.updateEdge(prev_node, n, qual)
-                prev_node = n
-
-            current_pos += 1
-
-        start = False
+            start = False
 
 
 cdef int topo_sort2(DiGraph& G, cpp_deque[int]& order): #  except -1:
@@ -266,52 +347,62 @@ cdef int topo_sort2(DiGraph& G, cpp_deque[int]& order): #  except -1:
     cdef int v, n, w
 
     cdef cpp_vector[int] debug_res
+    cdef int cycle_n = -1
+    cdef int cycle_w = -1
 
-    # with nogil:
+    with nogil:
+        for v in range(G.numberOfNodes()):  # process all vertices in G
+            if cycle_n != -1:
+                break
+            if explored.find(v) != explored.end():
+                continue
 
-    for v in range(G.numberOfNodes()):  # process all vertices in G
-        if explored.find(v) != explored.end():
-            continue
+            fringe.clear()
+            fringe.push_back(v)  # nodes yet to look at
 
-        fringe.clear()
-        fringe.push_back(v)  # nodes yet to look at
+            while fringe.size() != 0 and cycle_n == -1:
 
-        while fringe.size() != 0:
+                w = fringe.back() # depth first search
+                if explored.find(w) != explored.end():  # already looked down this branch
+                    fringe.pop_back()
+                    continue
 
-            w = fringe.back() # depth first search
-            if explored.find(w) != explored.end():  # already looked down this branch
-                fringe.pop_back()
-                continue
+                seen.insert(w)
+
+                # Check successors for cycles and for new nodes
+                if new_nodes.size() > 0:
+                    new_nodes.clear()
 
-            seen.insert(w)
+                G.neighbors(w, neighbors)
+                for n in neighbors:
+                    if explored.find(n) == explored.end():
 
-            # Check successors for cycles and for new nodes
-            if new_nodes.size() > 0:
-                new_nodes.clear()
+                        if seen.find(n) != seen.end(): #CYCLE !!
+                            cycle_n = n
+                            cycle_w = w
+                            break
 
-            G.neighbors(w, neighbors)
-            for n in neighbors:
-                if explored.find(n) == explored.end():
+                        new_nodes.push_back(n)
 
-                    if seen.find(n) != seen.end(): #CYCLE !!
-                        order.clear()
-                        order.push_back(-1)
-                        order.push_back(n)
-                        order.push_back(w)
-                        # return order
-                        graph_node_2_vec(n, debug_res)
-                        raise ValueError("Graph contains a cycle. Please report this. n={}, w={}, v={}. Node info n was: {}, {}, {}, {}".format(n, w, v, debug_res[0], debug_res[1], debug_res[2], debug_res[4]))
+                if cycle_n != -1:
+                    break
 
-                    new_nodes.push_back(n)
+                if new_nodes.size() > 0:  # Add new_nodes to fringe
+                    fringe.insert(fringe.end(), new_nodes.begin(), new_nodes.end())  # Extend
 
-            if new_nodes.size() > 0:  # Add new_nodes to fringe
-                fringe.insert(fringe.end(), new_nodes.begin(), new_nodes.end())  # Extend
+                else:  # No new nodes so w is fully explored
+                    explored.insert(w)
 
-            else:  # No new nodes so w is fully explored
-                explored.insert(w)
+                    order.push_front(w)
+                    fringe.pop_back()  # done considering this node
 
-                order.push_front(w)
-                fringe.pop_back()  # done considering this node
+    if cycle_n != -1:
+        order.clear()
+        order.push_back(-1)
+        order.push_back(cycle_n)
+        order.push_back(cycle_w)
+        graph_node_2_vec(cycle_n, debug_res)
+        raise ValueError("Graph contains a cycle. Please report this. n={}, w={}, v={}. Node info n was: {}, {}, {}, {}".format(cycle_n, cycle_w, v, debug_res[0], debug_res[1], debug_res[2], debug_res[4]))
 
 
 cdef cpp_deque[int] score_best_path(DiGraph& G, cpp_deque[int]& nodes_to_visit, cpp_vector[int]& n_weights):
@@ -391,9 +482,8 @@ cdef dict get_consensus(rd, int position, int max_distance):
     cdef int begin = 0
     cdef int return_code
 
-    cdef DiGraph G = DiGraph()
-    cdef TwoWayMap ndict_r2
-    cdef cpp_vector[int] node_weights
+    cdef AssemblyWorkspace ws = get_workspace()
+    ws.reset()
 
     for r in rd:
         if r.seq is None:
@@ -401,18 +491,18 @@ cdef dict get_consensus(rd, int position, int max_distance):
         if r.query_qualities is None or len(r.seq) != len(r.query_qualities):
             r.query_qualities = array.array("B", [1] * len(r.seq))
 
-        add_to_graph(G, r, node_weights, ndict_r2, position, max_distance)
+        add_to_graph(ws.G, r, ws.node_weights, ws.ndict_r2, position, max_distance)
 
     cdef cpp_deque[int] nodes_to_visit2
 
-    return_code = topo_sort2(G, nodes_to_visit2)
+    return_code = topo_sort2(ws.G, nodes_to_visit2)
 
     if return_code == -1 or nodes_to_visit2.size() < 50:
         return {}
 
     cdef cpp_deque[int] path2
 
-    path2 = score_best_path(G, nodes_to_visit2, node_weights)
+    path2 = score_best_path(ws.G, nodes_to_visit2, ws.node_weights)
 
     if path2.size() < 50:
         return {}
@@ -422,30 +512,28 @@ cdef dict get_consensus(rd, int position, int max_distance):
 
     # vec has the form base, current_pos, offset, base-type (left-clip/right-clip/insertion)
     cdef cpp_vector[int] vec = [0, 0, 0, 0]
-    ndict_r2.idx_2_vec(front, vec)
+    ws.ndict_r2.idx_2_vec(front, vec)
 
     longest_left_sc = vec[2]
     vec.assign(vec.size(), 0)
 
-    ndict_r2.idx_2_vec(back, vec)
+    ws.ndict_r2.idx_2_vec(back, vec)
 
     longest_right_sc = vec[2]
     vec.assign(vec.size(), 0)
 
-    cdef tuple t
     cdef int item
-
-    cdef str sequence = ""
     cdef int m, u, w
 
     cdef int count = 0
     cdef int finish = path2.size()
 
-    cdef cpp_vector[float] path_qual = [1] * path2.size()
+    ws.path_qual.assign(finish, 1)
+    ws.sequence.resize(finish)
 
     for item in path2:
 
-        ndict_r2.idx_2_vec(item, vec)
+        ws.ndict_r2.idx_2_vec(item, vec)
 
         if count == 0:
             u = -1
@@ -456,43 +544,40 @@ cdef dict get_consensus(rd, int position, int max_distance):
         else:
             w = path2[count + 1]
 
-        path_qual[count] = G.node_path_quality(u, item, w)
+        ws.path_qual[count] = ws.G.node_path_quality(u, item, w)
 
+        m = vec[0]
         if vec[3] != 4:
-            m = vec[0]
-            sequence += lowermap[m]
+            ws.sequence[count] = lowermap[m]
         else:
-            m = vec[0]
             if ref_start == -1:
                 ref_start = vec[1]
 
             elif vec[1] > ref_end:
                 ref_end = vec[1]
 
-            sequence += basemap[m]
+            ws.sequence[count] = basemap[m]
 
         vec.assign(vec.size(), 0)
 
         count += 1
 
-    seq = sequence
-
     # Trim off bad sequence
     cdef int i, start_seq, end_seq
     cdef int original_right_sc = longest_right_sc
-    end_seq = len(seq)
+    end_seq = finish
 
     if longest_right_sc > 0:
-        for i in range(len(seq) - 1, len(seq) - longest_right_sc, -1):
-            if path_qual[i] < 0.5:
+        for i in range(finish - 1, finish - longest_right_sc, -1):
+            if ws.path_qual[i] < 0.5:
                 end_seq = i
-        end_seq = min(len(seq) - longest_right_sc + 300, end_seq)
-        longest_right_sc -= len(seq) - end_seq
+        end_seq = min(finish - longest_right_sc + 300, end_seq)
+        longest_right_sc -= finish - end_seq
 
     start_seq = 0
     if longest_left_sc > 0:
         for i in range(longest_left_sc):
-            if path_qual[i] < 0.5:
+            if ws.path_qual[i] < 0.5:
                 start_seq = i
         start_seq = max(start_seq, longest_left_sc - 300)
         longest_left_sc -= start_seq
@@ -501,17 +586,17 @@ cdef dict get_consensus(rd, int position, int max_distance):
     cdef float left_clip_weight = 0
     if longest_left_sc > 0:
         for i in range(start_seq, start_seq + longest_left_sc):
-            left_clip_weight += node_weights[i]
+            left_clip_weight += ws.node_weights[i]
         left_clip_weight = left_clip_weight / longest_left_sc
 
     cdef float right_clip_weight = 0
     if longest_right_sc > 0:
-        for i in range(len(seq) - original_right_sc, end_seq):
-            right_clip_weight += node_weights[i]
+        for i in range(finish - original_right_sc, end_seq):
+            right_clip_weight += ws.node_weights[i]
         right_clip_weight = right_clip_weight / longest_right_sc
 
-    if start_seq != 0 or end_seq != len(seq):
-        seq = seq[start_seq:end_seq]
+    if end_seq > start_seq:
+        seq = ws.sequence.data()[start_seq:end_seq]
 
     return {"contig": seq,
             "left_clips": longest_left_sc,
@@ -647,122 +732,337 @@ cpdef dict base_assemble(rd, int position, int max_distance):
     return get_consensus(rd, position, max_distance)
 
 
-cpdef float compute_rep(seq):
-
-    cdef unordered_map[float, int] last_visited
+cdef float rep_score(AssemblyWorkspace ws, const unsigned char *seq, int n) nogil:
+    # Scores how often each k-mer (k = 2..6) recurs, weighted by how close the previous copy is. K-mers of plain
+    # bases are packed 3 bits per base and looked up in a direct-address table, any containing other characters
+    # are packed byte-wise into kmer_other
     cdef float tot_amount = 0
     cdef float total_seen = 0
-    cdef int k, i, diff
+    cdef int k, i, j, diff, last_escape
     cdef float decay, max_amount, amount
+    cdef uint64_t code, mask, key
+    cdef uint8_t c
+    cdef int64_t start, prev
+    cdef int64_t *last = ws.kmer_last.data()
+    cdef unordered_map[uint64_t, int64_t].iterator got
 
-    cdef bytes s_bytes = bytes(seq.encode("ascii"))
-    cdef const unsigned char* sub_ptr = s_bytes
-
-    for k in (2, 3, 4, 5, 6):
+    for k in range(2, REP_MAX_K + 1):
 
         decay = 0.25 * 1/k
-        max_amount = exp(-decay) * k  # If last kmer was the same as current kmer
-
-        sub_ptr = s_bytes
-        for i in range(len(seq) - k):
-
-            a = xxhasher(sub_ptr, k, 42)
-            if last_visited.find(a) != last_visited.end():
-                diff = i - last_visited[a]
-                x = exp(-decay * diff)
-                amount = (k * x) / max_amount
+        max_amount = exp(-decay) * k
+        start = ws.kmer_base
+        ws.kmer_base += n + 1
+        mask = (<uint64_t>1 << (3 * k)) - 1
+        code = 0
+        last_escape = -1
+        for j in range(min(k - 1, n)):
+            c = rep_codes[seq[j]]
+            if c == REP_ESCAPE:
+                last_escape = j
+                c = 0
+            code = (code << 3) | c
+
+        for i in range(n - k):
+            j = i + k - 1
+            c = rep_codes[seq[j]]
+            if c == REP_ESCAPE:
+                last_escape = j
+                c = 0
+            code = ((code << 3) | c) & mask
+
+            if last_escape < i:
+                prev = last[code]
+                last[code] = start + i
+            else:
+                key = 0
+                for j in range(i, i + k):
+                    key = (key << 8) | seq[j]
+                got = ws.kmer_other.find(key)
+                if got != ws.kmer_other.end():
+                    prev = dereference(got).second
+                else:
+                    prev = -1
+                ws.kmer_other[key] = start + i
 
+            if prev >= start:
+                diff = i - <int>(prev - start)
+                if diff < REP_MAX_DIFF:
+                    amount = decay_lut[(k - 2) * REP_MAX_DIFF + diff]
+                else:
+                    amount = (k * exp(-decay * diff)) / max_amount
             else:
                 amount = 0
             if i > k:
                 tot_amount += amount
                 total_seen += 1
-            last_visited[a] = i
-            sub_ptr += 1
 
+    if ws.kmer_other.size() > 65536:
+        ws.kmer_other.clear()
     if total_seen == 0:
         return 0
 
     return tot_amount / total_seen
 
-cdef tuple get_rep(contig_seq):
 
-    cdef int left_clip_end = 0
-    cdef int right_clip_start = 0
-    cdef float aligned_portion, clip_rep, clip_seen
-    cdef str clip
-    # Get left clip
-    for left_clip_end in range(len(contig_seq)):
-        if contig_seq[left_clip_end].isupper():
+cpdef float compute_rep(seq):
+    cdef bytes s_bytes = bytes(seq.encode("ascii"))
+    return rep_score(get_workspace(), s_bytes, len(s_bytes))
+
+
+cpdef np.ndarray compute_rep_batch(seqs):
+    """Repetitiveness score of each sequence, as given by compute_rep, returned as a float32 array"""
+    cdef AssemblyWorkspace ws = get_workspace()
+    cdef np.ndarray[np.float32_t, ndim=1] out = np.zeros(len(seqs), dtype=np.float32)
+    cdef bytes s_bytes
+    cdef int i
+    for i, seq in enumerate(seqs):
+        s_bytes = seq.encode("ascii")
+        out[i] = rep_score(ws, s_bytes, len(s_bytes))
+    return out
+
+cdef struct SeqFeatures:
+    int length
+    int gc
+    int compressed
+    int left_clip_end
+    int right_clip_start
+    bint has_clip
+    float rep
+    float rep_sc
+    int n_expansion
+    int stride
+    int exp_start
+    int ref_poly_bases
+
+
+cdef inline bint is_upper(unsigned char c) nogil:
+    return 65 <= c <= 90
+
+
+cdef inline bint is_lower(unsigned char c) nogil:
+    return 97 <= c <= 122
+
+
+cdef void clip_bounds(const unsigned char *seq, int n, SeqFeatures *f) nogil:
+    # Lower case clipped sequence at either end of a contig, gives the end of the left clip and start of the right
+    cdef int i
+    f.left_clip_end = 0
+    for i in range(n):
+        f.left_clip_end = i
+        if is_upper(seq[i]):
             break
-
-    for right_clip_start in range(len(contig_seq) - 1, -1, -1):
-        if contig_seq[right_clip_start].isupper():
-            right_clip_start += 1
+    f.right_clip_start = 0
+    for i in range(n - 1, -1, -1):
+        f.right_clip_start = i
+        if is_upper(seq[i]):
+            f.right_clip_start = i + 1
             break
 
-    aligned_portion = compute_rep(contig_seq[left_clip_end: right_clip_start])
-
-    clip_rep = 0
-    clip_seen = 0
-    if left_clip_end > 0:
-        clip = contig_seq[:left_clip_end]
-        clip_rep += compute_rep(clip)
-        clip_seen += 1
-
-    elif right_clip_start < len(contig_seq):
-        clip = contig_seq[right_clip_start:]
-        clip_rep += compute_rep(clip)
-        clip_seen += 1
 
-    if clip_seen != 0:
-        clip_rep = clip_rep / clip_seen
-    return aligned_portion, clip_rep, right_clip_start - left_clip_end
+cdef void tandem_repeats(const unsigned char *ori, const unsigned char *seq, int str_len, SeqFeatures *f) nogil:
+    # Finds short tandem repeats in the upper-cased contig seq. Repeat units in lower case (ori) next to reference
+    # units are reported as an expansion
+    cdef int rep_len = min(7, str_len)
+    cdef int i = 0
+    cdef int t, j, start, count, mm, good_i, successive_bad, size, finish, starting_kmer_idx
+    cdef int low_start, low_end, up_end, n_upper
+    cdef bint expansion
+    cdef unsigned char starting_base
+    f.n_expansion = 0
+    f.stride = 0
+    f.exp_start = 0
+    f.ref_poly_bases = 0
+    while i < str_len:
+        for t in range(1, rep_len):
+            start = i
+            if start + t >= str_len:
+                break
+            starting_base = seq[i]
+            starting_kmer_idx = start
+            count = 1
+            mm = 0
+            good_i = 0
+            successive_bad = 0
+            finish = 0
+            while start + t < str_len and (starting_base == seq[start + t] or mm < 2):
+                start += t
+                if start + t + 1 > str_len:
+                    break
+                if memcmp(seq + start, seq + starting_kmer_idx, t) != 0:
+                    successive_bad += 1
+                    mm += 1
+                    if mm > 3 or successive_bad > 1 or count < 2:
+                        finish = good_i
+                        break
+                else:
+                    good_i = start
+                    finish = good_i
+                    successive_bad = 0
+                    count += 1
+            if count >= 3 and (finish - i) + t > 10:
+                # check for lowercase to uppercase transition; determines repeat expansion length. Only the first
+                # block of lower case units is considered, reference blocks are counted
+                low_start = -1
+                low_end = -1
+                up_end = -1
+                n_upper = 0
+                expansion = False
+                j = i
+                while j < finish:
+                    if is_lower(ori[j]):
+                        if low_start == -1:
+                            low_start = j
+                            low_end = j + t
+                            if n_upper and c_abs(up_end - j) < 3:
+                                expansion = True
+                        elif low_end == j:
+                            low_end += t
+                    else:
+                        if not n_upper and low_start != -1 and c_abs(low_end - j) < 3:
+                            expansion = True
+                        up_end = j + t
+                        n_upper += 1
+                    j += t
+                if expansion:
+                    size = low_end - low_start
+                    if size >= 10:
+                        f.n_expansion = size
+                        f.exp_start = low_start
+                        f.stride = t
+                f.ref_poly_bases += n_upper * t
+                i = finish + t
+        i += 1
+
+
+cdef void sequence_features(AssemblyWorkspace ws, const unsigned char *ori, int n, SeqFeatures *f) nogil:
+    cdef int i
+    cdef unsigned char c
+    cdef uLongf dest_len
+    f.length = n
+    f.gc = 0
+    ws.upper.resize(n)
+    cdef unsigned char *seq = ws.upper.data()
+    for i in range(n):
+        c = ori[i]
+        if is_lower(c):
+            c -= 32
+        seq[i] = c
+        if c == 71 or c == 67:  # G, C
+            f.gc += 1
+
+    dest_len = compressBound(n)
+    ws.compressed.resize(dest_len)
+    compress2(ws.compressed.data(), &dest_len, seq, n, Z_DEFAULT_COMPRESSION)
+    f.compressed = dest_len
+
+    clip_bounds(ori, n, f)
+    if f.right_clip_start > f.left_clip_end:
+        f.rep = rep_score(ws, ori + f.left_clip_end, f.right_clip_start - f.left_clip_end)
+    else:
+        f.rep = rep_score(ws, ori, 0)
+    f.has_clip = True
+    if f.left_clip_end > 0:
+        f.rep_sc = rep_score(ws, ori, f.left_clip_end)
+    elif f.right_clip_start < n:
+        f.rep_sc = rep_score(ws, ori + f.right_clip_start, n - f.right_clip_start)
+    else:
+        f.has_clip = False
+        f.rep_sc = 0
 
+    tandem_repeats(ori, seq, n, f)
 
-def contig_info(events):
 
+cdef void features_range(const unsigned char *packed, const int64_t *offsets, SeqFeatures *out, int begin, int end):
+    cdef AssemblyWorkspace ws = get_workspace()
+    cdef int i
+    with nogil:
+        for i in range(begin, end):
+            sequence_features(ws, packed + offsets[i], offsets[i + 1] - offsets[i], &out[i])
+
+
+def _features_chunk(packed, offsets, out, int begin, int end):
+    cdef const unsigned char[:] p = packed
+    cdef const int64_t[:] o = offsets
+    cdef SeqFeatures[:] f = out
+    features_range(&p[0], &o[0], &f[0], begin, end)
+
+
+SEQ_FEATURES_DTYPE = np.dtype([("length", np.int32), ("gc", np.int32), ("compressed", np.int32),
+                               ("left_clip_end", np.int32), ("right_clip_start", np.int32), ("has_clip", np.int32),
+                               ("rep", np.float32), ("rep_sc", np.float32), ("n_expansion", np.int32),
+                               ("stride", np.int32), ("exp_start", np.int32), ("ref_poly_bases", np.int32)])
+
+
+def sequence_features_batch(seqs, int threads=1):
+    """GC count, zlib compressed size, repetitiveness (compute_rep of the aligned and clipped parts) and tandem
+    repeat expansion of each sequence. Sequences are packed into one buffer with offsets and processed without
+    the GIL, split over a thread pool when threads > 1. Returns a record array with SEQ_FEATURES_DTYPE fields"""
+    cdef int n = len(seqs)
+    out = np.zeros(n, dtype=SEQ_FEATURES_DTYPE)
+    if n == 0:
+        return out
+    encoded = [s.encode("ascii") for s in seqs]
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+    packed = np.frombuffer(b"".join(encoded) + b"\0", dtype=np.uint8)
+    run_chunked(_features_chunk, (packed, offsets, out), n, threads)
+    return out
+
+
+def contig_features(events, int threads=1):
+    """Sets the contig derived fields of each event: GC content, repetitiveness, tandem repeat expansions and
+    compressibility"""
     cdef EventResult_t e
+    seqs = []
     for i in range(len(events)):
         e = events[i]
-        gc_count = 0
-        seq_length = 0
         if e.contig:
-            cont = e.contig.upper()
-            seq_length += len(cont)
-            for letter in cont:
-                if letter == "G" or letter == "C":
-                    gc_count += 1
-
+            seqs.append(e.contig)
         if e.contig2:
-            cont = e.contig2.upper()
-            seq_length += len(cont)
-            for letter in cont:
-                if letter == "G" or letter == "C":
-                    gc_count += 1
-
-        if seq_length > 0:
-            e.gc = round((gc_count / seq_length) * 100, 2)
-        else:
-            e.gc = 0
+            seqs.append(e.contig2)
+    features = sequence_features_batch(seqs, threads)
 
+    cdef int idx = 0
+    for i in range(len(events)):
+        e = events[i]
+        gc_count = 0
+        seq_length = 0
         sc_rep = 0
         aln_rep = 0
         aligned = 0
         seen = 0
-        if e.contig:
-            aln_rep1, sc_rep1, aligned_bases = get_rep(e.contig)
-            sc_rep += sc_rep1
-            aln_rep += aln_rep1
-            aligned += aligned_bases
+        c1 = []
+        e.n_expansion = 0
+        e.stride = 0
+        e.exp_seq = ""
+        e.ref_poly_bases = 0
+        for second, cont in enumerate((e.contig, e.contig2)):
+            if not cont:
+                continue
+            f = features[idx]
+            idx += 1
+            gc_count += f["gc"]
+            seq_length += f["length"]
+            aln_rep += float(f["rep"])
+            if f["has_clip"]:
+                sc_rep += float(f["rep_sc"])
+            aligned += f["right_clip_start"] - f["left_clip_end"]
             seen += 1
+            c1.append(int(f["compressed"]) / int(f["length"]))
+            # the second contig only replaces the expansion of the first if it is larger
+            if not second or e.n_expansion < f["n_expansion"]:
+                e.n_expansion = f["n_expansion"]
+                e.stride = f["stride"]
+                if f["n_expansion"]:
+                    e.exp_seq = cont[f["exp_start"]: f["exp_start"] + f["n_expansion"]]
+                else:
+                    e.exp_seq = ""
+                e.ref_poly_bases += f["ref_poly_bases"]
 
-        if e.contig2:
-            aln_rep1, sc_rep1, aligned_bases = get_rep(e.contig2)
-            seen += 1
-            sc_rep += sc_rep1
-            aln_rep += aln_rep1
-            aligned += aligned_bases
+        if seq_length > 0:
+            e.gc = round((int(gc_count) / int(seq_length)) * 100, 2)
+        else:
+            e.gc = 0
 
         if seen > 0:
             aln_rep = aln_rep / seen
@@ -772,6 +1072,11 @@ def contig_info(events):
         e.rep_sc = round(sc_rep, 3)
         e.ref_bases = aligned
 
+        if c1:
+            e.compress = round((sum(c1) / len(c1)) * 100, 2)
+        else:
+            e.compress = 0
+
     return events
 
 
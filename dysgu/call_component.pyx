@@ -1,26 +1,31 @@
 #cython: language_level=3, boundscheck=True, c_string_type=unicode, c_string_encoding=utf8, infer_types=True
 from __future__ import absolute_import
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, OrderedDict
 import logging
 import numpy as np
 cimport numpy as np
-from numpy.random import normal
 import itertools
 
 from dysgu import assembler
-from dysgu.map_set_utils import echo
+from dysgu.map_set_utils import echo, thread_pool
 from dysgu.map_set_utils cimport hash as xxhasher
 from dysgu.map_set_utils cimport is_overlapping, clip_sizes_hard, EventResult, clip_sizes, min_fractional_overlapping
 from dysgu.sv_category cimport AlignmentItem, classify_d
 from dysgu.extra_metrics cimport soft_clip_qual_corr
 from dysgu.extra_metrics import filter_poorly_aligned_ends, gap_size_upper_bound
-from pysam.libcalignedsegment cimport AlignedSegment
-from pysam.libchtslib cimport bam_get_qname, bam_get_cigar
-from libc.stdint cimport uint32_t
+from pysam.libcalignedsegment cimport AlignedSegment, makeAlignedSegment
+from pysam.libcalignmentfile cimport AlignmentHeader
+from pysam.libchtslib cimport bam_get_qname, bam_get_cigar, bam_get_qual, bam_get_aux, bam1_t, bam_init1, bam_destroy1
+from libc.stdint cimport int8_t, uint8_t, int16_t, uint16_t, int32_t, uint32_t, int64_t
 from libc.stdint cimport uint64_t
-from scipy.cluster.hierarchy import linkage
-from scipy.cluster.hierarchy import fcluster
+from libc.stdlib cimport realloc
+from libc.string cimport memcpy, memset
+from libc.math cimport sqrt, floor
+import os
+import zlib
+import threading
 import warnings
+from scipy.spatial import cKDTree
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
@@ -36,43 +41,177 @@ ctypedef enum ReadEnum_t:
     BREAKEND = 4
 
 
-cdef n_aligned_bases(AlignedSegment aln):
-    cdef int opp, l, aligned, large_gaps, n_small_gaps, i
-    cdef uint32_t cigar_value
-    cdef uint32_t cigar_l = aln._delegate.core.n_cigar
-    cdef uint32_t *cigar_p = bam_get_cigar(aln._delegate)
-    aligned, large_gaps, n_small_gaps = 0, 0, 0
-    for i in range(cigar_l):
-        cigar_value = cigar_p[i]
-        opp = <int> cigar_value & 15
-        l = <int> cigar_value >> 4
+_task_state = threading.local()
+
+
+def run_seeded(fn, args, seed):
+    # Pool tasks draw from their own random state, so results do not depend on thread timing
+    _task_state.rng = np.random.RandomState(seed)
+    try:
+        return fn(*args)
+    finally:
+        _task_state.rng = None
+
+
+cdef task_random():
+    rng = getattr(_task_state, "rng", None)
+    return np.random if rng is None else rng
+
+
+cdef int32_t le_int32(const uint8_t *p) nogil:
+    cdef int32_t v
+    memcpy(&v, p, 4)
+    return v
+
+
+cdef struct ReadStats:
+    # Per-read values used by count_attributes2, filled by read_stats in one pass over the cigar and aux data
+    int left_hard_clip, right_hard_clip  # as clip_sizes_hard
+    bint soft_clipped  # first or last cigar op is a soft-clip
+    float aligned, large_gaps, n_small_gaps
+    int n_sa, n_xa  # number of ';' in the SA and XA tags
+    bint has_nm, has_as
+    double nm
+    int as_score
+    int aligned_base_quals, aligned_bases, clipped_base_quals, clipped_bases
+
+
+cdef int aux_value_size(uint8_t type_c, const uint8_t *p, const uint8_t *end) nogil:
+    # Size in bytes of an aux value starting at p, or -1 if it runs past end
+    cdef int32_t n
+    cdef const uint8_t *q
+    if type_c == b'A' or type_c == b'c' or type_c == b'C':
+        return 1
+    if type_c == b's' or type_c == b'S':
+        return 2
+    if type_c == b'i' or type_c == b'I' or type_c == b'f':
+        return 4
+    if type_c == b'd':
+        return 8
+    if type_c == b'Z' or type_c == b'H':
+        q = p
+        while q < end and q[0] != 0:
+            q += 1
+        return -1 if q >= end else <int>(q - p) + 1
+    if type_c == b'B':
+        if p + 5 > end or p[0] == b'Z' or p[0] == b'H' or p[0] == b'B':
+            return -1
+        n = le_int32(p + 1)
+        if n < 0 or n > end - p:
+            return -1
+        return 5 + n * aux_value_size(p[0], p, end)
+    return -1
+
+
+cdef double aux_number(uint8_t type_c, const uint8_t *p) nogil:
+    cdef int16_t i16
+    cdef uint16_t u16
+    cdef uint32_t u32
+    cdef float f32
+    cdef double f64
+    if type_c == b'c':
+        return <int8_t>p[0]
+    if type_c == b'C':
+        return p[0]
+    if type_c == b's':
+        memcpy(&i16, p, 2)
+        return i16
+    if type_c == b'S':
+        memcpy(&u16, p, 2)
+        return u16
+    if type_c == b'i':
+        return le_int32(p)
+    if type_c == b'I':
+        memcpy(&u32, p, 4)
+        return u32
+    if type_c == b'f':
+        memcpy(&f32, p, 4)
+        return f32
+    if type_c == b'd':
+        memcpy(&f64, p, 8)
+        return f64
+    return 0
+
+
+cdef void read_stats(bam1_t *b, bint base_quals, ReadStats *s) nogil:
+    cdef uint32_t n_cigar = b.core.n_cigar
+    cdef uint32_t *cigar = bam_get_cigar(b)
+    cdef int opp, l, i, left_soft, right_soft, l_qseq, size
+    cdef uint8_t type_c
+    cdef const uint8_t *qual
+    cdef const uint8_t *p
+    cdef const uint8_t *end
+    cdef float abq, ab, cbq
+    memset(s, 0, sizeof(ReadStats))
+    left_soft = 0
+    right_soft = 0
+    if n_cigar > 0:
+        opp = cigar[0] & 15
+        if opp == 4 or opp == 5:
+            s.left_hard_clip = cigar[0] >> 4
+        if opp == 4:
+            left_soft = cigar[0] >> 4
+        opp = cigar[n_cigar - 1] & 15
+        if opp == 4 or opp == 5:
+            s.right_hard_clip = cigar[n_cigar - 1] >> 4
+        if opp == 4:
+            right_soft = cigar[n_cigar - 1] >> 4
+        s.soft_clipped = (cigar[0] & 15) == 4 or (cigar[n_cigar - 1] & 15) == 4
+    for i in range(n_cigar):
+        opp = cigar[i] & 15
+        l = cigar[i] >> 4
         if opp == 0:
-            aligned += l
+            s.aligned += l
         elif opp == 1 or opp == 2:
             if l >= 30:
-                large_gaps += l
+                s.large_gaps += l
             else:
-                n_small_gaps += 1
-    return float(aligned), float(large_gaps), float(n_small_gaps)
-
-
-cdef base_quals_aligned_clipped(AlignedSegment a):
-    cdef int left_clip, right_clip
-    cdef float aligned_base_quals = 0
-    cdef float aligned_bases = 0
-    cdef float clipped_base_quals = 0
-    left_clip, right_clip = clip_sizes(a)
-    clipped_bases = left_clip + right_clip
-    cdef const unsigned char[:] quals = a.query_qualities
-    cdef int i
-    for i in range(left_clip):
-        clipped_base_quals += quals[i]
-    for i in range(left_clip, len(quals) - right_clip):
-        aligned_base_quals += quals[i]
-        aligned_bases += 1
-    for i in range(len(quals) - right_clip, len(quals)):
-        clipped_base_quals += quals[i]
-    return aligned_base_quals, aligned_bases, clipped_base_quals, clipped_bases
+                s.n_small_gaps += 1
+    # SA, XA, NM and AS in one pass over the aux data. The first copy of a tag is used, the same as bam_aux_get
+    cdef bint has_sa = 0
+    cdef bint has_xa = 0
+    p = bam_get_aux(b)
+    end = b.data + b.l_data
+    while p + 3 <= end:
+        type_c = p[2]
+        size = aux_value_size(type_c, p + 3, end)
+        if size < 0 or p + 3 + size > end:
+            break
+        if p[0] == b'S' and p[1] == b'A' and not has_sa:
+            has_sa = 1
+            for i in range(size if type_c == b'Z' else 0):
+                if p[3 + i] == b';':
+                    s.n_sa += 1
+        elif p[0] == b'X' and p[1] == b'A' and not has_xa:
+            has_xa = 1
+            for i in range(size if type_c == b'Z' else 0):
+                if p[3 + i] == b';':
+                    s.n_xa += 1
+        elif p[0] == b'N' and p[1] == b'M' and not s.has_nm:
+            s.has_nm = 1
+            s.nm = aux_number(type_c, p + 3)
+        elif p[0] == b'A' and p[1] == b'S' and not s.has_as:
+            s.has_as = 1
+            s.as_score = <int>aux_number(type_c, p + 3)
+        p += 3 + size
+    if base_quals:
+        l_qseq = b.core.l_qseq
+        qual = bam_get_qual(b)
+        abq = 0
+        ab = 0
+        cbq = 0
+        if l_qseq > 0 and qual[0] != 0xff:
+            for i in range(min(left_soft, l_qseq)):
+                cbq += qual[i]
+            for i in range(left_soft, l_qseq - right_soft):
+                abq += qual[i]
+                ab += 1
+            for i in range(max(l_qseq - right_soft, 0), l_qseq):
+                cbq += qual[i]
+        s.aligned_base_quals = <int>abq
+        s.aligned_bases = <int>ab
+        s.clipped_base_quals = <int>cbq
+        s.clipped_bases = left_soft + right_soft
 
 
 cdef count_attributes2(reads1, reads2, spanning, float insert_ppf, generic_ins,
@@ -91,117 +230,87 @@ cdef count_attributes2(reads1, reads2, spanning, float insert_ppf, generic_ins,
     cdef float aligned_bases = 0
     cdef float clipped_base_quals = 0
     cdef float clipped_bases = 0
-    cdef int abq, ab, cbq, cb
+    # EventResult counts, written once at the end
+    cdef int n_np = 0
+    cdef int n_small_tlen = 0
+    cdef int n_unmapped_mates = 0
+    cdef int double_clips = 0
+    cdef int supp = 0
+    cdef int pe = 0
+    cdef int minus = 0
+    cdef int plus = 0
+    cdef int sc = 0
+    cdef ReadStats st
     paired_end = set([])
-    seen = set([])
     er.spanning = len(spanning)
     er.bnd = len(generic_ins)
-    cdef int flag, index, this_as
-    cdef float a_bases, large_gaps, n_small_gaps
+    cdef int flag, index, n_first, is_spanning
     cdef AlignedSegment a
-    for index, a in enumerate(itertools.chain(reads1, reads2, [i.read_a for i in generic_ins])):
-        flag = a.flag
+    cdef bam1_t *b
+    n_first = len(reads1) + len(reads2) + len(generic_ins)
+    for index, a in enumerate(itertools.chain(reads1, reads2, [i.read_a for i in generic_ins], spanning)):
+        b = a._delegate
+        is_spanning = index >= n_first
+        flag = b.core.flag
+        read_stats(b, flag & 1, &st)
         if flag & 2:
-            er.NP += 1
-        if a.flag & 1 and a.tlen and abs(a.tlen) < insert_ppf:
-            er.n_small_tlen += 1
-        if paired_end_reads and paired_end and flag & 8:
-            er.n_unmapped_mates += 1
-        left_clip, right_clip = clip_sizes_hard(a)
-        if left_clip > 0 and right_clip > 0:
-            er.double_clips += 1
-        has_sa = a.has_tag("SA")
-        if has_sa:
-            n_sa += a.get_tag("SA").count(";")
-        if a.has_tag("XA"):
-            n_xa += a.get_tag("XA").count(";")
-        a_bases, large_gaps, n_small_gaps = n_aligned_bases(a)
-        if a_bases > 0:
-            n_gaps += n_small_gaps / a_bases
+            n_np += 1
+        if not is_spanning:
+            if flag & 1 and b.core.isize and <double>abs(b.core.isize) < <double>insert_ppf:
+                n_small_tlen += 1
+            if paired_end_reads and len(paired_end) > 0 and flag & 8:
+                n_unmapped_mates += 1
+        if st.left_hard_clip > 0 and st.right_hard_clip > 0:
+            double_clips += 1
+        n_sa += st.n_sa
+        n_xa += st.n_xa
+        if st.aligned > 0:
+            n_gaps += st.n_small_gaps / st.aligned
         if flag & 2304:  # Supplementary (and not primary if -M if flagged using bwa)
-            er.supp += 1
-            MAPQsupp += a.mapq
-            if a.has_tag("NM"):
-                if a_bases:
-                    NMsupp += float(a.get_tag("NM")) / a_bases
-            if a.has_tag("AS"):
-                this_as = a.get_tag("AS")
-                if this_as > maxASsupp:
-                    maxASsupp = this_as
-        else:  # Primary reads
-            total_pri += 1
-            MAPQpri += a.mapq
-            if paired_end_reads:
-                if index >= len(reads2) and a.qname in paired_end:
-                    er.pe += 1
-                else:
-                    paired_end.add(a.qname)
-            if a.has_tag("NM"):
-                if a_bases:
-                    nm = float(a.get_tag("NM"))
-                    NMpri += nm / a_bases
-                    NMbase += (nm - large_gaps) / a_bases
-        if flag & 16:
-            er.minus += 1
-        else:
-            er.plus += 1
-        ct = a.cigartuples
-        if ct[0][0] == 4 or ct[-1][0] == 4:
-            er.sc += 1
-        if a.flag & 1:  # paired read
-            abq, ab, cbq, cb = base_quals_aligned_clipped(a)
-            aligned_base_quals += abq
-            aligned_bases += ab
-            clipped_base_quals += cbq
-            clipped_bases += cb
-
-    for a in spanning:
-        flag = a.flag
-        if flag & 2:
-            er.NP += 1
-        left_clip, right_clip = clip_sizes_hard(a)
-        if left_clip > 0 and right_clip > 0:
-            er.double_clips += 1
-        if a.has_tag("SA"):
-            n_sa += a.get_tag("SA").count(";")
-        if a.has_tag("XA"):
-            n_xa += a.get_tag("XA").count(";")
-        a_bases, large_gaps, n_small_gaps = n_aligned_bases(a)
-        if a_bases > 0:
-            n_gaps += n_small_gaps / a_bases
-        if flag & 2304:  # Supplementary
-            MAPQsupp += a.mapq
-            if a.has_tag("NM"):
-                if a_bases:
-                    NMsupp += float(a.get_tag("NM")) / a_bases
-            if a.has_tag("AS"):
-                this_as = a.get_tag("AS")
-                if this_as > maxASsupp:
-                    maxASsupp = this_as
+            if not is_spanning:
+                supp += 1
+            MAPQsupp += b.core.qual
+            if st.has_nm and st.aligned:
+                NMsupp += st.nm / st.aligned
+            if st.has_as and st.as_score > maxASsupp:
+                maxASsupp = st.as_score
         else:  # Primary reads
-            MAPQpri += a.mapq
             total_pri += 1
+            MAPQpri += b.core.qual
             if paired_end_reads:
-                if a.qname in paired_end:  # If two primary reads from same pair
-                    er.pe += 2
+                if is_spanning:
+                    if a.qname in paired_end:  # If two primary reads from same pair
+                        pe += 2
+                    else:
+                        paired_end.add(a.qname)
+                elif index >= len(reads2) and a.qname in paired_end:
+                    pe += 1
                 else:
                     paired_end.add(a.qname)
-            if a.has_tag("NM"):
-                if a_bases:
-                    nm = float(a.get_tag("NM"))
-                    NMpri += nm / a_bases
-                    NMbase += (nm - large_gaps) / a_bases
+            if st.has_nm and st.aligned:
+                NMpri += st.nm / st.aligned
+                NMbase += (st.nm - st.large_gaps) / st.aligned
         if flag & 16:
-            er.minus += 1
+            minus += 1
         else:
-            er.plus += 1
-        if a.flag & 1:
-            abq, ab, cbq, cb = base_quals_aligned_clipped(a)
-            aligned_base_quals += abq
-            aligned_bases += ab
-            clipped_base_quals += cbq
-            clipped_bases += cb
-
+            plus += 1
+        if not is_spanning and st.soft_clipped:
+            sc += 1
+        if flag & 1:  # paired read
+            aligned_base_quals += st.aligned_base_quals
+            aligned_bases += st.aligned_bases
+            clipped_base_quals += st.clipped_base_quals
+            clipped_bases += st.clipped_bases
+
+    er.NP += n_np
+    er.n_small_tlen += n_small_tlen
+    er.n_unmapped_mates += n_unmapped_mates
+    er.double_clips += double_clips
+    er.supp += supp
+    er.pe += pe
+    er.minus += minus
+    er.plus += plus
+    er.sc += sc
     cdef int tot = er.supp + total_pri
     er.NMpri = (NMpri / total_pri) * 100 if total_pri > 0 else 0
     er.NMsupp = (NMsupp / er.supp) * 100 if er.supp > 0 else 0
@@ -395,7 +504,7 @@ cdef make_generic_insertion_item(aln, int insert_size, int insert_std):
     aln_span = aln.reference_end - aln.pos
     v_item.size_inferred = 1
     if insert_std > 0:
-        rand_insert_pos = abs(insert_size - aln_span + int(normal(0, insert_std)))
+        rand_insert_pos = abs(insert_size - aln_span + int(task_random().normal(0, insert_std)))
     else:  # single read mode
         v_item.svtype = "BND"
         clip_s = max(clip_sizes(aln))
@@ -474,6 +583,60 @@ cpdef int assign_contig_to_break(asmb, EventResult_t er, side, spanning):
     return ref_bases
 
 
+MAX_SAMPLED_READS = 500  # reads of a partition used for breakpoint estimation and assembly, support uses all of them
+
+
+cdef list stratified_sample(list items, list reads, int cap):
+    # Deterministic sample of about cap items. Templates are ranked by a hash of their name and one global hash
+    # cutoff is used for every read, so mates and supplementary alignments are always kept together. Strata are the
+    # strand and evidence type of the matching read; a stratum with no template under the cutoff keeps its lowest
+    # ranked template, so rare evidence types are not lost. Items keep their input order, and are returned unchanged
+    # when there are no more than cap
+    cdef int n = len(items)
+    if n <= cap:
+        return items
+    cdef AlignedSegment r
+    cdef int k, s, flag, first_op, last_op
+    cdef uint32_t n_cigar
+    cdef uint32_t *cigar_p
+    cdef uint64_t h
+    hashes = []
+    lowest = {}
+    for k in range(n):
+        r = reads[k]
+        flag = r._delegate.core.flag
+        n_cigar = r._delegate.core.n_cigar
+        cigar_p = bam_get_cigar(r._delegate)
+        first_op = cigar_p[0] & 15 if n_cigar else 0
+        last_op = cigar_p[n_cigar - 1] & 15 if n_cigar else 0
+        if flag & 2048 or r.has_tag("SA"):
+            s = 0  # split
+        elif flag & 1 and not flag & 2:
+            s = 2  # discordant pair
+        elif first_op == 4 or first_op == 5 or last_op == 4 or last_op == 5:
+            s = 4  # clipped
+        else:
+            s = 6  # spanning or other
+        if flag & 16:
+            s += 1
+        h = xxhasher(bam_get_qname(r._delegate), len(r.qname), 42)
+        hashes.append(h)
+        if s not in lowest or h < lowest[s]:
+            lowest[s] = h
+    # The cutoff is the hash of the cap-th ranked item; every item of a template at or below it is kept
+    cdef uint64_t cutoff = sorted(hashes)[cap - 1]
+    extra = {h for h in lowest.values() if h > cutoff}
+    keep = []
+    for k in range(n):
+        if hashes[k] <= cutoff or hashes[k] in extra:
+            keep.append(items[k])
+    return keep
+
+
+cdef list sample_reads(list reads):
+    return stratified_sample(reads, reads, MAX_SAMPLED_READS)
+
+
 cdef make_single_call(sub_informative, insert_size, insert_stdev, insert_ppf, min_support, to_assemble, spanning_alignments,
                       svlen_precise, generic_ins, site, bint paired_end):
     cdef EventResult_t er = EventResult()
@@ -520,11 +683,11 @@ cdef make_single_call(sub_informative, insert_size, insert_stdev, insert_ppf, mi
     ref_bases = 0
     if to_assemble or len(spanning_alignments) > 0:
         if er.preciseA:
-            as1 = assembler.base_assemble(u_reads, er.posA, 500)
+            as1 = assembler.base_assemble(sample_reads(u_reads), er.posA, 500)
             if as1 and (er.svtype != "TRA" or (as1['contig'] and (as1['contig'][0].islower() or as1['contig'][-1].islower()))):
                 ref_bases += assign_contig_to_break(as1, er, "A", spanning_alignments)
         if er.preciseB:
-            as2 = assembler.base_assemble(v_reads, er.posB, 500)
+            as2 = assembler.base_assemble(sample_reads(v_reads), er.posB, 500)
             if as2 and (er.svtype != "TRA" or (as2['contig'] and (as2['contig'][0].islower() or as2['contig'][-1].islower()))):
                 ref_bases += assign_contig_to_break(as2, er, "B", 0)
     er.linked = 0
@@ -584,6 +747,104 @@ def assign_sites_to_clusters(sites_info, clusters, informative, coords, cluster_
     return clusters_d, sites_to_clusters
 
 
+cdef int uf_find(int[:] parent, int i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+LINKAGE_PAIRWISE_MAX = 4096  # cell pairs with more point pairs than this are checked with a KD-tree
+
+
+def cell_pair_linked(coords, cells, trees, key_a, key_b, double cut):
+    # True if any point of cell a is within cut of a point in cell b. The nearest neighbour in the larger cell is
+    # found for each point of the smaller cell, using a slightly widened bound, then confirmed with the same
+    # distance test as the pairwise check
+    cdef int q, t
+    cdef double d0, d1
+    small, big = cells[key_a], cells[key_b]
+    if len(small) > len(big):
+        small, big = big, small
+        key_b = key_a
+    if key_b not in trees:
+        trees[key_b] = cKDTree(np.asarray(coords)[big])
+    _, nearest = trees[key_b].query(np.asarray(coords)[small], k=1, distance_upper_bound=cut * (1 + 1e-9))
+    for q, t in zip(small, nearest.tolist()):
+        if t < len(big):
+            d0 = coords[q, 0] - coords[big[t], 0]
+            d1 = coords[q, 1] - coords[big[t], 1]
+            if sqrt(d0 * d0 + d1 * d1) <= cut:
+                return True
+    return False
+
+
+cpdef np.ndarray single_linkage_clusters(double[:, :] coords, double cut):
+    """Flat clusters of 2d points, the same as fcluster(linkage(coords, 'single'), cut, criterion='distance').
+    Points are connected if their euclidean distance is <= cut. Points are binned into a grid with cell side
+    cut / sqrt(2), so every pair in a cell is connected. Only cells up to 2 apart need a check for a close pair,
+    so the distance matrix is never made. Small cell pairs are checked pairwise, stopping at the first close pair;
+    for larger pairs the smaller cell queries a KD-tree of the larger one, so two dense cells that never link
+    cost O((|A| + |B|) log |B|) rather than |A|.|B|, and the whole clustering is O(n log n). Cluster ids are
+    numbered from 1 in order of first appearance"""
+    cdef int n = coords.shape[0]
+    cdef int i, j, k, a, b, ra, rb, dx, dy
+    cdef double side, d0, d1
+    labels = np.zeros(n, dtype=np.int32)
+    if n == 0:
+        return labels
+    cdef int[:] parent = np.arange(n, dtype=np.int32)
+    side = cut / sqrt(2) if cut > 0 else 0
+    cells = defaultdict(list)
+    trees = {}
+    for i in range(n):
+        if side > 0:
+            cells[(<long>floor(coords[i, 0] / side), <long>floor(coords[i, 1] / side))].append(i)
+        else:
+            cells[(coords[i, 0], coords[i, 1])].append(i)
+    for members in cells.values():
+        ra = uf_find(parent, members[0])
+        for k in range(1, len(members)):
+            rb = uf_find(parent, members[k])
+            if rb != ra:
+                parent[rb] = ra
+    if side > 0:
+        for (cx, cy), members in cells.items():
+            for dx in range(-2, 3):
+                for dy in range(-2, 3):
+                    if dx < 0 or (dx == 0 and dy <= 0):
+                        continue  # each pair of cells is visited once
+                    other = cells.get((cx + dx, cy + dy))
+                    if other is None:
+                        continue
+                    ra = uf_find(parent, members[0])
+                    rb = uf_find(parent, other[0])
+                    if ra == rb:
+                        continue
+                    if len(members) * len(other) > LINKAGE_PAIRWISE_MAX:
+                        if cell_pair_linked(coords, cells, trees, (cx, cy), (cx + dx, cy + dy), cut):
+                            parent[rb] = ra
+                        continue
+                    for a in members:
+                        for b in other:
+                            d0 = coords[a, 0] - coords[b, 0]
+                            d1 = coords[a, 1] - coords[b, 1]
+                            if sqrt(d0 * d0 + d1 * d1) <= cut:
+                                parent[rb] = ra
+                                break
+                        else:
+                            continue
+                        break
+    cdef int[:] lab = labels
+    root_label = {}
+    for i in range(n):
+        ra = uf_find(parent, i)
+        if ra not in root_label:
+            root_label[ra] = len(root_label) + 1
+        lab[i] = root_label[ra]
+    return labels
+
+
 cdef partition_single(informative, insert_size, insert_stdev, insert_ppf, spanning_alignments,
                       min_support, to_assemble, generic_insertions, sites_info, bint paired_end):
     # spanning alignments is empty
@@ -615,18 +876,7 @@ cdef partition_single(informative, insert_size, insert_stdev, insert_ppf, spanni
     sub_cluster_calls = []
     cdef EventResult_t er
     if try_cluster:
-        try:
-            Z = linkage(coords, 'single')
-        except:
-            logging.warning("Linkage clustering failed, at chromosome tid {}, position {}. n-reads in cluster {}".format(
-                informative[0].chrA, informative[0].breakA, len(coords)))
-            return []
-        try:
-            clusters = fcluster(Z, insert_size, criterion='distance')
-        except:
-            logging.warning("fcluster function failed, at chromosome tid {}, position {}. n-reads in cluster {}".format(
-                informative[0].chrA, informative[0].breakA, len(coords)))
-            return []
+        clusters = single_linkage_clusters(coords, insert_size)
         # cluster ids start are >=1, so bincount 0 is always 0
         cluster_count = len(np.bincount(clusters)) - 1
         if sites_info:
@@ -726,39 +976,41 @@ cdef single(rds, int insert_size, int insert_stdev, float insert_ppf, int clip_l
     cdef bint passed
     cdef EventResult_t er
     if len(spanning_alignments) > 0:
-
+        cigar_profiles = {}
         if not paired_end:
-            spanning_alignments, rate_poor_ends = filter_poorly_aligned_ends(spanning_alignments, divergence)
+            spanning_alignments, rate_poor_ends = filter_poorly_aligned_ends(spanning_alignments, divergence, cigar_profiles)
             if not spanning_alignments or rate_poor_ends > 0.7:
                 return []
 
         # make call from spanning alignments if possible
         svtype_m = Counter([i[0] for i in spanning_alignments]).most_common()[0][0]
         spanning_alignments = [i for i in spanning_alignments if i[0] == svtype_m]
-        posA_arr = [i[2] for i in spanning_alignments]
+        # breakpoints and contigs come from a sample at very high depth, support is counted from all alignments
+        spanning_sample = stratified_sample(spanning_alignments, [i[5] for i in spanning_alignments], MAX_SAMPLED_READS)
+        posA_arr = [i[2] for i in spanning_sample]
         posA = int(np.median(posA_arr))
         posA_95 = int(abs(int(np.percentile(posA_arr, [97.5])) - posA))
-        posB_arr = [i[3] for i in spanning_alignments]
+        posB_arr = [i[3] for i in spanning_sample]
         posB = int(np.median(posB_arr))
         posB_95 = int(abs(int(np.percentile(posB_arr, [97.5])) - posB))
-        chrom = spanning_alignments[0][1]
+        chrom = spanning_sample[0][1]
         # choose representative alignment to use
         best_index = 0
         best_dist = 1e9
-        for index in range(len(spanning_alignments)):
-            dist = abs(spanning_alignments[index][2] - posA) + abs(spanning_alignments[index][3] - posB)
+        for index in range(len(spanning_sample)):
+            dist = abs(spanning_sample[index][2] - posA) + abs(spanning_sample[index][3] - posB)
             if dist < best_dist:
                 best_index = index
                 best_dist = dist
                 if dist == 0:
                     break
 
-        best_align = spanning_alignments[best_index][5]
+        best_align = spanning_sample[best_index][5]
 
         er = EventResult()
 
         if not paired_end:
-            size_pos_bounded = [gap_size_upper_bound(sp[5], sp[6], sp[2], sp[3], length_extend, divergence) for sp in spanning_alignments]
+            size_pos_bounded = [gap_size_upper_bound(sp[5], sp[6], sp[2], sp[3], length_extend, divergence, cigar_profiles) for sp in spanning_sample]
             svlen_adjusted = int(np.median([b[0] for b in size_pos_bounded]))
             posA_adjusted = int(np.median([b[1] for b in size_pos_bounded]))
             posB_adjusted = int(np.median([b[2] for b in size_pos_bounded]))
@@ -777,9 +1029,9 @@ cdef single(rds, int insert_size, int insert_stdev, float insert_ppf, int clip_l
                 svlen = svlen_adjusted
 
         else:
-            svlen = int(np.median([sp[4] for sp in spanning_alignments]))
-            posA = spanning_alignments[best_index][2]
-            posB = spanning_alignments[best_index][3]
+            svlen = int(np.median([sp[4] for sp in spanning_sample]))
+            posA = spanning_sample[best_index][2]
+            posB = spanning_sample[best_index][3]
             er.preciseA = True
             er.preciseB = True
 
@@ -801,7 +1053,7 @@ cdef single(rds, int insert_size, int insert_stdev, float insert_ppf, int clip_l
         er.query_gap = 0
         er.query_overlap = 0
         er.jitter = jitter
-        u_reads = [i[5] for i in spanning_alignments]
+        u_reads = [i[5] for i in spanning_sample]
         v_reads = []
         min_found_support = len(spanning_alignments)
         if len(generic_insertions) > 0:
@@ -834,7 +1086,7 @@ cdef single(rds, int insert_size, int insert_stdev, float insert_ppf, int clip_l
                 if as2:
                     ref_bases += assign_contig_to_break(as2, er, "B", 0)
             if not as1 and len(generic_insertions) > 0:
-                as1 = assembler.base_assemble([item.read_a for item in generic_insertions], er.posA, 500)
+                as1 = assembler.base_assemble(sample_reads([item.read_a for item in generic_insertions]), er.posA, 500)
                 if as1:
                     ref_bases += assign_contig_to_break(as1, er, "A", 0)
         er.linked = 0
@@ -842,7 +1094,7 @@ cdef single(rds, int insert_size, int insert_stdev, float insert_ppf, int clip_l
         er.ref_bases = ref_bases
         er.sqc = -1  # not calculated
         if er.svtype == "INS":
-            cigar_index = spanning_alignments[best_index][6]
+            cigar_index = spanning_sample[best_index][6]
             start_ins = 0
             ct = best_align.cigartuples
             target_len = svlen
@@ -1243,12 +1495,12 @@ cdef void assemble_partitioned_reads(EventResult_t er, u_reads, v_reads, int blo
     as2 = None
     if assemble:
         if er.preciseA:
-            as1 = assembler.base_assemble(u_reads, er.posA, 500)
+            as1 = assembler.base_assemble(sample_reads(u_reads), er.posA, 500)
             if as1:
                 if er.spanning == 0 and not (as1['left_clips'] or as1['right_clips']):
                     as1 = None
         if (er.spanning == 0 or as1 is None) and er.preciseB:
-            as2 = assembler.base_assemble(v_reads, er.posB, 500)
+            as2 = assembler.base_assemble(sample_reads(v_reads), er.posB, 500)
             if as2 :
                 if not (as2['left_clips'] or as2['right_clips']):
                     as2 = None
@@ -1481,28 +1733,29 @@ cdef one_edge(u_reads_info, v_reads_info, int clip_length, int insert_size, int
     # make call from spanning alignments if possible
     cdef EventResult_t er
     if len(spanning_alignments) > 0:
-        posA_arr = [i[2] for i in spanning_alignments]
+        spanning_sample = stratified_sample(spanning_alignments, [i[5] for i in spanning_alignments], MAX_SAMPLED_READS)
+        posA_arr = [i[2] for i in spanning_sample]
         posA = int(np.median(posA_arr))
         posA_95 = int(abs(int(np.percentile(posA_arr, [97.5])) - posA))
-        posB_arr = [i[3] for i in spanning_alignments]
+        posB_arr = [i[3] for i in spanning_sample]
         posB = int(np.median(posB_arr))
         posB_95 = int(abs(int(np.percentile(posB_arr, [97.5])) - posB))
-        chrom = spanning_alignments[0][1]
+        chrom = spanning_sample[0][1]
         # choose representative alignment to use
         best_index = 0
         best_dist = 1e9
-        for index in range(len(spanning_alignments)):
-            dist = abs(spanning_alignments[index][2] - posA) + abs(spanning_alignments[index][3] - posB)
+        for index in range(len(spanning_sample)):
+            dist = abs(spanning_sample[index][2] - posA) + abs(spanning_sample[index][3] - posB)
             if dist < best_dist:
                 best_index = index
                 best_dist = dist
                 if dist == 0:
                     break
 
-        best_align = spanning_alignments[best_index][5]
-        svlen = spanning_alignments[best_index][4]
-        posA = spanning_alignments[best_index][2]
-        posB = spanning_alignments[best_index][3]
+        best_align = spanning_sample[best_index][5]
+        svlen = spanning_sample[best_index][4]
+        posA = spanning_sample[best_index][2]
+        posB = spanning_sample[best_index][3]
         if svlen > 0:
             jitter = ((posA_95 + posB_95) / 2) / svlen
         else:
@@ -1530,7 +1783,7 @@ cdef one_edge(u_reads_info, v_reads_info, int clip_length, int insert_size, int
 
         assemble_partitioned_reads(er, u_reads, v_reads, block_edge, assemble)
         if er.svtype == "INS":
-            cigar_index = spanning_alignments[best_index][6]
+            cigar_index = spanning_sample[best_index][6]
             start_ins = 0
             ct = best_align.cigartuples
             for i in range(cigar_index):
@@ -1563,6 +1816,150 @@ def fpos_srt(x):
     return x[0].tell
 
 
+BGZF_CACHE_BLOCKS = 64  # inflated blocks kept by a BlockReader, each is at most 64 kb
+
+
+cdef class BlockReader:
+    """Fetches alignments from a bgzf bam by virtual file offset. Each block is inflated once and held in a
+    small LRU that is kept across components, so nodes sharing a block are read in one forward pass instead of
+    a seek and re-inflate per node. Made with make_block_reader and used by get_reads in place of seek/next"""
+    cdef object infile, blocks
+    cdef int fd, cache_blocks
+    cdef int64_t coffset, uoffset
+    cdef AlignmentHeader header
+    cdef bam1_t *scratch
+    def __cinit__(self):
+        self.scratch = bam_init1()
+        self.fd = -1
+    def __init__(self, infile, int cache_blocks=BGZF_CACHE_BLOCKS):
+        self.infile = infile
+        self.header = infile.header
+        self.fd = os.open(infile.filename, os.O_RDONLY)
+        self.blocks = OrderedDict()
+        self.cache_blocks = cache_blocks
+    def __dealloc__(self):
+        if self.scratch != NULL:
+            bam_destroy1(self.scratch)
+        if self.fd != -1:
+            os.close(self.fd)
+    def close(self):
+        if self.fd != -1:
+            os.close(self.fd)
+            self.fd = -1
+        self.blocks.clear()
+
+    cdef tuple block(self, int64_t coffset):
+        # Returns (inflated block, offset of the next block). Next offset is -1 past the end of the file
+        b = self.blocks.get(coffset)
+        if b is not None:
+            self.blocks.move_to_end(coffset)
+            return b
+        raw = os.pread(self.fd, 65536, coffset)
+        if len(raw) < 18:
+            return b"", -1
+        xlen = raw[10] | (raw[11] << 8)
+        bsize = -1
+        i = 12
+        while i < 12 + xlen:  # find the BC subfield holding the block size
+            slen = raw[i + 2] | (raw[i + 3] << 8)
+            if raw[i] == 66 and raw[i + 1] == 67:
+                bsize = (raw[i + 4] | (raw[i + 5] << 8)) + 1
+                break
+            i += 4 + slen
+        if bsize == -1:
+            raise ValueError("Input file is not bgzf compressed")
+        b = (zlib.decompress(raw[12 + xlen: bsize - 8], -15), coffset + bsize)
+        self.blocks[coffset] = b
+        if len(self.blocks) > self.cache_blocks:
+            self.blocks.popitem(last=False)
+        return b
+
+    cdef bytes take(self, int n):
+        # n bytes from the current position, which is moved past them. None at the end of the file
+        cdef int k
+        parts = []
+        while n > 0:
+            data, nxt = self.block(self.coffset)
+            if nxt == -1:
+                return None
+            k = min(len(data) - self.uoffset, n)
+            if k <= 0:
+                self.coffset = nxt
+                self.uoffset = 0
+                continue
+            parts.append(data[self.uoffset: self.uoffset + k])
+            self.uoffset += k
+            n -= k
+        return b"".join(parts)
+
+    cdef AlignedSegment read_at(self, uint64_t voffset):
+        self.coffset = voffset >> 16
+        self.uoffset = voffset & 0xFFFF
+        return self.next_read()
+
+    cdef AlignedSegment next_read(self):
+        # Unpacks the next record the same way as bam_read1, returns None at the end of the file
+        cdef uint64_t start = (self.coffset << 16) | self.uoffset
+        head = self.take(4)
+        if head is None:
+            return None
+        rec = self.take(le_int32(head))
+        if rec is None or len(rec) < 32:
+            return None
+        cdef const uint8_t *p = rec
+        cdef int n = len(rec)
+        cdef int l_qname = p[8]
+        cdef int l_extranul = (4 - l_qname % 4) % 4
+        cdef int l_data = n - 32 + l_extranul
+        cdef bam1_t *b = self.scratch
+        cdef uint16_t v16
+        if b.m_data < <uint32_t>l_data:
+            b.data = <uint8_t *>realloc(b.data, l_data)
+            b.m_data = l_data
+        b.core.tid = le_int32(p)
+        b.core.pos = le_int32(p + 4)
+        b.core.l_qname = l_qname + l_extranul
+        b.core.qual = p[9]
+        memcpy(&v16, p + 10, 2)
+        b.core.bin = v16
+        memcpy(&v16, p + 12, 2)
+        b.core.n_cigar = v16
+        memcpy(&v16, p + 14, 2)
+        b.core.flag = v16
+        b.core.l_extranul = l_extranul
+        b.core.l_qseq = le_int32(p + 16)
+        b.core.mtid = le_int32(p + 20)
+        b.core.mpos = le_int32(p + 24)
+        b.core.isize = le_int32(p + 28)
+        memcpy(b.data, p + 32, l_qname)
+        memset(b.data + l_qname, 0, l_extranul)
+        memcpy(b.data + l_qname + l_extranul, p + 32 + l_qname, n - 32 - l_qname)
+        b.l_data = l_data
+        cdef uint32_t *cigar = bam_get_cigar(b)
+        if b.core.n_cigar == 2 and cigar[0] == ((<uint32_t>b.core.l_qseq << 4) | 4) and (cigar[1] & 15) == 3:
+            # Long cigar held in the CG tag, leave this one to htslib
+            self.infile.seek(start)
+            return next(self.infile)
+        return makeAlignedSegment(b, self.header)
+
+    def fetch(self, offsets):
+        """Alignments at the given virtual file offsets, read in file order so each block is inflated once.
+        Returned in the order of offsets, None for an offset past the end of the file"""
+        order = sorted(range(len(offsets)), key=offsets.__getitem__)
+        found = [None] * len(offsets)
+        for i in order:
+            found[i] = self.read_at(offsets[i])
+        return found
+
+
+def make_block_reader(infile):
+    """BlockReader for infile, or None when infile is not a seekable bam file, e.g. cram, in which case get_reads
+    seeks in infile for each read"""
+    if not infile.is_bam or infile.is_stream or infile.is_remote or not os.path.isfile(infile.filename):
+        return None
+    return BlockReader(infile)
+
+
 cdef get_reads(infile, nodes_info, buffered_reads, n2n, bint add_to_buffer, sites_index):
     cdef int j, int_node, steps
     cdef uint64_t p
@@ -1579,12 +1976,18 @@ cdef get_reads(infile, nodes_info, buffered_reads, n2n, bint add_to_buffer, site
             aligns.append((n, buffered_reads[int_node]))
             continue
         fpos.append((n, int_node))
+    cdef BlockReader reader = infile if isinstance(infile, BlockReader) else None
     for node, int_node in sorted(fpos, key=fpos_srt):
-        infile.seek(node.tell)
-        try:
-            a = next(infile)
-        except StopIteration:
-            return aligns
+        if reader is not None:
+            a = reader.read_at(node.tell)
+            if a is None:
+                return aligns
+        else:
+            infile.seek(node.tell)
+            try:
+                a = next(infile)
+            except StopIteration:
+                return aligns
         v = xxhasher(bam_get_qname(a._delegate), len(a.qname), 42)
         if v == node.hash_name and a.flag == node.flag and a.pos == node.pos and a.rname == node.chrom:
             aligns.append((node, a))
@@ -1594,10 +1997,15 @@ cdef get_reads(infile, nodes_info, buffered_reads, n2n, bint add_to_buffer, site
         else:  # Try next few reads, find the read in the bgzf block?
             steps = 0
             while steps < 50:
-                try:
-                    a = next(infile)
-                except StopIteration:
-                    return aligns
+                if reader is not None:
+                    a = reader.next_read()
+                    if a is None:
+                        return aligns
+                else:
+                    try:
+                        a = next(infile)
+                    except StopIteration:
+                        return aligns
                 steps += 1
                 v = xxhasher(bam_get_qname(a._delegate), len(a.qname), 42)
                 if v == node.hash_name and a.flag == node.flag and a.pos == node.pos and a.rname == node.chrom:
@@ -1609,8 +2017,34 @@ cdef get_reads(infile, nodes_info, buffered_reads, n2n, bint add_to_buffer, site
     return aligns
 
 
+def edge_calls(rd_u, rd_v, clip_length, insert_size, insert_stdev, insert_ppf, min_support, assemble_contigs, sites_info,
+               paired_end):
+    return one_edge(rd_u, rd_v, clip_length, insert_size, insert_stdev, insert_ppf, min_support, 1, assemble_contigs,
+                    sites_info, paired_end)
+
+
+def single_calls(rds, insert_size, insert_stdev, insert_ppf, clip_length, min_support, assemble_contigs, sites_info,
+                 paired_end, length_extend, divergence):
+    res = single(rds, insert_size, insert_stdev, insert_ppf, clip_length, min_support, assemble_contigs,
+                 sites_info, paired_end, length_extend, divergence)
+    if not res:
+        return []
+    if isinstance(res, EventResult):
+        return [res]
+    return res
+
+
+cdef void add_calls(list calls, pool, fn, tuple args):
+    # Calls are run now, or queued in the pool. Either way they are collected in the order they were added
+    if pool is None:
+        calls.append(fn(*args))
+    else:
+        calls.append(pool.submit(run_seeded, fn, args, np.random.randint(0, 2147483647)))
+
+
 cdef list multi(data, bam, int insert_size, int insert_stdev, float insert_ppf, int clip_length, int min_support, int lower_bound_support,
-                 int assemble_contigs, int max_single_size, info, bint paired_end, int length_extend, float divergence):
+                 int assemble_contigs, int max_single_size, info, bint paired_end, int length_extend, float divergence,
+                 int threads):
 
     # Sometimes partitions are not linked, happens when there is not much support between partitions
     # Then need to decide whether to call from a single partition
@@ -1626,6 +2060,12 @@ cdef list multi(data, bam, int insert_size, int insert_stdev, float insert_ppf,
         sites_info = list(info.values())
     else:
         sites_info = []
+    # Reads are collected here in order, the calls on them can run in threads. Sites are shared between calls
+    # so those components stay serial
+    pool = None
+    if threads > 1 and not sites_info and len(data["s_between"]) + len(data["s_within"]) >= 4:
+        pool = thread_pool(threads)
+    calls = []
     # u and v are the part ids, d[0] and d[1] are the lists of nodes for those parts
     for (u, v), d in data["s_between"].items():
         rd_u = get_reads(bam, d[0], data["reads"], data["n2n"], add_to_buffer, info)   # [(Nodeinfo, alignment)..]
@@ -1646,24 +2086,14 @@ cdef list multi(data, bam, int insert_size, int insert_stdev, float insert_ppf,
         # finds reads that should be a single partition
         u_reads, v_reads, u_single, v_single = filter_single_partitions(rd_u, rd_v)
         if len(u_reads) > 0 and len(v_reads) > 0:
-            events += one_edge(rd_u, rd_v, clip_length, insert_size, insert_stdev, insert_ppf, min_support, 1, assemble_contigs,
-                               sites_info, paired_end)
+            add_calls(calls, pool, edge_calls, (rd_u, rd_v, clip_length, insert_size, insert_stdev, insert_ppf, min_support,
+                                                assemble_contigs, sites_info, paired_end))
         if u_single:
-            res = single(u_single, insert_size, insert_stdev, insert_ppf, clip_length, min_support, assemble_contigs,
-                         sites_info, paired_end, length_extend, divergence)
-            if res:
-                if isinstance(res, EventResult):
-                    events.append(res)
-                else:
-                    events += res
+            add_calls(calls, pool, single_calls, (u_single, insert_size, insert_stdev, insert_ppf, clip_length, min_support,
+                                                  assemble_contigs, sites_info, paired_end, length_extend, divergence))
         if v_single:
-            res = single(v_single, insert_size, insert_stdev, insert_ppf, clip_length, min_support, assemble_contigs,
-                         sites_info, paired_end, length_extend, divergence)
-            if res:
-                if isinstance(res, EventResult):
-                    events.append(res)
-                else:
-                    events += res
+            add_calls(calls, pool, single_calls, (v_single, insert_size, insert_stdev, insert_ppf, clip_length, min_support,
+                                                  assemble_contigs, sites_info, paired_end, length_extend, divergence))
 
     # Process any singles / unconnected blocks
     if seen:
@@ -1675,13 +2105,8 @@ cdef list multi(data, bam, int insert_size, int insert_stdev, float insert_ppf,
                 rds = get_reads(bam, d, data["reads"], data["n2n"], 0, info)
                 if len(rds) < lower_bound_support or (len(sites_info) != 0 and len(rds) == 0):
                     continue
-                res = single(rds, insert_size, insert_stdev, insert_ppf, clip_length, min_support, assemble_contigs,
-                             sites_info, paired_end, length_extend, divergence)
-                if res:
-                    if isinstance(res, EventResult):
-                        events.append(res)
-                    else:
-                        events += res
+                add_calls(calls, pool, single_calls, (rds, insert_size, insert_stdev, insert_ppf, clip_length, min_support,
+                                                      assemble_contigs, sites_info, paired_end, length_extend, divergence))
 
     # Check for events within clustered nodes
     for k, d in data["s_within"].items():
@@ -1693,18 +2118,16 @@ cdef list multi(data, bam, int insert_size, int insert_stdev, float insert_ppf,
             rds = get_reads(bam, d, data["reads"], data["n2n"], 0, info)
             if len(rds) < lower_bound_support or (len(sites_info) != 0 and len(rds) == 0):
                     continue
-            res = single(rds, insert_size, insert_stdev, insert_ppf, clip_length, min_support, assemble_contigs,
-                         sites_info, paired_end, length_extend, divergence)
-            if res:
-                if isinstance(res, EventResult):
-                    events.append(res)
-                else:
-                    events += res
+            add_calls(calls, pool, single_calls, (rds, insert_size, insert_stdev, insert_ppf, clip_length, min_support,
+                                                  assemble_contigs, sites_info, paired_end, length_extend, divergence))
+    for c in calls:
+        events += c if pool is None else c.result()
     return events
 
 
 cpdef list call_from_block_model(bam, data, clip_length, insert_size, insert_stdev, insert_ppf, min_support, lower_bound_support,
-                                 assemble_contigs, max_single_size, sites_index, bint paired_end, int length_extend, float divergence):
+                                 assemble_contigs, max_single_size, sites_index, bint paired_end, int length_extend, float divergence,
+                                 int threads=1):
     n_parts = len(data["parts"])
     events = []
     if "info" in data:
@@ -1715,7 +2138,7 @@ cpdef list call_from_block_model(bam, data, clip_length, insert_size, insert_std
     cdef EventResult_t e
     if n_parts >= 1:
         events += multi(data, bam, insert_size, insert_stdev, insert_ppf, clip_length, min_support, lower_bound_support,
-                        assemble_contigs, max_single_size, info, paired_end, length_extend, divergence)
+                        assemble_contigs, max_single_size, info, paired_end, length_extend, divergence, threads)
     elif n_parts == 0:
         if len(data["n2n"]) > max_single_size:
             return []
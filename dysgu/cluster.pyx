@@ -13,7 +13,7 @@ from sys import stdout
 import pandas as pd
 from dysgu import coverage, graph, call_component, assembler, io_funcs, re_map, post_call
 from dysgu.map_set_utils cimport is_reciprocal_overlapping, EventResult, Py_SimpleGraph
-from dysgu.map_set_utils import to_dict, merge_intervals, echo
+from dysgu.map_set_utils import merge_intervals, echo, events_to_columns, events_from_columns, events_to_frame
 from dysgu import sites_utils
 from dysgu.io_funcs import intersecter
 import pickle
@@ -22,7 +22,10 @@ import itertools
 import multiprocessing
 from scipy import stats
 from libcpp.vector cimport vector
+from libc.stdint cimport int64_t
 import time
+import queue
+import traceback
 
 ctypedef EventResult EventResult_t
 
@@ -500,122 +503,15 @@ def sample_level_density(potential, regions, max_dist=50):
     return potential
 
 
-cdef bint same_k(int start1, int start2, int n, const unsigned char[:] seq):
-    cdef int j
-    for j in range(n):
-        if seq[start1 + j] != seq[start2 + j]:
-            return False
-    return True
-
-
-cdef dict search_ssr_kc(ori):
-    seq = ori.upper()
-    cdef const unsigned char[:] string_view = bytes(seq.encode("ascii"))  # use for indexing
-    cdef int str_len = len(seq)
-    cdef int rep_len = min(7, str_len)
-    cdef int i = 0
-    cdef int t, start, count, mm, good_i, successive_bad, size, finish
-    cdef int n_ref_repeat_bases = 0
-    cdef int n_expansion = 0
-    cdef int stride = 0
-    expansion_seq = ""
-    cdef unsigned char starting_base
-    while i < str_len:
-        if seq[i] == b"N":
-            i += 1
-            continue
-        for t in range(1, rep_len):
-            start = i
-            if start + t >= str_len:
-                break
-            starting_base = string_view[i]
-            starting_kmer_idx = start
-            count = 1
-            mm = 0
-            good_i = 0
-            successive_bad = 0
-            finish = 0
-            while start + t < str_len and (starting_base == string_view[start+t] or mm < 2):
-                start += t
-                if start + t + 1 > str_len:
-                    break
-                if not same_k(start, starting_kmer_idx, t, string_view):
-                    successive_bad += 1
-                    mm += 1
-                    if mm > 3 or successive_bad > 1 or count < 2:
-                        finish = good_i
-                        break
-                else:
-                    good_i = start
-                    finish = good_i
-                    successive_bad = 0
-                    count += 1
-            if count >= 3 and (finish - i) + t > 10:
-                # check for lowercase to uppercase transition; determines repeat expansion length
-                lowercase = []
-                uppercase = []
-                expansion_index = -1
-                for j in range(i, finish, t):
-                    if ori[j].islower():
-                        if not lowercase:  # finds first block of repeats
-                            lowercase.append([j, j + t])
-                            if uppercase and abs(uppercase[-1][1] - j) < 3:
-                                expansion_index = 0
-                        elif lowercase[-1][1] == j:
-                            lowercase[-1][1] += t
-                    else:  # finds all reference blocks
-                        if not uppercase:  # finds first block of repeats
-                            uppercase.append([j, j + t])
-                            if lowercase and abs(lowercase[-1][1] - j) < 3:
-                                expansion_index = len(lowercase) - 1
-                        elif uppercase[-1][1] == j:
-                            uppercase[-1][1] += t
-                        else:
-                            uppercase.append([j, j + t])
-                if expansion_index != -1:
-                    e = lowercase[expansion_index]
-                    size = e[1] - e[0]
-                    if size >= 10:
-                        n_expansion = size
-                        expansion_seq = ori[e[0]:e[1]]
-                        stride = t
-                for begin, end in uppercase:
-                    n_ref_repeat_bases += end - begin
-                i = finish + t
-        i += 1
-    return {"n_expansion": n_expansion, "stride": stride, "exp_seq": expansion_seq, "ref_poly_bases": n_ref_repeat_bases}
-
-
-def find_repeat_expansions(events, insert_stdev):
-    cdef EventResult_t e
-    for e in events:
-        e.n_expansion = 0
-        e.stride = 0
-        e.exp_seq = ""
-        e.ref_poly_bases = 0
-        if e.contig:
-            r = search_ssr_kc(e.contig)
-            e.n_expansion = r["n_expansion"]
-            e.stride = r["stride"]
-            e.exp_seq = r["exp_seq"]
-            e.ref_poly_bases += r["ref_poly_bases"]
-        if e.contig2:
-            r = search_ssr_kc(e.contig2)
-            if e.n_expansion < r["n_expansion"]:
-                e.n_expansion = r["n_expansion"]
-                e.stride = r["stride"]
-                e.exp_seq = r["exp_seq"]
-                e.ref_poly_bases += r["ref_poly_bases"]
-    return events
-
-
 def component_job(infile, component, regions, event_id, clip_length, insert_med, insert_stdev, insert_ppf, min_supp, lower_bound_support,
                   merge_dist, regions_only, assemble_contigs, rel_diffs, diffs, min_size, max_single_size,
-                  sites_index, paired_end, length_extend, divergence):
+                  sites_index, paired_end, length_extend, divergence, block_reader=None, threads=1):
+    # block_reader from call_component.make_block_reader is used to fetch reads when given, see get_reads.
+    # threads > 1 lets large components be called with a thread pool, see call_component.multi
     potential_events = []
     grp_id = event_id
     cdef EventResult_t event
-    for event in call_component.call_from_block_model(infile,
+    for event in call_component.call_from_block_model(infile if block_reader is None else block_reader,
                                                       component,
                                                       clip_length,
                                                       insert_med,
@@ -628,7 +524,8 @@ def component_job(infile, component, regions, event_id, clip_length, insert_med,
                                                       sites_index,
                                                       paired_end,
                                                       length_extend,
-                                                      divergence):
+                                                      divergence,
+                                                      threads):
         if event:
             event.grp_id = grp_id
             event.event_id = event_id
@@ -644,64 +541,335 @@ def component_job(infile, component, regions, event_id, clip_length, insert_med,
     return potential_events, event_id
 
 
-def process_job(msg_queue, args):
-    job_path, infile_path, bam_mode, ref_path, regions_path, clip_length, insert_median, insert_stdev, insert_ppf, min_support, \
-    lower_bound_support, merge_dist, regions_only, assemble_contigs, rel_diffs, diffs, min_size,\
+RING_BYTES = 32 * 1024 * 1024  # component ring size per worker
+
+
+class ComponentRing:
+    """Memory-mapped ring buffer in the working directory, used to hand encoded components to worker processes.
+    Each block starts with a (state, length) header; a worker sets state to 0 once the component is called,
+    and the parent reclaims free blocks from the tail before writing new ones"""
+    header_bytes = 16
+    def __init__(self, path, size=None):
+        self.path = path
+        if size is None:  # worker side, attach to existing ring
+            self.buf = np.memmap(path, dtype=np.uint8, mode="r+")
+        else:
+            self.buf = np.memmap(path, dtype=np.uint8, mode="w+", shape=(size,))
+        self.words = self.buf.view(np.int64)
+        self.size = len(self.buf)
+        self.head = 0
+        self.tail = 0
+
+    def _reclaim(self):
+        cdef long pos
+        while self.tail < self.head:
+            pos = (self.tail % self.size) // 8
+            if self.words[pos] != 0:
+                break
+            self.tail += int(self.words[pos + 1])
+
+    def put(self, data):
+        # Returns the (offset, length) of the written block, or None if there is not enough free space
+        cdef long n = len(data)
+        cdef long need = (n + self.header_bytes + 63) & ~63
+        cdef long pos, pad
+        if need > self.size:
+            return None
+        self._reclaim()
+        pos = self.head % self.size
+        pad = self.size - pos if pos + need > self.size else 0
+        if self.head + pad + need - self.tail > self.size:
+            return None
+        if pad:  # mark the unused end of the ring as a free block and wrap
+            self.words[pos // 8 + 1] = pad
+            self.words[pos // 8] = 0
+            self.head += pad
+            pos = 0
+        self.buf[pos + self.header_bytes: pos + self.header_bytes + n] = data
+        self.words[pos // 8 + 1] = need
+        self.words[pos // 8] = 1
+        self.head += need
+        return pos, n
+
+    def get(self, offset, length):
+        return np.asarray(self.buf[offset + self.header_bytes: offset + self.header_bytes + length])
+
+    def release(self, offset):
+        self.words[offset // 8] = 0
+
+    def close(self, remove=False):
+        self.words = None
+        self.buf = None
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# Prior seconds per unit of each graph.component_features column, refined from observed call times
+COST_PRIOR = np.array([2e-3, 1e-4, 2e-4, 5e-4, 5e-2, 1e-3, 1e-4, 1e-4])
+
+
+class ComponentScheduler:
+    """Hands components to calling workers through a shared work queue, so an idle worker always takes the next
+    component. Components wait in a pending heap ordered by estimated cost, and the most expensive are released
+    first to avoid stragglers at the end of the run. The cost model is a ridge fit of observed call times against
+    graph.component_features, shrunk towards COST_PRIOR. Called events are streamed back from the workers in
+    columnar batches and decoded as they arrive. Queues are polled with a timeout and the worker processes are
+    checked between polls, so a worker that fails or is killed raises an error instead of stalling the run"""
+    def __init__(self, procs, ring, work_queue, feedback_queue, results_queue, workers, max_pending=None,
+                 max_pending_bytes=256 * 1024 * 1024):
+        self.procs = procs
+        self.workers = workers
+        self.ring = ring
+        self.work_queue = work_queue
+        self.feedback_queue = feedback_queue
+        self.results_queue = results_queue
+        self.results = {}
+        self.workers_done = set()
+        self.depth = 2 * procs  # components released to the work queue but not finished
+        self.max_pending = max_pending if max_pending is not None else 64 * procs
+        self.max_pending_bytes = max_pending_bytes
+        self.pending = []
+        self.pending_bytes = 0
+        self.in_flight = {}
+        self.seq = 0
+        self.weights = COST_PRIOR.copy()
+        self.ridge = 10.
+        self.xtx = np.zeros((len(COST_PRIOR), len(COST_PRIOR)))
+        self.xty = np.zeros(len(COST_PRIOR))
+        self.n_obs = 0
+        self.busy = [0.] * procs
+        self.n_done = [0] * procs
+        self.t0 = time.time()
+
+    def estimate(self, features):
+        return float(np.dot(self.weights, features))
+
+    def observe(self, features, seconds):
+        self.xtx += np.outer(features, features)
+        self.xty += features * seconds
+        self.n_obs += 1
+        if self.n_obs % 64 == 0:
+            w = np.linalg.solve(self.xtx + self.ridge * np.eye(len(self.weights)), self.xty + self.ridge * COST_PRIOR)
+            self.weights = np.clip(w, 0, None)
+
+    def submit(self, buf, features):
+        heapq.heappush(self.pending, (-self.estimate(features), self.seq, buf, features))
+        self.pending_bytes += len(buf)
+        self.seq += 1
+        self._poll(False)
+        self._dispatch()
+        while len(self.pending) > self.max_pending or self.pending_bytes > self.max_pending_bytes:
+            self._poll(True)
+            self._dispatch()
+        self._collect(False)
+
+    def _dispatch(self):
+        while self.pending and len(self.in_flight) < self.depth:
+            _, seq, buf, features = heapq.heappop(self.pending)
+            self.pending_bytes -= len(buf)
+            block = self.ring.put(buf)
+            self.work_queue.put((seq, block if block is not None else buf))
+            self.in_flight[seq] = features
+
+    def _check_workers(self):
+        for w_idx, p in enumerate(self.workers):
+            if w_idx not in self.workers_done and not p.is_alive() and p.exitcode != 0:
+                msg = f"Calling worker {w_idx} exited with code {p.exitcode}"
+                while not self.feedback_queue.empty():
+                    w, seq, tb = self.feedback_queue.get()
+                    if seq is None:
+                        msg = f"Calling worker {w} failed:\n{tb}"
+                        break
+                raise RuntimeError(msg)
+
+    def _get(self, q):
+        # Blocking get that checks worker health while waiting. A worker that exited cleanly without sending all
+        # of its results is an error once its queue data has been drained
+        while True:
+            try:
+                return q.get(timeout=WORKER_POLL_SECONDS)
+            except queue.Empty:
+                self._check_workers()
+                if any(not p.is_alive() for w_idx, p in enumerate(self.workers) if w_idx not in self.workers_done):
+                    try:
+                        return q.get(timeout=WORKER_POLL_SECONDS)
+                    except queue.Empty:
+                        raise RuntimeError("A calling worker exited before sending all of its results")
+
+    def _poll(self, block):
+        while self.in_flight:
+            if block:
+                msg = self._get(self.feedback_queue)
+                block = False
+            elif not self.feedback_queue.empty():
+                msg = self.feedback_queue.get()
+            else:
+                break
+            w_idx, seq, seconds = msg
+            if seq is None:  # the worker sent its traceback
+                raise RuntimeError(f"Calling worker {w_idx} failed:\n{seconds}")
+            self.busy[w_idx] += seconds
+            self.n_done[w_idx] += 1
+            self.observe(self.in_flight.pop(seq), seconds)
+
+    def _collect(self, block):
+        # Decode result batches, a batch of (None, w_idx) means that worker has sent all of its results
+        while len(self.workers_done) < self.procs:
+            if not block and self.results_queue.empty():
+                break
+            counts, cols = self._get(self.results_queue) if block else self.results_queue.get()
+            if counts is None:
+                self.workers_done.add(cols)
+                continue
+            events = events_from_columns(cols)
+            start = 0
+            for seq, n in counts:
+                self.results[seq] = events[start: start + n]
+                start += n
+
+    def finish(self):
+        # Returns the called events of each component, in submission order
+        while self.pending or self.in_flight:
+            self._dispatch()
+            self._poll(True)
+            self._collect(False)
+        for _ in range(self.procs):
+            self.work_queue.put(None)
+        self._collect(True)
+        wall = max(time.time() - self.t0, 1e-6)
+        for w_idx in range(self.procs):
+            logging.info(f"Calling worker {w_idx}: components {self.n_done[w_idx]}, busy {round(self.busy[w_idx], 1)}s, "
+                         f"utilisation {round(100 * self.busy[w_idx] / wall, 1)}%")
+        return [self.results[seq] for seq in sorted(self.results)]
+
+
+RESULT_BATCH = 512  # events per batch sent back from a calling worker
+WORKER_POLL_SECONDS = 5  # queue timeout between checks that the calling workers are alive
+
+
+def process_job(work_queue, feedback_queue, results_queue, w_idx, args):
+    # Errors are sent back on the feedback queue as a traceback, the worker then exits with a non-zero code
+    try:
+        call_components(work_queue, feedback_queue, results_queue, w_idx, args)
+    except BaseException:
+        feedback_queue.put((w_idx, None, traceback.format_exc()))
+        feedback_queue.close()
+        feedback_queue.join_thread()
+        raise
+
+
+def call_components(work_queue, feedback_queue, results_queue, w_idx, args):
+    ring_path, arena_path, read_threads, component_threads, infile_path, bam_mode, ref_path, regions_path, clip_length, insert_median, insert_stdev, insert_ppf, \
+    min_support, lower_bound_support, merge_dist, regions_only, assemble_contigs, rel_diffs, diffs, min_size,\
         max_single_size, sites_index, paired_end, length_extend, divergence = args
     regions = io_funcs.overlap_regions(regions_path)
-    completed_file = open(job_path[:-3] + "done.pkl", "wb")
+    ring = ComponentRing(ring_path)
+    batch_counts = []
+    batch = []
     pysam.set_verbosity(0)
-    infile = pysam.AlignmentFile(infile_path, bam_mode, threads=1, reference_filename=None if bam_mode != "rc" else ref_path)
+    infile = pysam.AlignmentFile(infile_path, bam_mode, threads=read_threads, reference_filename=None if bam_mode != "rc" else ref_path)
     pysam.set_verbosity(3)
-    event_id = 0
+    read_arena = graph.ReadArena(arena_path, infile.header) if arena_path else None
+    block_reader = call_component.make_block_reader(infile)
     while 1:
-        msg = msg_queue.recv()
-        if msg == 0:
+        msg = work_queue.get()
+        if msg is None:
             break
-        res = msg
-        event_id += 1
-        potential_events, event_id = component_job(infile, res, regions, event_id, clip_length,
-                                                   insert_median,
-                                                   insert_stdev,
-                                                   insert_ppf,
-                                                   min_support,
-                                                   lower_bound_support,
-                                                   merge_dist,
-                                                   regions_only,
-                                                   assemble_contigs,
-                                                   rel_diffs=rel_diffs, diffs=diffs, min_size=min_size,
-                                                   max_single_size=max_single_size, sites_index=sites_index,
-                                                   paired_end=paired_end, length_extend=length_extend, divergence=divergence)
+        t0 = time.perf_counter()
+        seq, payload = msg
+        block = None
+        if isinstance(payload, tuple):
+            block = payload[0]
+            res = graph.decode_component(ring.get(*payload), read_arena)
+        else:
+            res = graph.decode_component(payload, read_arena)
+        np.random.seed(seq % 4294967296)  # seeded as in the single process loop, so results do not depend on procs
+        potential_events, _ = component_job(infile, res, regions, 1, clip_length,
+                                            insert_median,
+                                            insert_stdev,
+                                            insert_ppf,
+                                            min_support,
+                                            lower_bound_support,
+                                            merge_dist,
+                                            regions_only,
+                                            assemble_contigs,
+                                            rel_diffs=rel_diffs, diffs=diffs, min_size=min_size,
+                                            max_single_size=max_single_size, sites_index=sites_index,
+                                            paired_end=paired_end, length_extend=length_extend, divergence=divergence,
+                                            block_reader=block_reader, threads=component_threads)
+        res = None
+        if block is not None:
+            ring.release(block)
         if potential_events:
-            for res in potential_events:
-                pickle.dump(res, completed_file)
-    completed_file.close()
-
-
-# def postcall_job(preliminaries, aux_data):
-#     mode, ref_path, no_gt, insert_stdev, paired_end, drop_gaps = aux_data
-#     ref_genome = pysam.FastaFile(ref_path)
-#     preliminaries = re_map.drop_svs_near_reference_gaps(preliminaries, paired_end, ref_genome, drop_gaps)
-#     preliminaries = post_call.ref_repetitiveness(preliminaries, ref_genome)
-#     preliminaries = post_call.strand_binom_t(preliminaries)
-#     preliminaries = assembler.contig_info(preliminaries)  # GC info, repetitiveness
-#     preliminaries = find_repeat_expansions(preliminaries, insert_stdev)
-#     preliminaries = post_call.compressability(preliminaries)
-#     preliminaries = post_call.get_gt_metric2(preliminaries, mode, no_gt)
-#     preliminaries = post_call.get_ref_base(preliminaries, ref_genome)
-#     return preliminaries
-
-
-# https://rvprasad.medium.com/data-and-chunk-sizes-matter-when-using-multiprocessing-pool-map-in-python-5023c96875ef
-# aux_data = None
-#
-# def initializer(init_data):
-#     global aux_data
-#     aux_data = init_data
-
-
-# def with_initializer_worker_wrapper(varying_data):
-#     return postcall_job(varying_data, aux_data)
+            batch_counts.append((seq, len(potential_events)))
+            batch += potential_events
+            if len(batch) >= RESULT_BATCH:
+                results_queue.put((batch_counts, events_to_columns(batch)))
+                batch_counts = []
+                batch = []
+        feedback_queue.put((w_idx, seq, time.perf_counter() - t0))
+    if batch:
+        results_queue.put((batch_counts, events_to_columns(batch)))
+    results_queue.put((None, w_idx))
+    ring.close()
+    if read_arena is not None:
+        read_arena.close()
+    if block_reader is not None:
+        block_reader.close()
+
+
+POSTCALL_MIN_EVENTS = 2000  # below this the post-call stages run in-process
+POSTCALL_PREFETCH_PAD = 250  # reference windows of the post-call stages closer than this are fetched together
+
+
+def postcall_stages(preliminaries, ref_genome, mode, no_gt, symbolic_sv_size, threads=1):
+    ref_genome.prefetch(post_call.reference_spans(preliminaries, symbolic_sv_size), pad=POSTCALL_PREFETCH_PAD)
+    preliminaries = post_call.ref_repetitiveness(preliminaries, ref_genome)
+    preliminaries = post_call.strand_binom_t(preliminaries)
+    preliminaries = assembler.contig_features(preliminaries, threads)  # GC, repetitiveness, expansions, compressibility
+    preliminaries = post_call.get_gt_metric2(preliminaries, mode, no_gt)
+    preliminaries = post_call.get_ref_base(preliminaries, ref_genome, symbolic_sv_size)
+    return preliminaries
+
+
+def postcall_job(job):
+    # each worker opens its own reference handle, events are sent both ways as columns
+    cols, ref_path, mode, no_gt, symbolic_sv_size = job
+    fasta = pysam.FastaFile(ref_path)
+    events = events_from_columns(cols)
+    ref_genome = io_funcs.ReferenceCache(fasta)
+    events = postcall_stages(events, ref_genome, mode, no_gt, symbolic_sv_size)
+    fasta.close()
+    return events_to_columns(events)
+
+
+def postcall_chunks(preliminaries, int procs):
+    """Index lists partitioning events by chromosome, large chromosomes are split so no chunk holds more than
+    1/procs of all events"""
+    by_chrom = defaultdict(list)
+    for i, e in enumerate(preliminaries):
+        by_chrom[e.chrA].append(i)
+    cdef int size = max(1, (len(preliminaries) + procs - 1) // procs)
+    chunks = []
+    for idxs in by_chrom.values():
+        for start in range(0, len(idxs), size):
+            chunks.append(idxs[start:start + size])
+    chunks.sort(key=len, reverse=True)
+    return chunks
+
+
+def postcall_features(preliminaries, ref_genome, args, int procs):
+    if procs <= 1 or len(preliminaries) < POSTCALL_MIN_EVENTS:
+        return postcall_stages(preliminaries, ref_genome, args["mode"], args["no_gt"], args["symbolic_sv_size"], procs)
+    chunks = postcall_chunks(preliminaries, procs)
+    jobs = [(events_to_columns([preliminaries[i] for i in idxs]), args["reference"], args["mode"], args["no_gt"],
+             args["symbolic_sv_size"]) for idxs in chunks]
+    ordered = [None] * len(preliminaries)
+    with multiprocessing.Pool(min(procs, len(jobs))) as pool:
+        for idxs, cols in zip(chunks, pool.imap(postcall_job, jobs)):
+            for i, e in zip(idxs, events_from_columns(cols)):
+                ordered[i] = e
+    return ordered
 
 
 def pipe1(args, infile, kind, regions, ibam, ref_genome, sample_name, bam_iter=None):
@@ -843,11 +1011,24 @@ def pipe1(args, infile, kind, regions, ibam, ref_genome, sample_name, bam_iter=N
     component_path = f"{tdir}/components.bin"
     cdef bytes cmp_file = component_path.encode("ascii")  # write components to file if low-mem used
     cdef vector[int] cmp
-    G.connectedComponents(cmp_file, low_mem, cmp)
-    cdef int length_components = cmp.size()
+    cdef vector[int64_t] cmp_offsets
+    G.connectedComponents(cmp_file, low_mem, cmp, cmp_offsets)
+    # component i is nodes[offsets[i]:offsets[i + 1]], slices are views so no copy is made per component
+    cdef const int64_t[::1] offsets
     if low_mem:
-        cmp_mmap = np.memmap(component_path, dtype=np.int32, mode='r')
-        length_components = len(cmp_mmap)
+        if os.path.getsize(component_path):
+            nodes_arr = np.memmap(component_path, dtype=np.int32, mode='r')
+        else:
+            nodes_arr = np.zeros(0, dtype=np.int32)
+        offsets_arr = np.memmap(component_path + ".offsets", dtype=np.int64, mode='r')
+    else:
+        if cmp.size():
+            nodes_arr = np.asarray(<int[:cmp.size()]> cmp.data())
+        else:
+            nodes_arr = np.zeros(0, dtype=np.int32)
+        offsets_arr = np.asarray(<int64_t[:cmp_offsets.size()]> cmp_offsets.data())
+    offsets = offsets_arr
+    cdef int n_components = offsets.shape[0] - 1
     if insert_median != -1:
         insert_ppf = stats.norm.ppf(0.05, loc=insert_median, scale=insert_stdev)
         if insert_ppf < 0:
@@ -860,153 +1041,156 @@ def pipe1(args, infile, kind, regions, ibam, ref_genome, sample_name, bam_iter=N
     else:
         rel_diffs = True
         diffs = 0.15
-    write_index = None
-    minhq = None
     consumers = []
-    msg_queues = []
+    scheduler = None
     if procs > 1:
-        write_index = itertools.cycle(range(procs))
-        minhq = [(0, i) for i in range(procs)]
-        msg_queues = [multiprocessing.Pipe(duplex=False) for _ in range(procs)]
+        # Buffered reads are handed to the workers through a memory-mapped arena instead of the component buffers
+        arena_path = f"{tdir}/reads.arena"
+        if not graph.write_read_arena(arena_path, read_buffer):
+            arena_path = None
+        read_buffer.clear()
+        ring = ComponentRing(f"{tdir}/components.ring", RING_BYTES * procs)
+        work_queue = multiprocessing.Queue()
+        feedback_queue = multiprocessing.Queue()
+        results_queue = multiprocessing.Queue()
+        scheduler = ComponentScheduler(procs, ring, work_queue, feedback_queue, results_queue, consumers)
         for n in range(procs):
-            job_path = f"{tdir}/job_{n}.pkl"
-            proc_args = ( job_path, args["sv_aligns"], args["bam_mode"], args["reference"], args["regions"], clip_length, insert_median, insert_stdev,
-                insert_ppf, min_support, lower_bound_support, merge_dist, regions_only, assemble_contigs,
+            proc_args = ( ring.path, arena_path, args.get("read_threads", 1), args.get("component_threads", 1), args["sv_aligns"], args["bam_mode"], args["reference"], args["regions"], clip_length,
+                insert_median, insert_stdev, insert_ppf, min_support, lower_bound_support, merge_dist, regions_only, assemble_contigs,
                 rel_diffs, diffs, min_size, max_single_size, sites_index, paired_end, length_extend, divergence )
-            p = multiprocessing.Process(target=process_job, args=(msg_queues[n][0], proc_args,), daemon=True)
+            p = multiprocessing.Process(target=process_job, args=(work_queue, feedback_queue, results_queue, n, proc_args,),
+                                        daemon=True)
             p.start()
             consumers.append(p)
 
     num_jobs = 0
     completed = 0
     components_seen = 0
+    component_seq = 0
     if procs == 1 and low_mem:
         completed_file = open(f"{tdir}/job_0.done.pkl", "wb")
     else:
         completed_file = None
-    cdef int last_i = 0
-    cdef int start_i, end_i, ci, cmp_idx, item_index, item  # cmp is a flat array of indexes. item == -1 signifies end of component
-    for item_idx in range(length_components):
-        if low_mem:
-            item = cmp_mmap[item_idx]
+    block_reader = call_component.make_block_reader(infile) if procs == 1 else None
+    cdef int cmp_i
+    for cmp_i in range(n_components):
+        components_seen += 1
+        component = nodes_arr[offsets[cmp_i]:offsets[cmp_i + 1]]
+        if len(component) > 100_000:
+            reduced = graph.break_large_component(G, component, min_support)
+            for cmp2 in reduced:
+                res = graph.proc_component(node_to_name, np.fromiter(cmp2, dtype=np.int32, count=len(cmp2)), read_buffer,
+                                           infile, G, lower_bound_support, procs, paired_end, sites_index)
+                if not res:
+                    continue
+                event_id += 1
+                if procs == 1:
+                    np.random.seed(component_seq % 4294967296)  # seeded by component as in the calling workers
+                    potential_events, event_id = component_job(infile, res, regions, event_id, clip_length,
+                                                               insert_median,
+                                                               insert_stdev,
+                                                               insert_ppf,
+                                                               min_support,
+                                                               lower_bound_support,
+                                                               merge_dist,
+                                                               regions_only,
+                                                               assemble_contigs,
+                                                               rel_diffs=rel_diffs, diffs=diffs,
+                                                               min_size=min_size,
+                                                               max_single_size=max_single_size,
+                                                               sites_index=sites_index,
+                                                               paired_end=paired_end,
+                                                               length_extend=length_extend,
+                                                               divergence=divergence,
+                                                               block_reader=block_reader,
+                                                               threads=args.get("component_threads", 1))
+                    if potential_events:
+                        if not low_mem:
+                            block_edge_events += potential_events
+                        else:
+                            pickle.dump((components_seen, potential_events), completed_file)
+                else:
+                    scheduler.submit(graph.encode_component(res, node_to_name), graph.component_features(res, node_to_name))
+                component_seq += 1
         else:
-            item = cmp[item_idx]
-        if item == -1:
-            components_seen += 1
-            start_i = last_i
-            end_i = item_idx
-            last_i = item_idx + 1
-            component = np.zeros(end_i - start_i)
-            ci = 0
-            for cmp_idx in range(start_i, end_i):
-                if low_mem:
-                    component[ci] = cmp_mmap[cmp_idx]
+            # most partitions processed here, dict returned, or None
+            res = graph.proc_component(node_to_name, component, read_buffer, infile, G, lower_bound_support,
+                                       procs, paired_end, sites_index)
+            if res:
+                event_id += 1
+                # Res is a dict {"parts": partitions, "s_between": sb, "reads": reads, "s_within": support_within, "n2n": n2n}
+                if procs == 1:
+                    np.random.seed(component_seq % 4294967296)  # seeded by component as in the calling workers
+                    potential_events, event_id = component_job(infile, res, regions, event_id, clip_length,
+                                                               insert_median,
+                                                               insert_stdev,
+                                                               insert_ppf,
+                                                               min_support,
+                                                               lower_bound_support,
+                                                               merge_dist,
+                                                               regions_only,
+                                                               assemble_contigs,
+                                                               rel_diffs=rel_diffs, diffs=diffs, min_size=min_size,
+                                                               max_single_size=max_single_size,
+                                                               sites_index=sites_index,
+                                                               paired_end=paired_end,
+                                                               length_extend=length_extend, divergence=divergence,
+                                                               block_reader=block_reader,
+                                                               threads=args.get("component_threads", 1))
+                    if potential_events:
+                        if not low_mem:
+                            block_edge_events += potential_events
+                        else:
+                            pickle.dump((components_seen, potential_events), completed_file)
                 else:
-                    component[ci] = cmp[cmp_idx]
-                ci += 1
-            if len(component) > 100_000:
-                reduced = graph.break_large_component(G, component, min_support)
-                for cmp2 in reduced:
-                    res = graph.proc_component(node_to_name, cmp2, read_buffer, infile, G, lower_bound_support,
-                                               procs, paired_end, sites_index)
-                    if not res:
-                        continue
-                    event_id += 1
-                    if procs == 1:
-                        potential_events, event_id = component_job(infile, res, regions, event_id, clip_length,
-                                                                   insert_median,
-                                                                   insert_stdev,
-                                                                   insert_ppf,
-                                                                   min_support,
-                                                                   lower_bound_support,
-                                                                   merge_dist,
-                                                                   regions_only,
-                                                                   assemble_contigs,
-                                                                   rel_diffs=rel_diffs, diffs=diffs,
-                                                                   min_size=min_size,
-                                                                   max_single_size=max_single_size,
-                                                                   sites_index=sites_index,
-                                                                   paired_end=paired_end,
-                                                                   length_extend=length_extend,
-                                                                   divergence=divergence)
-                        if potential_events:
-                            if not low_mem:
-                                block_edge_events += potential_events
-                            else:
-                                for res in potential_events:
-                                    pickle.dump(res, completed_file)
-                    else:
-                        j_submitted, w_idx = heapq.heappop(minhq)
-                        heapq.heappush(minhq, (j_submitted + len(res["n2n"]), w_idx))
-                        msg_queues[w_idx][1].send(res)
-            else:
-                # most partitions processed here, dict returned, or None
-                res = graph.proc_component(node_to_name, component, read_buffer, infile, G, lower_bound_support,
-                                           procs, paired_end, sites_index)
-                if res:
-                    event_id += 1
-                    # Res is a dict {"parts": partitions, "s_between": sb, "reads": reads, "s_within": support_within, "n2n": n2n}
-                    if procs == 1:
-                        potential_events, event_id = component_job(infile, res, regions, event_id, clip_length,
-                                                                   insert_median,
-                                                                   insert_stdev,
-                                                                   insert_ppf,
-                                                                   min_support,
-                                                                   lower_bound_support,
-                                                                   merge_dist,
-                                                                   regions_only,
-                                                                   assemble_contigs,
-                                                                   rel_diffs=rel_diffs, diffs=diffs, min_size=min_size,
-                                                                   max_single_size=max_single_size,
-                                                                   sites_index=sites_index,
-                                                                   paired_end=paired_end,
-                                                                   length_extend=length_extend, divergence=divergence)
-                        if potential_events:
-                            if not low_mem:
-                                block_edge_events += potential_events
-                            else:
-                                for res in potential_events:
-                                    pickle.dump(res, completed_file)
-                    else:
-                        j_submitted, w_idx = heapq.heappop(minhq)
-                        heapq.heappush(minhq, (j_submitted + len(res["n2n"]), w_idx))
-                        msg_queues[w_idx][1].send(res)
+                    scheduler.submit(graph.encode_component(res, node_to_name), graph.component_features(res, node_to_name))
+                component_seq += 1
 
     if completed_file is not None:
         completed_file.close()
+    if block_reader is not None:
+        block_reader.close()
     del G
     del read_buffer
+    component = None
+    offsets = None
+    nodes_arr = None
+    offsets_arr = None
     cmp.clear()
+    cmp_offsets.clear()
     if low_mem:
         os.remove(component_path)
+        os.remove(component_path + ".offsets")
     gc.collect()
     # #
     if procs > 1 or low_mem:
-        for w in msg_queues:
-            w[1].send(0)
-        for n in consumers:
-            n.join()
-        event_id = 0
-        last_seen_grp_id = None
-        new_grp = None
-        for p in range(procs):
-            jf = open(f"{tdir}/job_{p}.done.pkl", "rb")
+        if scheduler is not None:
+            finished = scheduler.finish()
+            for n in consumers:
+                n.join()
+            scheduler.ring.close(remove=True)
+            if arena_path:
+                os.remove(arena_path)
+        else:
+            finished = []
+            jf = open(f"{tdir}/job_0.done.pkl", "rb")
             while 1:
                 try:
-                    res = pickle.load(jf)
-                    event_id += 1
-                    current_id = res.event_id
-                    current_grp = res.grp_id
-                    if last_seen_grp_id != current_grp:
-                        last_seen_grp_id = current_grp
-                        new_grp = event_id  # replace old grp id with new_grp (id of first in group)
-                    res.event_id = event_id
-                    res.grp_id = new_grp
-                    block_edge_events.append(res)
+                    finished.append(pickle.load(jf)[1])
                 except EOFError:
                     break
-            last_grp_id = event_id
-            os.remove(f"{tdir}/job_{p}.done.pkl")
+            jf.close()
+            os.remove(f"{tdir}/job_0.done.pkl")
+        # Components are renumbered in submission order, so ids do not depend on which worker called them
+        event_id = 0
+        for potential_events in finished:
+            new_grp = event_id + 1  # replace old grp id with new_grp (id of first in group)
+            for res in potential_events:
+                event_id += 1
+                res.event_id = event_id
+                res.grp_id = new_grp
+                block_edge_events.append(res)
+        finished = None
     if len(block_edge_events) == 0:
         return [], None
     logging.info("Number of components {}. N candidates {}".format(components_seen, len(block_edge_events)))
@@ -1014,10 +1198,12 @@ def pipe1(args, infile, kind, regions, ibam, ref_genome, sample_name, bam_iter=N
     if keeps:
         logging.info("Number of matching SVs from --sites {}".format(keeps))
     preliminaries = []
+    if not isinstance(ref_genome, io_funcs.ReferenceCache):
+        ref_genome = io_funcs.ReferenceCache(ref_genome)
     if args["remap"] == "True" and args["contigs"] == "True":
         block_edge_events = re_map.remap_soft_clips(block_edge_events, ref_genome,
                                                     keep_unmapped=True if args["pl"] == "pe" else False,
-                                                    min_support=min_support)
+                                                    min_support=min_support, procs=procs)
         logging.info("Re-alignment of soft-clips done. N candidates {}".format(len(block_edge_events)))
     # Merge across calls
     if args["merge_within"] == "True":
@@ -1080,24 +1266,9 @@ def pipe1(args, infile, kind, regions, ibam, ref_genome, sample_name, bam_iter=N
 
     preliminaries = post_call.get_badclip_metric(preliminaries, bad_clip_counter, infile, regions)
 
-    # if False:
-    #     aux_data = args["mode"], args["reference"], args["no_gt"], insert_stdev, paired_end, args["drop_gaps"] == "True"
-    #     pool = multiprocessing.Pool(procs, initializer, (aux_data,))
-    #     n = int(len(preliminaries) / procs)
-    #     preliminaries = [preliminaries[i:i + n] for i in range(0, len(preliminaries), n)]
-    #     preliminaries = pool.map(with_initializer_worker_wrapper, preliminaries)
-    #     preliminaries = [item for m in preliminaries for item in m]
-    #
-    # else:
-
-    preliminaries = re_map.drop_svs_near_reference_gaps(preliminaries, paired_end, ref_genome, args["drop_gaps"] == "True")
-    preliminaries = post_call.ref_repetitiveness(preliminaries, ref_genome)
-    preliminaries = post_call.strand_binom_t(preliminaries)
-    preliminaries = assembler.contig_info(preliminaries)  # GC info, repetitiveness
-    preliminaries = find_repeat_expansions(preliminaries, insert_stdev)
-    preliminaries = post_call.compressability(preliminaries)
-    preliminaries = post_call.get_gt_metric2(preliminaries, args["mode"], args["no_gt"])
-    preliminaries = post_call.get_ref_base(preliminaries, ref_genome, args["symbolic_sv_size"])
+    preliminaries = re_map.drop_svs_near_reference_gaps(preliminaries, paired_end, ref_genome, args["drop_gaps"] == "True",
+                                                        tdir)
+    preliminaries = postcall_features(preliminaries, ref_genome, args, procs)
 
     preliminaries = sample_level_density(preliminaries, regions)
     preliminaries = coverage_analyser.normalize_coverage_values(preliminaries)
@@ -1190,8 +1361,9 @@ def cluster_reads(args):
         logging.critical("No events found")
         return
 
-    df = pd.DataFrame.from_records([to_dict(e) for e in events])
-    df = post_call.apply_model(df, args["pl"], args["contigs"], args["diploid"], args["thresholds"])
+    df = events_to_frame(events)
+    df = post_call.apply_model(df, args["pl"], args["contigs"], args["diploid"], args["thresholds"],
+                               procs=args["procs"])
     if args["sites"]:
         df = post_call.update_prob_at_sites(df, events, args["thresholds"], parse_probs=args["parse_probs"] == "True",
                                         default_prob=args["sites_prob"])
@@ -1,6 +1,6 @@
 #cython: language_level=3, boundscheck=False
 from __future__ import absolute_import
-from collections import deque
+from collections import deque, defaultdict
 from dysgu import io_funcs
 import numpy as np
 cimport numpy as np
@@ -11,7 +11,12 @@ ctypedef np.float_t DTYPE_t
 from dysgu.map_set_utils cimport CoverageTrack
 from dysgu.map_set_utils import merge_intervals, echo
 from dysgu.io_funcs import intersecter
-from libc.stdint cimport uint32_t
+from libc.stdint cimport uint32_t, int64_t
+from libcpp.vector cimport vector
+
+
+cdef extern from "<algorithm>" namespace "std" nogil:
+    void nth_element[Iter](Iter first, Iter nth, Iter last)
 from pysam.libcalignedsegment cimport AlignedSegment
 from pysam.libchtslib cimport bam_get_cigar
 
@@ -525,8 +530,171 @@ cpdef calculate_coverage(int start, int end, np.int16_t[:] chrom_depth, int bin_
     return total / (end - start), max_cov
 
 
+def block_max(arr):
+    n_blocks = (len(arr) + 9) // 10
+    padded = np.full(n_blocks * 10, -32768, dtype=np.int16)
+    padded[:len(arr)] = arr
+    return padded.reshape(-1, 10).max(axis=1)
+
+
+cdef class CoveragePyramid:
+    """Window summaries of a 10 bp binned coverage track. Sums of 10-bin blocks are kept as prefix sums, and maxima
+    at 100 bp, 1 kb and 10 kb blocks, so a window mean or max only visits the unaligned bins at each end of
+    each level"""
+    cdef np.int16_t[:] depth
+    cdef np.int64_t[:] block_prefix
+    cdef np.int16_t[:] max_100bp, max_1kb, max_10kb
+    cdef int n
+
+    def __init__(self, np.int16_t[:] depth):
+        self.depth = depth
+        self.n = <int> len(depth)
+        arr = np.asarray(depth)
+        block_sums = np.zeros(0, dtype=np.int64)
+        if self.n:
+            block_sums = np.add.reduceat(arr, np.arange(0, self.n, 10), dtype=np.int64)
+        self.block_prefix = np.concatenate(([0], np.cumsum(block_sums))).astype(np.int64)
+        self.max_100bp = block_max(arr)
+        self.max_1kb = block_max(np.asarray(self.max_100bp))
+        self.max_10kb = block_max(np.asarray(self.max_1kb))
+
+    cdef int64_t _sum(self, int s, int e) nogil:
+        # sum of bins [s, e)
+        cdef int64_t total = 0
+        while s < e and s % 10 != 0:
+            total += self.depth[s]
+            s += 1
+        while e > s and e % 10 != 0:
+            e -= 1
+            total += self.depth[e]
+        if e > s:
+            total += self.block_prefix[e // 10] - self.block_prefix[s // 10]
+        return total
+
+    cdef int _max(self, int s, int e) nogil:
+        # max of bins [s, e), s < e
+        cdef int m = -32768
+        cdef int level, i
+        cdef np.int16_t[:] arr
+        for level in range(4):
+            if level == 0:
+                arr = self.depth
+            elif level == 1:
+                arr = self.max_100bp
+            elif level == 2:
+                arr = self.max_1kb
+            else:
+                arr = self.max_10kb
+                for i in range(s, e):
+                    if arr[i] > m:
+                        m = arr[i]
+                break
+            while s < e and s % 10 != 0:
+                if arr[s] > m:
+                    m = arr[s]
+                s += 1
+            while e > s and e % 10 != 0:
+                e -= 1
+                if arr[e] > m:
+                    m = arr[e]
+            s = s // 10
+            e = e // 10
+            if s >= e:
+                break
+        return m
+
+    cdef void _mean_max(self, int start, int end, float *mean, float *max_cov) nogil:
+        # same result as calculate_coverage over the full track
+        cdef float fs = start / <double> 10
+        cdef float fe = end / <double> 10
+        start = <int> fs
+        end = <int> fe
+        if start < 0:
+            start = 0
+        if end > self.n:
+            end = self.n
+        cdef float total = 0
+        cdef int m
+        mean[0] = 0
+        max_cov[0] = 0
+        if start == end:
+            if start < self.n:
+                total = self.depth[start]
+            if total != 0:
+                mean[0] = total
+                max_cov[0] = total
+        elif start < end:
+            total = <float> self._sum(start, end)
+            if total != 0:
+                mean[0] = total / (end - start)
+                m = self._max(start, end)
+                max_cov[0] = m if m > 0 else 0
+
+    def mean_max(self, int start, int end):
+        """Mean and max coverage of a window in bp, as returned by calculate_coverage"""
+        cdef float mean, max_cov
+        self._mean_max(start, end, &mean, &max_cov)
+        return mean, max_cov
+
+    def mean_max_batch(self, starts, ends):
+        """Vectorised mean_max over arrays of window starts and ends"""
+        cdef np.int64_t[:] s = np.asarray(starts, dtype=np.int64)
+        cdef np.int64_t[:] e = np.asarray(ends, dtype=np.int64)
+        means = np.zeros(len(s), dtype=np.float32)
+        maxes = np.zeros(len(s), dtype=np.float32)
+        cdef np.float32_t[:] mv = means
+        cdef np.float32_t[:] xv = maxes
+        cdef Py_ssize_t i
+        with nogil:
+            for i in range(s.shape[0]):
+                self._mean_max(<int> s[i], <int> e[i], &mv[i], &xv[i])
+        return means, maxes
+
+
+cpdef np.ndarray median_batch(np.int16_t[:] chrom_depth, starts, ends):
+    """Median coverage of many bp windows over 10 bp bins. Bin bounds are swapped if reversed and clipped to
+    [1, len), and empty windows give -1"""
+    cdef np.int64_t[:] s_arr = np.asarray(starts, dtype=np.int64)
+    cdef np.int64_t[:] e_arr = np.asarray(ends, dtype=np.int64)
+    result = np.full(len(s_arr), -1, dtype=np.float64)
+    cdef np.float64_t[:] out = result
+    cdef int64_t n = len(chrom_depth)
+    cdef int64_t s, e, tmp, k, j, i
+    cdef np.int16_t lower
+    cdef vector[np.int16_t] buf
+    with nogil:
+        for i in range(s_arr.shape[0]):
+            s = <int64_t> (s_arr[i] / <double> 10)
+            e = <int64_t> (e_arr[i] / <double> 10)
+            if s > e:
+                tmp = s
+                s = e
+                e = tmp
+            if s < 1:
+                s = 1
+            if e > n:
+                e = n
+            if e <= s:
+                continue
+            buf.clear()
+            for j in range(s, e):
+                buf.push_back(chrom_depth[j])
+            k = buf.size() // 2
+            nth_element(buf.begin(), buf.begin() + k, buf.end())
+            if buf.size() % 2 == 1:
+                out[i] = buf[k]
+            else:
+                lower = buf[0]
+                for j in range(1, k):
+                    if buf[j] > lower:
+                        lower = buf[j]
+                out[i] = (<double> lower + <double> buf[k]) / 2
+    return result
+
+
 def get_raw_coverage_information(events, regions, regions_depth, infile, max_cov):
     new_events = []
+    windows = defaultdict(list)
     for r in events:
         ar = False
         if intersecter(regions, r.chrA, r.posA, r.posA + 1):
@@ -567,35 +735,30 @@ def get_raw_coverage_information(events, regions, regions_depth, infile, max_cov
             r.cipos95B = cipos95A
             r.contig2 = r.contig
             r.contig = contig2
-        max_depth = 0
-        if kind == "hemi-regional":
-            chrom_i = r.chrA
-            if chrom_i in regions_depth.chrom_cov_arrays:
-                reads_10kb, max_depth = calculate_coverage(r.posA - 10000, r.posA + 10000, regions_depth.chrom_cov_arrays[chrom_i])
-                reads_10kb = round(reads_10kb, 3)
-            else:
-                reads_10kb = 0
-        else:
-            chrom_i = r.chrA
-            if chrom_i in regions_depth.chrom_cov_arrays:
-                reads_10kb_left, max_depth = calculate_coverage(r.posA - 10000, r.posA + 10000, regions_depth.chrom_cov_arrays[chrom_i])
-                reads_10kb_left = round(reads_10kb_left, 3)
-            else:
-                reads_10kb_left = 0
-            chrom_i = r.chrB
-            if chrom_i in regions_depth.chrom_cov_arrays:
-                reads_10kb_right, max_depth = calculate_coverage(r.posB - 10000, r.posB + 10000, regions_depth.chrom_cov_arrays[chrom_i])
-                reads_10kb_right = round(reads_10kb_right, 3)
-            else:
-                reads_10kb_right = 0
-            if reads_10kb_left > reads_10kb_right:
-                reads_10kb = reads_10kb_left
-            else:
-                reads_10kb = reads_10kb_right
         r.kind = kind
-        r.raw_reads_10kb = reads_10kb
         if r.chrA != r.chrB:
             r.svlen = 1000000
-        r.mcov = max_depth
+        # +-10 kb windows are answered per chromosome in one batch below
+        windows[r.chrA].append((len(new_events), 0, r.posA))
+        if kind != "hemi-regional":
+            windows[r.chrB].append((len(new_events), 1, r.posB))
         new_events.append(r)
+    means = [[0, 0] for _ in new_events]
+    maxes = [[0, 0] for _ in new_events]
+    for chrom, items in windows.items():
+        if chrom not in regions_depth.chrom_cov_arrays:
+            continue
+        pos = np.array([p for _, _, p in items], dtype=np.int64)
+        m, x = regions_depth.chrom_cov_arrays.pyramid(chrom).mean_max_batch(pos - 10000, pos + 10000)
+        for (i, side, _), mean, max_cov in zip(items, m.tolist(), x.tolist()):
+            means[i][side] = round(mean, 3)
+            maxes[i][side] = max_cov
+    for i, r in enumerate(new_events):
+        if r.kind == "hemi-regional":
+            r.raw_reads_10kb = means[i][0]
+            r.mcov = maxes[i][0]
+        else:
+            r.raw_reads_10kb = means[i][0] if means[i][0] > means[i][1] else means[i][1]
+            # the right side's max is used when its chromosome has coverage
+            r.mcov = maxes[i][1] if r.chrB in regions_depth.chrom_cov_arrays else maxes[i][0]
     return new_events
@@ -4,7 +4,7 @@ cimport numpy as np
 from dysgu.map_set_utils cimport unordered_map, EventResult
 from cython.operator import dereference, postincrement, postdecrement, preincrement, predecrement
 from libc.math cimport fabs as c_fabs
-from libc.stdint cimport uint32_t
+from libc.stdint cimport uint32_t, int64_t
 from libcpp.vector cimport vector as cpp_vector
 from dysgu.map_set_utils import echo
 import array
@@ -12,71 +12,82 @@ from pysam.libcalignedsegment cimport AlignedSegment
 from pysam.libchtslib cimport bam_get_cigar
 import pandas as pd
 pd.options.mode.chained_assignment = None
-from sys import byteorder
 import os
-import resource
 ctypedef EventResult EventResult_t
 
 
-class BadClipCounter:
+BADCLIP_FLUSH = 1 << 20  # records buffered before appending to the low-mem log
+
 
+class BadClipCounter:
+    """Positions of poor quality soft-clips. Records are appended to a single log as int64 keys (tid << 32 | pos),
+    which sort_arrays sorts once so each reference is a contiguous run found by binary search. With low_mem the
+    log is kept on disk and the sorted keys are memory-mapped"""
     def __init__(self, n_references, low_mem, temp_dir):
         self.low_mem = low_mem
         self.temp_dir = temp_dir
         self.n_refs = n_references
-        if not self.low_mem:
-            self.clip_pos_arr = [array.array("L", []) for i in range(n_references)]  # 32 bit unsigned int
-        else:
-            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
-            if soft + (n_references * 2) > soft:
-                resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, soft + (n_references * 2)), hard))
-            self.clip_pos_arr = [open(f"{self.temp_dir}/{i}.badclip.bin", "wb") for i in range(n_references)]
+        self.buffer = array.array("q")
+        self.keys = None
+        self.log_path = f"{self.temp_dir}/badclip.bin"
+        self.log = open(self.log_path, "wb") if self.low_mem else None
 
     def tidy(self):
         if self.low_mem:
-            [os.remove(f"{self.temp_dir}/{i}.badclip.bin") for i in range(self.n_refs)]
+            self.keys = None
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+            if os.path.exists(self.log_path):
+                os.remove(self.log_path)
 
     def add(self, chrom, position):
-        if not self.low_mem:
-            self.clip_pos_arr[chrom].append(position)
-        else:
-            self.clip_pos_arr[chrom].write(position.to_bytes(4, byteorder))
+        self.buffer.append((chrom << 32) | position)
+        if self.low_mem and len(self.buffer) >= BADCLIP_FLUSH:
+            self.buffer.tofile(self.log)
+            self.buffer = array.array("q")
 
     def sort_arrays(self):
         if not self.low_mem:
-            self.clip_pos_arr = [np.array(i, dtype=np.dtype("i")) for i in self.clip_pos_arr]
+            keys = np.frombuffer(self.buffer, dtype=np.int64).copy()
+            keys.sort()
+            self.keys = keys
+            return
+        self.buffer.tofile(self.log)
+        self.buffer = array.array("q")
+        self.log.close()
+        self.log = None
+        keys = np.fromfile(self.log_path, dtype=np.int64)
+        keys.sort()
+        keys.tofile(self.log_path)
+        del keys
+        if os.path.getsize(self.log_path):
+            self.keys = np.memmap(self.log_path, dtype=np.int64, mode="r")
         else:
-            [i.close() for i in self.clip_pos_arr]
-            self.clip_pos_arr = [np.fromfile(f"{self.temp_dir}/{i}.badclip.bin", np.int32) for i in range(self.n_refs)]
+            self.keys = np.zeros(0, dtype=np.int64)
 
-        [i.sort() for i in self.clip_pos_arr]
+    def count_near_batch(self, tids, starts, ends):
+        """Number of clips with start <= position <= end on each tid, for arrays of queries"""
+        tids = np.asarray(tids, dtype=np.int64)
+        starts = np.maximum(np.asarray(starts, dtype=np.int64), 0)
+        ends = np.asarray(ends, dtype=np.int64)
+        counts = np.zeros(len(tids), dtype=np.int64)
+        valid = (tids >= 0) & (ends >= 0)
+        if self.keys is None or len(self.keys) == 0 or not valid.any():
+            return counts
+        keys = self.keys
+        t = tids[valid]
+        ref_begin = np.searchsorted(keys, t << 32, side="left")
+        ref_end = np.searchsorted(keys, (t + 1) << 32, side="left")
+        lo = np.searchsorted(keys, (t << 32) | starts[valid], side="left")
+        hi = np.searchsorted(keys, (t << 32) | np.minimum(ends[valid], 0xFFFFFFFF), side="right")
+        # as before, nothing is counted when only the last clip on the reference is past start
+        c = np.where(lo - ref_begin >= ref_end - ref_begin - 1, 0, hi - lo)
+        counts[valid] = np.maximum(c, 0)
+        return counts
 
     def count_near(self, int chrom, int start, int end):
-        py_a = self.clip_pos_arr[chrom]
-        cdef int len_a = len(py_a)
-        if chrom < 0 or len_a == 0:
-            return 0
-        cdef int[:] a = py_a
-        if start < 0:
-            start = 0
-        cdef int i = np.searchsorted(py_a, start)
-        if i < 0:
-            i = 0
-        if i >= len_a - 1:
-            return 0
-        # search forward and backwards
-        cdef int count = 0
-        cdef int p
-        while True:
-            if i >= len_a:
-                break
-            p = a[i]
-            if p <= end:
-                count += 1
-                i += 1
-            else:
-                break
-        return count
+        return int(self.count_near_batch([chrom], [start], [end])[0])
 
 
 cdef float soft_clip_qual_corr(reads):
@@ -174,58 +185,119 @@ cdef struct WindowRate:
     int index
 
 
-cdef void window_rate(WindowRate *result, uint32_t cigar_l, uint32_t *cigar_p, int index, int window_size, bint reverse=False):
-    cdef int n = 0
-    cdef int matches = 0
-    cdef int covered = 0
-    cdef int i = index
-    cdef int stop, opp, l
-    cdef uint32_t cigar_value
-    if reverse:
-        stop = 0
-    else:
-        stop = cigar_l - 1
-    while i != stop:
-        cigar_value = cigar_p[i]
-        opp = <int> cigar_value & BAM_CIGAR_MASK
-        l = <int> cigar_value >> BAM_CIGAR_SHIFT
-        if opp == CMATCH or opp == CEQUAL:
-            matches += l
-            covered += l
-        elif opp == CDEL:
-            covered += l
-            n += 1
-        elif opp == CINS or opp == CSOFT_CLIP or opp == CHARD_CLIP or opp == CDIFF:
-            n += 1
-        if reverse:
-            i -= 1
-        else:
-            i += 1
-        if covered >= window_size:
+cdef class CigarProfile:
+    # Decoded cigar of one alignment with prefix sums over the operations, so that the rate of non-matching
+    # events within a window can be found without walking the cigar again. Index k of a prefix array holds the
+    # total over operations [0, k)
+    cdef public int n
+    cdef cpp_vector[int] ops
+    cdef cpp_vector[int] lens
+    cdef cpp_vector[int64_t] matches
+    cdef cpp_vector[int64_t] covered
+    cdef cpp_vector[int64_t] events
+
+    def __init__(self, AlignedSegment alignment):
+        cdef uint32_t cigar_l = alignment._delegate.core.n_cigar
+        cdef uint32_t *cigar_p = bam_get_cigar(alignment._delegate)
+        cdef uint32_t k
+        cdef int opp, l
+        cdef int64_t m = 0
+        cdef int64_t c = 0
+        cdef int64_t e = 0
+        self.n = cigar_l
+        self.ops.reserve(cigar_l)
+        self.lens.reserve(cigar_l)
+        self.matches.reserve(cigar_l + 1)
+        self.covered.reserve(cigar_l + 1)
+        self.events.reserve(cigar_l + 1)
+        self.matches.push_back(0)
+        self.covered.push_back(0)
+        self.events.push_back(0)
+        for k in range(cigar_l):
+            opp = <int> cigar_p[k] & BAM_CIGAR_MASK
+            l = <int> cigar_p[k] >> BAM_CIGAR_SHIFT
+            self.ops.push_back(opp)
+            self.lens.push_back(l)
+            if opp == CMATCH or opp == CEQUAL:
+                m += l
+                c += l
+            elif opp == CDEL:
+                c += l
+                e += 1
+            elif opp == CINS or opp == CSOFT_CLIP or opp == CHARD_CLIP or opp == CDIFF:
+                e += 1
+            self.matches.push_back(m)
+            self.covered.push_back(c)
+            self.events.push_back(e)
+
+    cdef void rate_between(self, WindowRate *result, int start, int stop, bint capped, int window_size):
+        # rate of non-matching events over operations [start, stop)
+        cdef int64_t matches = self.matches[stop] - self.matches[start]
+        cdef int64_t n = self.events[stop] - self.events[start]
+        if capped:
             # if final match block is really long, the previous cigar opp can be missed if this is not done:
-            matches = min(window_size, matches)
-            break
-    result.rate = 0 if not matches else n / (matches + n)
-    result.index = i
+            matches = min(<int64_t> window_size, matches)
+        result.rate = 0 if not matches else <double> n / (matches + n)
 
+    cdef int forward_rate(self, WindowRate *result, int index, int window_size, int stop):
+        # Equivalent to scanning operations from index towards the end of the cigar (the last operation is not
+        # scanned), stopping once window_size reference bases are covered. stop is the exclusive end found for a
+        # smaller index, which is a lower bound here because covered bases only increase; it is returned for reuse
+        cdef int last = self.n - 1
+        if stop < index + 1:
+            stop = index + 1
+        if stop > last:
+            stop = last if last > index else index
+        while stop < last and self.covered[stop] - self.covered[index] < window_size:
+            stop += 1
+        self.rate_between(result, index, stop, stop > index and self.covered[stop] - self.covered[index] >= window_size, window_size)
+        result.index = stop
+        return stop
 
-cpdef filter_poorly_aligned_ends(spanning_alignments, float divergence=0.02):
+    cdef int reverse_rate(self, WindowRate *result, int index, int window_size, int stop):
+        # As forward_rate, scanning from index towards the start of the cigar, leaving the first operation unscanned.
+        # stop is the index of the last unscanned operation, an upper bound carried over from a larger index
+        if stop > index - 1:
+            stop = index - 1
+        if stop < 0:
+            stop = 0
+        while stop > 0 and self.covered[index + 1] - self.covered[stop + 1] < window_size:
+            stop -= 1
+        self.rate_between(result, stop + 1, index + 1, index > 0 and self.covered[index + 1] - self.covered[stop + 1] >= window_size, window_size)
+        result.index = stop
+        return stop
+
+
+cpdef CigarProfile cigar_profile(AlignedSegment alignment, dict profiles=None):
+    # Profiles are cached by alignment identity so that gap_size_upper_bound can reuse the decoding done for
+    # filter_poorly_aligned_ends
+    cdef CigarProfile profile
+    if profiles is None:
+        return CigarProfile(alignment)
+    key = id(alignment)
+    if key in profiles:
+        return profiles[key]
+    profile = CigarProfile(alignment)
+    profiles[key] = profile
+    return profile
+
+
+cpdef filter_poorly_aligned_ends(spanning_alignments, float divergence=0.02, dict profiles=None):
     # This trys to check if the ends of reads are poorly aligned by looking at the rate of non-matching cigar events
-    cdef int i, index_begin, index_end, start_i, end_i, cigar_index
+    cdef int i, index_begin, index_end, start_i, end_i, cigar_index, stop
     cdef float threshold, w_rate, mean, std
-    cdef uint32_t cigar_value
-    cdef uint32_t cigar_l
-    cdef uint32_t *cigar_p
     cdef WindowRate window_r
     cdef AlignedSegment alignment
+    cdef CigarProfile profile
+    if profiles is None:
+        profiles = {}
     rates = []
     for item in spanning_alignments:
         alignment = item[5]
         if alignment.flag & 2048:
             continue
-        cigar_l = alignment._delegate.core.n_cigar
-        cigar_p = bam_get_cigar(alignment._delegate)
-        window_rate(&window_r, cigar_l, cigar_p, 0, 1_000_000_000, <bint>False)
+        profile = cigar_profile(alignment, profiles)
+        profile.forward_rate(&window_r, 0, 1_000_000_000, 0)
         rates.append(window_r.rate)
     if rates:
         mean = np.mean(rates)
@@ -238,20 +310,21 @@ cpdef filter_poorly_aligned_ends(spanning_alignments, float divergence=0.02):
     spanning = []
     for item in spanning_alignments:
         alignment = item[5]
-        cigar_l = alignment._delegate.core.n_cigar
-        cigar_p = bam_get_cigar(alignment._delegate)
+        profile = cigar_profile(alignment, profiles)
         cigar_index = item[6]
         index_begin = 0
-        for i in range(cigar_l):
-            window_rate(&window_r, cigar_l, cigar_p, i, 2000, <bint>False)
+        stop = 0
+        for i in range(profile.n):
+            stop = profile.forward_rate(&window_r, i, 2000, stop)
             w_rate = window_r.rate
             start_i = window_r.index
             if w_rate < threshold:
                 break
             index_begin = start_i
-        index_end = cigar_l
-        for i in range(cigar_l-1, index_begin -1, -1):
-            window_rate(&window_r, cigar_l, cigar_p, i, 2000, <bint>True)
+        index_end = profile.n
+        stop = profile.n
+        for i in range(profile.n - 1, index_begin - 1, -1):
+            stop = profile.reverse_rate(&window_r, i, 2000, stop)
             w_rate = window_r.rate
             end_i = window_r.index
             if w_rate < threshold:
@@ -262,28 +335,26 @@ cpdef filter_poorly_aligned_ends(spanning_alignments, float divergence=0.02):
     return spanning, 1 - (len(spanning) / len(spanning_alignments))
 
 
-cpdef gap_size_upper_bound(AlignedSegment alignment, int cigarindex, int pos_input, int end_input, int length_extend=15, float divergence=0.02):
+cpdef gap_size_upper_bound(AlignedSegment alignment, int cigarindex, int pos_input, int end_input, int length_extend=15, float divergence=0.02,
+                           dict profiles=None):
     # expand indel using cigar, merges nearby gaps into the SV event
     cdef int pos, end, l, opp, extent_left, extent_right, candidate_type, candidate_len, len_input, i, dist, dist_thresh, middle, last_seen_size
-    cdef uint32_t cigar_value
-    cdef uint32_t cigar_l = alignment._delegate.core.n_cigar
-    cdef uint32_t *cigar_p = bam_get_cigar(alignment._delegate)
+    cdef CigarProfile profile = cigar_profile(alignment, profiles)
+    cdef int cigar_l = profile.n
     pos = pos_input
     end = end_input
     extent_left = pos
     extent_right = end
-    cigar_value = cigar_p[cigarindex]
-    candidate_type = cigar_value & BAM_CIGAR_MASK
-    candidate_len = cigar_value >> BAM_CIGAR_SHIFT
+    candidate_type = profile.ops[cigarindex]
+    candidate_len = profile.lens[cigarindex]
     len_input = candidate_len
     dist_thresh = min(len_input * 3, <int> (<float> log2_32(1 + candidate_len) / divergence))
     i = cigarindex + 1
     dist = 0
     last_seen_size = candidate_len
     while i < cigar_l:
-        cigar_value = cigar_p[i]
-        opp = <int> cigar_value & BAM_CIGAR_MASK
-        l = <int> cigar_value >> BAM_CIGAR_SHIFT
+        opp = profile.ops[i]
+        l = profile.lens[i]
         if opp == CSOFT_CLIP or opp == CHARD_CLIP:
             break
         if opp == CMATCH or opp == CEQUAL or opp == CDIFF:
@@ -315,9 +386,8 @@ cpdef gap_size_upper_bound(AlignedSegment alignment, int cigarindex, int pos_inp
     i = cigarindex - 1
     dist = 0
     while i > -1:
-        cigar_value = cigar_p[i]
-        opp = <int> cigar_value & BAM_CIGAR_MASK
-        l = <int> cigar_value >> BAM_CIGAR_SHIFT
+        opp = profile.ops[i]
+        l = profile.lens[i]
         if opp == CSOFT_CLIP or opp == CHARD_CLIP:
             break
         if opp == CMATCH or opp == CEQUAL or opp == CDIFF:
@@ -1,4 +1,6 @@
 #include <cstdint>
+#include <cmath>
+#include <vector>
 #include <iostream>
 #include <functional>
 #include <string>
@@ -76,8 +78,12 @@ class CoverageTrack
         }
 
         void write_track(char* out_name) {
-
-            std::ofstream file_out (out_name, std::ios::binary);
+            // Writes the cumulative coverage as int16 bins, and summary statistics of the non-zero bins to
+            // out_name + ".stats" so readers do not need to scan the whole track
+            std::vector<int16_t> track(cov_array.size());
+            std::vector<uint64_t> hist(32001, 0);
+            uint64_t n_positive = 0;
+            double total = 0;
 
             int current_cov = 0;
             int16_t high = 32000;
@@ -90,14 +96,47 @@ class CoverageTrack
                     current_cov = cov_array[i];
                 }
 
-                if (current_cov > high) {
-                    file_out.write((char *)&high, sizeof(int16_t));
-                } else {
-                    file_out.write((char *)&current_cov, sizeof(int16_t));
+                int16_t value = (current_cov > high) ? high : (int16_t)current_cov;
+                track[i] = value;
+                if (value > 0) {
+                    hist[value] += 1;
+                    n_positive += 1;
+                    total += value;
                 }
             }
 
+            std::ofstream file_out (out_name, std::ios::binary);
+            file_out.write((char *)track.data(), track.size() * sizeof(int16_t));
             file_out.close();
+
+            // median matches numpy, the mean of the two middle values for an even count
+            double median = std::nan("");
+            if (n_positive > 0) {
+                uint64_t lower_rank = (n_positive - 1) / 2;
+                uint64_t upper_rank = n_positive / 2;
+                int lower = -1;
+                int upper = -1;
+                uint64_t seen = 0;
+                for (int v = 1; v <= high; v++) {
+                    seen += hist[v];
+                    if (lower == -1 && seen > lower_rank) {
+                        lower = v;
+                    }
+                    if (seen > upper_rank) {
+                        upper = v;
+                        break;
+                    }
+                }
+                median = (lower + upper) / 2.0;
+            }
+
+            std::ofstream stats_out (std::string(out_name) + ".stats");
+            stats_out.precision(17);
+            stats_out << "n_bins\t" << track.size() << "\n";
+            stats_out << "n_positive\t" << n_positive << "\n";
+            stats_out << "mean\t" << (n_positive > 0 ? total / n_positive : std::nan("")) << "\n";
+            stats_out << "median\t" << median << "\n";
+            stats_out.close();
         }
 };
 
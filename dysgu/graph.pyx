@@ -9,6 +9,7 @@ from cpython cimport array
 import array
 import re
 import logging
+import pickle
 from dysgu.map_set_utils cimport unordered_map as robin_map, Py_SimpleGraph
 from dysgu.map_set_utils cimport multimap as cpp_map
 from dysgu cimport map_set_utils
@@ -23,11 +24,14 @@ from libcpp.deque cimport deque as cpp_deque
 from libcpp.vector cimport vector
 from libcpp.pair cimport pair as cpp_pair
 from libcpp.unordered_map cimport unordered_map
-from libc.stdint cimport uint16_t, uint32_t, int32_t, uint64_t
+from libc.stdint cimport uint8_t, uint16_t, uint32_t, int32_t, int64_t, uint64_t
 from libc.stdlib cimport abs as c_abs
+from libc.string cimport memcpy
+from cpython.bytes cimport PyBytes_FromStringAndSize
 from cython.operator import dereference, postincrement, postdecrement, preincrement, predecrement
-from pysam.libcalignedsegment cimport AlignedSegment
-from pysam.libchtslib cimport bam_get_qname, bam_seqi, bam_get_seq, bam_get_cigar
+from pysam.libcalignedsegment cimport AlignedSegment, makeAlignedSegment
+from pysam.libcalignmentfile cimport AlignmentHeader
+from pysam.libchtslib cimport bam_get_qname, bam_seqi, bam_get_seq, bam_get_cigar, bam1_t, bam1_core_t, bam_init1, bam_destroy1
 
 ctypedef cpp_pair[int, int] cpp_item
 
@@ -558,9 +562,11 @@ cdef class NodeToName:
     cdef vector[uint64_t] t
     cdef vector[int32_t] cigar_index
     cdef vector[uint32_t] event_pos
+    cdef vector[uint16_t] read_length  # capped at 65535, only used for cost estimates
     def __cinit__(self):
         pass
-    cdef void append(self, long a, int b, int c, int d, long e, int f, int g) nogil:
+    cdef void append(self, long a, int b, int c, int d, long e, int f, int g, int rl) nogil:
+        self.read_length.push_back(rl if rl < 65535 else 65535)
         self.h.push_back(a)
         self.f.push_back(b)
         self.p.push_back(c)
@@ -575,6 +581,68 @@ cdef class NodeToName:
     cdef bint same_template(self, int query_node, int target_node):
         if self.h[query_node] == self.h[target_node]:
             return True
+    def take(self, nodes):
+        # Copy the columns for a set of nodes into a NODE_DTYPE record array, without creating NodeName objects
+        cdef int i, v
+        cdef int n = len(nodes)
+        out = np.empty(n, dtype=NODE_DTYPE)
+        cdef uint64_t[:] h = out["hash_name"]
+        cdef uint64_t[:] t = out["tell"]
+        cdef uint32_t[:] p = out["pos"]
+        cdef int32_t[:] ci = out["cigar_index"]
+        cdef uint32_t[:] e = out["event_pos"]
+        cdef uint16_t[:] f = out["flag"]
+        cdef uint16_t[:] c = out["chrom"]
+        for i, v in enumerate(nodes):
+            h[i] = self.h[v]
+            t[i] = self.t[v]
+            p[i] = self.p[v]
+            ci[i] = self.cigar_index[v]
+            e[i] = self.event_pos[v]
+            f[i] = self.f[v]
+            c[i] = self.c[v]
+        return out
+    def read_bases(self, nodes):
+        cdef long total = 0
+        cdef int v
+        for v in nodes:
+            total += self.read_length[v]
+        return total
+
+
+# Fixed-width record of a NodeName, used when components are handed to worker processes as flat buffers
+NODE_DTYPE = np.dtype([("hash_name", np.uint64), ("tell", np.uint64), ("pos", np.uint32), ("cigar_index", np.int32),
+                       ("event_pos", np.uint32), ("flag", np.uint16), ("chrom", np.uint16)])
+
+
+cdef class NodeNameColumns:
+    # Read-only stand-in for the n2n dict of a component. Columns are views of a NODE_DTYPE array, NodeName
+    # objects are only made when a node is looked up
+    cdef dict index
+    cdef const uint64_t[:] h, t
+    cdef const uint32_t[:] p, e
+    cdef const int32_t[:] ci
+    cdef const uint16_t[:] f, c
+    def __init__(self, nodes, records):
+        self.index = dict(zip(nodes.tolist(), range(len(nodes))))
+        self.h = records["hash_name"]
+        self.t = records["tell"]
+        self.p = records["pos"]
+        self.ci = records["cigar_index"]
+        self.e = records["event_pos"]
+        self.f = records["flag"]
+        self.c = records["chrom"]
+    def __getitem__(self, v):
+        cdef int i = self.index[v]
+        return NodeName(self.h[i], self.f[i], self.p[i], self.c[i], self.t[i], self.ci[i], self.e[i])
+    def __contains__(self, v):
+        return v in self.index
+    def __len__(self):
+        return len(self.index)
+    def __iter__(self):
+        return iter(self.index)
+    def keys(self):
+        return self.index.keys()
 
 cdef get_query_pos_from_cigarstring(cigar, pos):
     # Infer the position on the query sequence of the alignment using cigar string
@@ -734,7 +802,7 @@ cdef void add_to_graph(Py_SimpleGraph G, AlignedSegment r, PairedEndScoper_t pe_
     cdef int bnd_site_node, bnd_site_node2
     cdef int q_start
     # echo("\nADDING", node_name, r.qname, (chrom, event_pos), (chrom2, pos2), flag, read_enum)
-    node_to_name.append(v, flag, r.pos, chrom, tell, cigar_index, event_pos)  # Index this list to get the template_name
+    node_to_name.append(v, flag, r.pos, chrom, tell, cigar_index, event_pos, r._delegate.core.l_qseq)  # Index this list to get the template_name
     genome_scanner.add_to_buffer(r, node_name, tell)  # Add read to buffer
     if read_enum < 2:  # Prevents joining up within-read svs with between-read svs
         q_start = r.query_alignment_start if not r.flag & 16 else r.infer_query_length() - r.query_alignment_end
@@ -1073,7 +1141,7 @@ class SiteAdder:
             self.sites_index_r[site] = node_name
             pe_scope.add_item(node_name, site.chrom, site.start, site.chrom2, site.end, read_enum, length)
             pe_scope.local_chrom = chrom  # needs setting otherwise scope can be cleared when new read is added
-            node_to_name.append(0, 0, 0, 0, 0, 0, 0)
+            node_to_name.append(0, 0, 0, 0, 0, 0, 0, 0)
             self.count += 1
             self.sites_queue[chrom].popleft()
             self.add_to_scope(site)
@@ -1258,12 +1326,13 @@ cdef BFS_local(Py_SimpleGraph G, int source, unordered_set[int]& visited ):
     return array.array("L", nodes_found)
 
 
-cdef get_partitions(Py_SimpleGraph G, nodes):
+cdef get_partitions(Py_SimpleGraph G, const int[:] nodes):
     cdef unordered_set[int] seen
     cdef int u, v, i
     cdef vector[int] neighbors
     parts = []
-    for u in nodes:
+    for i in range(nodes.shape[0]):
+        u = nodes[i]
         if seen.find(u) != seen.end():
             continue
         G.neighbors(u, neighbors)
@@ -1335,7 +1404,7 @@ cdef tuple count_support_between(Py_SimpleGraph G, parts):
     return counts, self_counts
 
 
-cpdef break_large_component(Py_SimpleGraph G, component, int min_support):
+cpdef break_large_component(Py_SimpleGraph G, const int[:] component, int min_support):
     # similar to count_support_between except only counts are returned without the node labels partitioned
     parts = get_partitions(G, component)
     cdef int i, j, node, child
@@ -1393,16 +1462,23 @@ cpdef break_large_component(Py_SimpleGraph G, component, int min_support):
     return jobs
 
 
-cpdef proc_component(node_to_name, component, read_buffer, infile, Py_SimpleGraph G, int min_support, int procs, int paired_end,
+cpdef proc_component(node_to_name, const int[:] component, read_buffer, infile, Py_SimpleGraph G, int min_support, int procs, int paired_end,
                      sites_index):
-    n2n = {}
+    # With procs > 1 the component is encoded as flat columns for a worker (see encode_component), so n2n only
+    # holds the node ids and NodeName objects are not made here
+    if procs == 1:
+        n2n = {}
+    else:
+        n2n = array.array("i")
     reads = {}
     cdef int support_estimate = 0
-    cdef int v
+    cdef int i, v
+    cdef NodeToName_t names = node_to_name
     info = None
-    if min_support >= 3 and len(component) == 1 and not sites_index:
+    if min_support >= 3 and component.shape[0] == 1 and not sites_index:
         return
-    for v in component:
+    for i in range(component.shape[0]):
+        v = component[i]
         # Add information from --sites, keep any read found that link to --sites variants
         if sites_index and v in sites_index:
             if info is None:
@@ -1411,14 +1487,16 @@ cpdef proc_component(node_to_name, component, read_buffer, infile, Py_SimpleGrap
                 info[v] = sites_index[v]
             min_support = len(info) + 1
             continue
-        if procs == 1 and v in read_buffer:
-            reads[v] = read_buffer[v]
-        key = node_to_name[v]
-        if key.cigar_index != -1:
+        if names.cigar_index[v] != -1:
             support_estimate += 2
         else:
             support_estimate += 1
-        n2n[v] = key
+        if procs == 1:
+            if v in read_buffer:
+                reads[v] = read_buffer[v]
+            n2n[v] = node_to_name[v]
+        else:
+            n2n.append(v)
     if support_estimate < min_support:
         return
 
@@ -1470,3 +1548,202 @@ cpdef proc_component(node_to_name, component, read_buffer, infile, Py_SimpleGrap
     if info:
         d["info"] = info
     return d
+
+
+cdef int _aligned(int n):
+    return (n + 7) & ~7
+
+
+cdef class _BufferWriter:
+    cdef object buf
+    cdef int offset
+    def __init__(self, int size):
+        self.buf = np.zeros(size, dtype=np.uint8)
+        self.offset = 0
+    def put(self, arr):
+        cdef int n = arr.nbytes
+        if n:
+            self.buf[self.offset: self.offset + n] = np.ascontiguousarray(arr).view(np.uint8).ravel()
+        self.offset += _aligned(n)
+
+
+cdef class _BufferReader:
+    cdef object buf
+    cdef int offset
+    def __init__(self, buf, int offset):
+        self.buf = buf
+        self.offset = offset
+    def take(self, dtype, int count):
+        dtype = np.dtype(dtype)
+        cdef int n = count * dtype.itemsize
+        arr = self.buf[self.offset: self.offset + n].view(dtype)
+        self.offset += _aligned(n)
+        return arr
+
+
+def _flatten(arrays):
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    if len(arrays):
+        np.cumsum([len(a) for a in arrays], out=offsets[1:])
+        flat = np.concatenate([np.asarray(a, dtype=np.uint32) for a in arrays]) if offsets[-1] else np.zeros(0, dtype=np.uint32)
+    else:
+        flat = np.zeros(0, dtype=np.uint32)
+    return offsets, flat
+
+
+def component_features(d, node_to_name):
+    """Features used to estimate the calling cost of a proc_component result: intercept, nodes, read kb,
+    partitions, sum of squared partition sizes (1e4 nodes^2), s_between edges and nodes, s_within nodes"""
+    n2n = d["n2n"]
+    part_sizes = np.array([len(p) for p in d["parts"]], dtype=np.float64)
+    between_nodes = sum(len(v[0]) + len(v[1]) for v in d["s_between"].values())
+    within_nodes = sum(len(v) for v in d["s_within"].values())
+    return np.array([1, len(n2n), node_to_name.read_bases(n2n) / 1000, len(part_sizes),
+                     np.dot(part_sizes, part_sizes) / 1e4, len(d["s_between"]), between_nodes, within_nodes],
+                    dtype=np.float64)
+
+
+def encode_component(d, node_to_name):
+    """Pack a proc_component result into one flat uint8 buffer. Node names are copied as NODE_DTYPE columns
+    and partitions as offset-indexed uint32 arrays, so the buffer can be read back with decode_component
+    without unpickling any objects"""
+    n2n = d["n2n"]
+    nodes = np.fromiter(n2n, dtype=np.int32, count=len(n2n))
+    records = node_to_name.take(nodes)
+    parts_offsets, parts_flat = _flatten(d["parts"])
+    between = d["s_between"]
+    between_keys = np.array([k for k in between.keys()], dtype=np.int32).reshape(-1, 2)
+    between_off0, between_flat0 = _flatten([v[0] for v in between.values()])
+    between_off1, between_flat1 = _flatten([v[1] for v in between.values()])
+    within = d["s_within"]
+    within_keys = np.fromiter(within.keys(), dtype=np.int32, count=len(within))
+    within_offsets, within_flat = _flatten(list(within.values()))
+    extra = {k: d[k] for k in ("reads", "info") if d.get(k)}
+    extra_bytes = np.frombuffer(pickle.dumps(extra), dtype=np.uint8) if extra else np.zeros(0, dtype=np.uint8)
+    header = np.array([len(nodes), len(d["parts"]), len(parts_flat), len(between), len(between_flat0),
+                       len(between_flat1), len(within), len(within_flat), len(extra_bytes)], dtype=np.int64)
+    sections = (header, nodes, records, parts_offsets, parts_flat, between_keys, between_off0, between_off1,
+                between_flat0, between_flat1, within_keys, within_offsets, within_flat, extra_bytes)
+    cdef _BufferWriter w = _BufferWriter(sum(_aligned(a.nbytes) for a in sections))
+    for a in sections:
+        w.put(a)
+    return w.buf
+
+
+def _split(offsets, flat):
+    return [flat[offsets[i]: offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+def decode_component(buf, ReadArena read_arena=None):
+    """Inverse of encode_component. Returns a proc_component style dict whose arrays are views of buf, so buf
+    must stay valid while the component is being called. Reads of the component found in read_arena are added
+    to d["reads"], the same as the read_buffer lookup in proc_component when procs == 1"""
+    cdef _BufferReader r = _BufferReader(buf, 0)
+    n_nodes, n_parts, n_parts_flat, n_between, n_between0, n_between1, n_within, n_within_flat, n_extra = \
+        r.take(np.int64, 9).tolist()
+    nodes = r.take(np.int32, n_nodes)
+    records = r.take(NODE_DTYPE, n_nodes)
+    parts = _split(r.take(np.int64, n_parts + 1), r.take(np.uint32, n_parts_flat))
+    between_keys = r.take(np.int32, 2 * n_between).tolist()
+    between_off0 = r.take(np.int64, n_between + 1)
+    between_off1 = r.take(np.int64, n_between + 1)
+    between0 = _split(between_off0, r.take(np.uint32, n_between0))
+    between1 = _split(between_off1, r.take(np.uint32, n_between1))
+    s_between = {(between_keys[2 * i], between_keys[2 * i + 1]): [between0[i], between1[i]] for i in range(n_between)}
+    within_keys = r.take(np.int32, n_within).tolist()
+    s_within = dict(zip(within_keys, _split(r.take(np.int64, n_within + 1), r.take(np.uint32, n_within_flat))))
+    d = {"parts": parts, "s_between": s_between, "reads": read_arena.fetch(nodes) if read_arena is not None else {},
+         "s_within": s_within, "n2n": NodeNameColumns(nodes, records)}
+    if n_extra:
+        d.update(pickle.loads(r.take(np.uint8, n_extra).tobytes()))
+    return d
+
+
+def write_read_arena(path, read_buffer):
+    """Write the buffered reads of GenomeScanner to path as raw bam records, so calling workers can rebuild
+    them without seeking in the alignment file. Layout is n (int64), node ids (int32, sorted), record offsets
+    (int64), record lengths (int64), then the records. Each record is a bam1_core_t followed by the bam data.
+    Returns False if there are no buffered reads"""
+    if not read_buffer:
+        return False
+    cdef AlignedSegment a
+    cdef int core_size = _aligned(sizeof(bam1_core_t))
+    nodes = sorted(read_buffer)
+    cdef int n = len(nodes)
+    keys = np.array(nodes, dtype=np.int32)
+    lengths = np.zeros(n, dtype=np.int64)
+    cdef int i
+    for i in range(n):
+        a = read_buffer[nodes[i]]
+        lengths[i] = core_size + a._delegate.l_data
+    offsets = np.zeros(n, dtype=np.int64)
+    start = _aligned(8 + 4 * n) + 16 * n
+    np.cumsum([_aligned(l) for l in lengths[:-1]], out=offsets[1:])
+    offsets += start
+    with open(path, "wb") as f:
+        f.write(np.array([n], dtype=np.int64).tobytes())
+        f.write(keys.tobytes())
+        f.write(bytes(_aligned(8 + 4 * n) - 8 - 4 * n))
+        f.write(offsets.tobytes())
+        f.write(lengths.tobytes())
+        for i in range(n):
+            a = read_buffer[nodes[i]]
+            f.write(PyBytes_FromStringAndSize(<char *>&a._delegate.core, sizeof(bam1_core_t)))
+            f.write(bytes(core_size - sizeof(bam1_core_t)))
+            f.write(PyBytes_FromStringAndSize(<char *>a._delegate.data, a._delegate.l_data))
+            f.write(bytes(_aligned(lengths[i]) - lengths[i]))
+    return True
+
+
+cdef class ReadArena:
+    """Read-only view of a file made by write_read_arena, shared by calling workers through the page cache"""
+    cdef object mm
+    cdef const uint8_t[::1] data
+    cdef object keys, offsets, lengths
+    cdef AlignmentHeader header
+    cdef bam1_t *scratch
+    def __cinit__(self):
+        self.scratch = bam_init1()
+    def __init__(self, path, AlignmentHeader header):
+        self.mm = np.memmap(path, dtype=np.uint8, mode="r")
+        self.data = self.mm
+        cdef int n = self.mm[:8].view(np.int64)[0]
+        start = _aligned(8 + 4 * n)
+        self.keys = self.mm[8: 8 + 4 * n].view(np.int32)
+        self.offsets = self.mm[start: start + 8 * n].view(np.int64)
+        self.lengths = self.mm[start + 8 * n: start + 16 * n].view(np.int64)
+        self.header = header
+    def __dealloc__(self):
+        if self.scratch != NULL:
+            self.scratch.data = NULL  # points into the memmap
+            bam_destroy1(self.scratch)
+    def fetch(self, nodes):
+        """Returns {node: AlignedSegment} for the nodes that have a record in the arena"""
+        reads = {}
+        if not len(nodes) or not len(self.keys):
+            return reads
+        nodes = np.asarray(nodes, dtype=np.int32)
+        idx = np.minimum(np.searchsorted(self.keys, nodes), len(self.keys) - 1)
+        found = np.flatnonzero(self.keys[idx] == nodes)
+        if not len(found):
+            return reads
+        cdef const int32_t[:] node_ids = nodes[found]
+        cdef const int64_t[:] offs = self.offsets[idx[found]]
+        cdef const int64_t[:] lens = self.lengths[idx[found]]
+        cdef int core_size = _aligned(sizeof(bam1_core_t))
+        cdef int i
+        cdef int64_t o
+        for i in range(node_ids.shape[0]):
+            o = offs[i]
+            memcpy(&self.scratch.core, &self.data[o], sizeof(bam1_core_t))
+            self.scratch.data = <uint8_t *>&self.data[o + core_size]
+            self.scratch.l_data = lens[i] - core_size
+            self.scratch.m_data = self.scratch.l_data
+            reads[node_ids[i]] = makeAlignedSegment(self.scratch, self.header)  # copies the record
+        self.scratch.data = NULL
+        self.scratch.l_data = 0
+        self.scratch.m_data = 0
+        return reads
+    def close(self):
+        self.data = None
+        self.mm = None
@@ -32,14 +32,25 @@ class DiGraph {
 
         int addNode() {
             int n = N;
-            std::vector<PairW2> node;
-            std::vector<PairW2> in_node;
-            outList.push_back(node);  // empty, no edges
-            inList.push_back(in_node);
+            if (n < (int)outList.size()) {  // reuse storage left by clear
+                outList[n].clear();
+                inList[n].clear();
+            } else {
+                std::vector<PairW2> node;
+                std::vector<PairW2> in_node;
+                outList.push_back(node);  // empty, no edges
+                inList.push_back(in_node);
+            }
             N++;
             return n;
         }
 
+        void clear() {
+            // Remove all nodes and edges, but keep the edge lists allocated for the next graph
+            N = 0;
+            n_edges = 0;
+        }
+
         int hasEdge(int u, int v) {
             if ((u > N ) || (v > N)) { return 0; }
             for (const auto& val: outList[u]) {
@@ -229,40 +240,53 @@ class SimpleGraph {
             adjList[u] = node;
         }
 
-        void connectedComponents(const char* outpath, bool low_mem, std::vector<int>& components) {
+        void connectedComponents(const char* outpath, bool low_mem, std::vector<int>& components, std::vector<int64_t>& offsets) {
+            // Components are written as one flat array of node ids, component i is components[offsets[i]:offsets[i+1]].
+            // With low_mem the nodes are written to outpath and the offsets to outpath.offsets instead
             std::string outpath_string = outpath;
-            std::ofstream outf(outpath);
-            std::vector<bool> visited(adjList.size(), false);
-            if (!components.empty()) {
-                components.clear();
+            std::ofstream outf;
+            std::ofstream offf;
+            if (low_mem) {
+                outf.open(outpath_string, std::ios::binary);
+                offf.open(outpath_string + ".offsets", std::ios::binary);
             }
-//            std::vector<int> components;
+            std::vector<bool> visited(adjList.size(), false);
+            components.clear();
+            offsets.clear();
+            int64_t written = 0;
+            auto add_offset = [&]() {
+                if (!low_mem) {
+                    offsets.push_back(written);
+                } else {
+                    offf.write((char*)&written, sizeof(int64_t));
+                }
+            };
+            auto add_node = [&](int32_t v) {
+                if (!low_mem) {
+                    components.push_back(v);
+                } else {
+                    outf.write((char*)&v, sizeof(int32_t));
+                }
+                written += 1;
+            };
+            add_offset();
+            std::vector<int> queue;
             for (int u=0; u<N; u++) {
                 if (visited[u] == false) {
-                    if (!low_mem) {
-                        components.push_back(u);
-                    } else {
-                        outf.write((char*)&u, sizeof(int32_t));
-                    }
+                    add_node(u);
                     visited[u] = true;
-                    std::vector<int> queue;
+                    queue.clear();
                     // visit direct neighbors
-                    if (adjList[u].size() > 0) {
-                        for (const auto& val: adjList[u]) {
-                            if ((val.first != -1) && (visited[val.first] == false)) {
-                                queue.push_back(val.first);
-                            }
+                    for (const auto& val: adjList[u]) {
+                        if ((val.first != -1) && (visited[val.first] == false)) {
+                            queue.push_back(val.first);
                         }
                     }
                     while (!queue.empty()) {
                         int v = queue.back();
                         queue.pop_back();
                         if (visited[v] == false) {
-                            if (!low_mem) {
-                                components.push_back(v);
-                            } else {
-                                outf.write((char*)&v, sizeof(int32_t));
-                            }
+                            add_node(v);
                             visited[v] = true;
                             for (const auto& val2: adjList[v]) {
                                 if ((val2.first != -1) && (visited[val2.first] == false)) {
@@ -271,17 +295,13 @@ class SimpleGraph {
                             }
                         }
                     }
-                    // -1 is end of component
-                    if (!low_mem) {
-                        components.push_back(-1);
-                    } else {
-                        int v = -1;
-                        outf.write((char*)&v, sizeof(int32_t));
-                    }
+                    add_offset();
                 }
             }
-            outf.close();
-//            return components;
+            if (low_mem) {
+                outf.close();
+                offf.close();
+            }
         }
 
         std::size_t showSize() {
@@ -388,6 +408,13 @@ class TwoWayMap
             }
         }
 
+        void clear() {
+            string_key.clear();
+            index_key_map.clear();
+            last_key = 0;
+            last_index = 0;
+        }
+
         int get_index_prev() { return last_index; };
         int get_key_prev() { return last_key; };
 
@@ -5,7 +5,7 @@ import numpy as np
 cimport numpy as np
 import logging
 from map_set_utils import merge_intervals, echo
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from importlib.metadata import version
 import sortedcontainers
 import pandas as pd
@@ -16,6 +16,7 @@ from dysgu.map_set_utils import Py_BasicIntervalTree
 import random
 
 from libc.stdlib cimport malloc
+from libc.stdint cimport int64_t
 
 
 cdef char *basemap = [ '\0', '\0', '\0', '\0', '\0', '\0', '\0', '\0', '\0', '\0', '\0', '\0', '\0', '\0', '\0', '\0',
@@ -125,6 +126,251 @@ def get_include_reads(include_regions, bam):
             yield r
 
 
+class ReferenceCache:
+    """Read-through cache of upper-cased reference windows with the fetch interface of pysam.FastaFile. Windows
+    requested with prefetch are merged per chromosome and each merged span is fetched once. Spans are evicted in
+    least-recently-used order once max_bytes is exceeded"""
+    def __init__(self, ref_genome, max_bytes=256_000_000, pad=1500, max_span=4_000_000):
+        self.ref_genome = ref_genome
+        self.max_bytes = max_bytes
+        self.pad = pad
+        self.max_span = max_span
+        self.references = ref_genome.references
+        self.lengths = ref_genome.lengths
+        self.filename = ref_genome.filename
+        self.chrom_lengths = dict(zip(ref_genome.references, ref_genome.lengths))
+        self.spans = OrderedDict()  # (chrom, start) -> (end, seq)
+        self.starts = defaultdict(sortedcontainers.SortedList)
+        self.n_bytes = 0
+
+    def get_reference_length(self, chrom):
+        return self.ref_genome.get_reference_length(chrom)
+
+    def _covering(self, chrom, int start, int end):
+        if chrom not in self.starts:
+            return None
+        starts = self.starts[chrom]
+        i = starts.bisect_right(start) - 1
+        if i < 0:
+            return None
+        key = (chrom, starts[i])
+        if self.spans[key][0] < end:
+            return None
+        self.spans.move_to_end(key)
+        return key
+
+    def _add(self, chrom, int start, int end):
+        key = (chrom, start)
+        if key in self.spans:
+            self.n_bytes -= len(self.spans.pop(key)[1])
+        else:
+            self.starts[chrom].add(start)
+        seq = self.ref_genome.fetch(chrom, start, end).upper()
+        self.spans[key] = (end, seq)
+        self.n_bytes += len(seq)
+        while self.n_bytes > self.max_bytes and len(self.spans) > 1:
+            old_key, (_, old_seq) = self.spans.popitem(last=False)
+            self.starts[old_key[0]].remove(old_key[1])
+            self.n_bytes -= len(old_seq)
+        return seq
+
+    def prefetch(self, intervals, pad=None):
+        """Fetch the merged span of a list of (chrom, start, end) windows, each padded by pad (default self.pad)"""
+        if pad is None:
+            pad = self.pad
+        for chrom, start, end in merge_intervals([i for i in intervals if i[0] in self.chrom_lengths], pad=pad):
+            start = max(0, start)
+            end = min(end, self.chrom_lengths[chrom])
+            while start < end:
+                stop = min(end, start + self.max_span)
+                if self._covering(chrom, start, stop) is None:
+                    self._add(chrom, start, stop)
+                if stop == end:
+                    break
+                start = stop - pad
+
+    def fetch(self, chrom, int start, int end):
+        cdef int length = self.chrom_lengths.get(chrom, -1)
+        if start < 0 or end < start or start >= length:
+            # defer to pysam for its errors and empty results
+            return self.ref_genome.fetch(chrom, start, end).upper()
+        if end > length:
+            end = length
+        key = self._covering(chrom, start, end)
+        if key is not None:
+            return self.spans[key][1][start - key[1]: end - key[1]]
+        span_start = max(0, start - self.pad)
+        return self._add(chrom, span_start, min(length, end + self.pad))[start - span_start: end - span_start]
+
+
+GAP_INDEX_VERSION = "2"
+LOW_COMPLEXITY_RUN = 25  # minimum homopolymer length recorded as a low-complexity run
+GAP_SCAN_CHUNK = 8_000_000
+
+
+cdef class RunScanner:
+    """Streams a chromosome in chunks, recording runs of N and homopolymer runs of at least min_run bases"""
+    cdef int64_t pos, n_start, h_start
+    cdef int h_base, min_run
+    cdef public list n_runs, low_runs
+
+    def __init__(self, int min_run):
+        self.pos = 0
+        self.n_start = -1
+        self.h_start = 0
+        self.h_base = -1
+        self.min_run = min_run
+        self.n_runs = []
+        self.low_runs = []
+
+    def feed(self, bytes chunk):
+        cdef const unsigned char *c = chunk
+        cdef int64_t i, n = len(chunk)
+        cdef int b
+        for i in range(n):
+            b = c[i] & 0xDF  # upper case
+            if b == 78:  # N
+                if self.n_start == -1:
+                    self.n_start = self.pos + i
+            elif self.n_start != -1:
+                self.n_runs.append((self.n_start, self.pos + i))
+                self.n_start = -1
+            if b != self.h_base:
+                if self.h_base != 78 and self.pos + i - self.h_start >= self.min_run:
+                    self.low_runs.append((self.h_start, self.pos + i))
+                self.h_base = b
+                self.h_start = self.pos + i
+        self.pos += n
+
+    def finish(self):
+        self.feed(b"")
+        if self.n_start != -1:
+            self.n_runs.append((self.n_start, self.pos))
+        if self.h_base != 78 and self.pos - self.h_start >= self.min_run:
+            self.low_runs.append((self.h_start, self.pos))
+
+
+class GapIndex:
+    """Sorted, non-overlapping N runs ("N") and low-complexity runs ("L") of a reference, per chromosome. Chromosomes
+    are scanned the first time they are needed and the runs are cached on disk, next to the fasta or in work_dir if
+    the fasta directory is not writable. The cache is rebuilt if the fasta changes"""
+    def __init__(self, ref_genome, work_dir=None):
+        self.ref_genome = ref_genome
+        ref_path = ref_genome.filename
+        if isinstance(ref_path, bytes):
+            ref_path = ref_path.decode()
+        self.stamp = fasta_stamp(ref_path)
+        self.paths = [gap_index_path(ref_path)]
+        if work_dir is not None:
+            self.paths.append(gap_index_path(ref_path, work_dir))
+        self.chroms = set(ref_genome.references)
+        self.scanned = {}  # chrom -> {kind: intervals}
+        self.runs = {}
+        for pth in self.paths:
+            if os.path.exists(pth):
+                for chrom, kinds in read_gap_index(pth, self.stamp).items():
+                    if chrom not in self.scanned:
+                        self._set(chrom, kinds)
+
+    def _set(self, chrom, kinds):
+        self.scanned[chrom] = kinds
+        for kind, intervals in kinds.items():
+            arr = np.array(sorted(intervals), dtype=np.int64).reshape(-1, 2)
+            self.runs[(chrom, kind)] = (np.ascontiguousarray(arr[:, 0]), np.ascontiguousarray(arr[:, 1]))
+
+    def ensure(self, chroms):
+        """Scan any of chroms not already indexed, then update the cache file"""
+        missing = sorted(c for c in set(chroms) if c in self.chroms and c not in self.scanned)
+        if not missing:
+            return
+        logging.info("Indexing reference gaps for {} chromosomes".format(len(missing)))
+        for chrom in missing:
+            self._set(chrom, scan_chromosome(self.ref_genome, chrom))
+        for pth in self.paths:
+            try:
+                write_gap_index(pth, self.stamp, self.scanned)
+                return
+            except OSError:
+                pass
+        logging.warning(f"Could not write gap index {' or '.join(self.paths)}, keeping in memory")
+
+    def overlaps(self, chrom, int64_t start, int64_t end, kind="N"):
+        """True if any run of kind overlaps [start, end)"""
+        if chrom not in self.scanned:
+            self.ensure([chrom])
+        if (chrom, kind) not in self.runs:
+            return False
+        starts, ends = self.runs[(chrom, kind)]
+        cdef int64_t i = np.searchsorted(starts, end, side="left") - 1
+        return i >= 0 and ends[i] > start
+
+
+def gap_index_path(ref_path, work_dir=None):
+    if work_dir is None:
+        return ref_path + ".gaps"
+    return os.path.join(work_dir, os.path.basename(ref_path) + ".gaps")
+
+
+def scan_chromosome(ref_genome, chrom):
+    cdef int64_t length = ref_genome.get_reference_length(chrom)
+    scanner = RunScanner(LOW_COMPLEXITY_RUN)
+    for start in range(0, length, GAP_SCAN_CHUNK):
+        scanner.feed(ref_genome.fetch(chrom, start, min(length, start + GAP_SCAN_CHUNK)).encode("ascii"))
+    scanner.finish()
+    return {"N": scanner.n_runs, "L": scanner.low_runs}
+
+
+def fasta_stamp(ref_path):
+    st = os.stat(ref_path)
+    return f"{GAP_INDEX_VERSION}\t{st.st_size}\t{st.st_mtime_ns}"
+
+
+def read_gap_index(pth, stamp):
+    # each scanned chromosome starts with a "#chrom" line, so chromosomes without runs are not scanned again
+    scanned = {}
+    with open(pth, "r") as f:
+        if f.readline().rstrip("\n") != "#dysgu-gaps\t" + stamp:
+            return scanned
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if fields[0] == "#chrom":
+                scanned[fields[1]] = {"N": [], "L": []}
+            else:
+                chrom, start, end, kind = fields
+                scanned[chrom][kind].append((int(start), int(end)))
+    return scanned
+
+
+def write_gap_index(pth, stamp, scanned):
+    tmp = f"{pth}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w") as f:
+            f.write("#dysgu-gaps\t" + stamp + "\n")
+            for chrom, kinds in scanned.items():
+                f.write(f"#chrom\t{chrom}\n")
+                for kind, intervals in kinds.items():
+                    for start, end in intervals:
+                        f.write(f"{chrom}\t{start}\t{end}\t{kind}\n")
+        os.replace(tmp, pth)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+_gap_indexes = {}
+
+
+def load_gap_index(ref_genome, work_dir=None):
+    """Gap index for a pysam.FastaFile (or ReferenceCache), shared by later calls with the same fasta"""
+    ref_path = ref_genome.filename
+    if isinstance(ref_path, bytes):
+        ref_path = ref_path.decode()
+    if ref_path not in _gap_indexes:
+        _gap_indexes[ref_path] = GapIndex(ref_genome, work_dir)
+    return _gap_indexes[ref_path]
+
+
 cpdef list col_names(small_output):
 
     if small_output:
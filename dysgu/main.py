@@ -169,6 +169,8 @@ def cli():
               show_default=True, default="wb0", type=str)
 @click.option("-p", "--procs", help="Number of cpu cores to use", type=cpu_range, default=1,
               show_default=True)
+@click.option("--read-threads", help="Decompression threads for each calling worker, used when reads are not in the read buffer", type=cpu_range, default=1, show_default=True)
+@click.option("--component-threads", help="Threads for each calling worker, used to call the partitions of large components in parallel", type=cpu_range, default=1, show_default=True)
 @click.option('--mode', help=f"Type of input reads. Multiple options are set, overrides other options. "
                              f"pacbio: --mq {presets['pacbio']['mq']} --paired False --min-support '{presets['pacbio']['min_support']}' --max-cov {presets['pacbio']['max_cov']} --dist-norm {presets['pacbio']['dist_norm']} --trust-ins-len True. "
                              f"nanopore: --mq {presets['nanopore']['mq']} --paired False --min-support '{presets['nanopore']['min_support']}' --max-cov {presets['nanopore']['max_cov']} --dist-norm {presets['nanopore']['dist_norm']} --trust-ins-len False",
@@ -362,6 +364,8 @@ def get_reads(ctx, **kwargs):
               default="False", type=click.Choice(["True", "False"]),
               show_default=True)
 @click.option("-p", "--procs", help="Processors to use", type=cpu_range, default=1, show_default=True)
+@click.option("--read-threads", help="Decompression threads for each calling worker, used when reads are not in the read buffer", type=cpu_range, default=1, show_default=True)
+@click.option("--component-threads", help="Threads for each calling worker, used to call the partitions of large components in parallel", type=cpu_range, default=1, show_default=True)
 @click.option("--buffer-size", help="Number of alignments to buffer", default=defaults["buffer_size"],
               type=int, show_default=True)
 @click.option("--merge-within", help="Try and merge similar events, recommended for most situations",
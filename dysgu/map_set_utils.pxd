@@ -7,7 +7,7 @@ from libcpp.utility cimport pair
 import numpy as np
 cimport numpy as np
 
-from libc.stdint cimport uint64_t, int32_t, int8_t
+from libc.stdint cimport uint64_t, int64_t, int32_t, int8_t
 
 ctypedef cpp_vector[int] int_vec_t
 ctypedef cpp_pair[int, int] get_val_result
@@ -112,6 +112,7 @@ cdef extern from "graph_objects.hpp" nogil:
         DiGraph() nogil
 
         int addNode()
+        void clear() nogil
         int hasEdge(int, int)
         void addEdge(int, int, int)
         int weight(int, int)
@@ -163,7 +164,7 @@ cdef extern from "graph_objects.hpp":
         int weight(int, int)
         void neighbors(int, cpp_vector[int]&)
         void removeNode(int)
-        void connectedComponents(char*, bint, cpp_vector[int]&)
+        void connectedComponents(char*, bint, cpp_vector[int]&, cpp_vector[int64_t]&)
         int showSize()
 
 
@@ -178,7 +179,7 @@ cdef class Py_SimpleGraph:
     cpdef int weight(self, int u, int v)
     cdef void neighbors(self, int u, cpp_vector[int]& neigh)
     cpdef void removeNode(self, int u)
-    cdef void connectedComponents(self, char* pth, bint low_mem, cpp_vector[int]& neigh)
+    cdef void connectedComponents(self, char* pth, bint low_mem, cpp_vector[int]& components, cpp_vector[int64_t]& offsets)
     cpdef int showSize(self)
 
 
@@ -3,9 +3,12 @@
 import click
 import numpy as np
 cimport numpy as np
+import pandas as pd
 import cython
 import time
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 from libcpp.vector cimport vector as cpp_vector
 from libcpp.pair cimport pair as cpp_pair
 
@@ -15,7 +18,7 @@ from libc.math cimport fabs as c_fabs
 # from pysam.libcalignmentfile cimport AlignmentFile
 # from pysam.libcalignedsegment cimport AlignedSegment
 # from pysam.libchtslib cimport bam1_t, BAM_CIGAR_SHIFT, BAM_CIGAR_MASK
-from libc.stdint cimport uint32_t, uint16_t, int16_t, int32_t
+from libc.stdint cimport uint32_t, uint16_t, int16_t, int32_t, int64_t
 
 import math
 
@@ -37,6 +40,31 @@ def timeit(method):
     return timed
 
 
+_pools = {}
+
+
+def thread_pool(int threads):
+    """Thread pool with this many workers, made once per process and shared by every caller"""
+    key = (os.getpid(), threads)
+    if key not in _pools:
+        _pools[key] = ThreadPoolExecutor(max_workers=threads)
+    return _pools[key]
+
+
+def run_chunked(fn, args, int n, int threads, int min_n=1000):
+    """Call fn(*args, start, end) over [0, n), split into one contiguous chunk per thread of thread_pool(threads).
+    fn should release the GIL. Runs in the calling thread when threads <= 1 or n < min_n. Must not be called from
+    a task of the same pool"""
+    if threads <= 1 or n < min_n:
+        fn(*args, 0, n)
+        return
+    cdef int step = (n + threads - 1) // threads
+    pool = thread_pool(threads)
+    jobs = [pool.submit(fn, *args, i, min(n, i + step)) for i in range(0, n, step)]
+    for j in jobs:
+        j.result()
+
+
 def merge_intervals(intervals, srt=True, pad=0, add_indexes=False):
     """
     Merge a list of intervals, the expected format is a 3-tuple e.g. (chromosome, start, end). If add_indexes is
@@ -170,8 +198,8 @@ cdef class Py_SimpleGraph:
         self.thisptr.neighbors(u, neigh)
     cpdef void removeNode(self, int u):
         self.thisptr.removeNode(u)
-    cdef void connectedComponents(self, char* pth, bint low_mem, cpp_vector[int]& components):
-        self.thisptr.connectedComponents(pth, low_mem, components)
+    cdef void connectedComponents(self, char* pth, bint low_mem, cpp_vector[int]& components, cpp_vector[int64_t]& offsets):
+        self.thisptr.connectedComponents(pth, low_mem, components, offsets)
     cpdef int showSize(self):
         return self.thisptr.showSize()
 
@@ -404,6 +432,161 @@ def from_dict(self, d):
     return self
 
 
+# EventResult fields grouped by storage type, following the cdef public declarations in map_set_utils.pxd
+EVENT_INT32_FIELDS = ("contig_ref_start", "contig_ref_end", "contig2_ref_start", "contig2_ref_end", "contig_lc", "contig_rc",
+                      "contig2_lc", "contig2_rc", "grp_id", "event_id", "n_expansion", "stride", "ref_poly_bases",
+                      "su", "pe", "supp", "sc", "NP", "maxASsupp", "plus", "minus", "spanning", "double_clips",
+                      "n_unmapped_mates", "n_small_tlen", "bnd", "ras", "fas", "cipos95A", "cipos95B",
+                      "posA", "posB", "svlen", "query_gap", "query_overlap", "block_edge", "ref_bases", "remap_score",
+                      "bad_clip_count", "remap_ed", "n_in_grp")
+EVENT_FLOAT32_FIELDS = ("contig_left_weight", "contig_right_weight", "contig2_left_weight", "contig2_right_weight", "ref_rep",
+                        "compress", "NMpri", "NMsupp", "MAPQpri", "MAPQsupp", "NMbase", "n_sa", "n_xa", "n_gaps",
+                        "jitter", "sqc", "scw", "clip_qual_ratio", "outer_cn", "inner_cn", "fcc", "rep", "rep_sc", "gc",
+                        "neigh", "neigh10kb", "raw_reads_10kb", "mcov", "strand_binom_t")
+EVENT_BOOL_FIELDS = ("preciseA", "preciseB", "linked", "modified", "remapped")
+EVENT_INT8_FIELDS = ("svlen_precise",)
+EVENT_OBJECT_FIELDS = ("contig", "contig2", "svtype", "join_type", "chrA", "chrB", "exp_seq", "sample", "type",
+                       "partners", "GQ", "GT", "kind", "ref_seq", "variant_seq", "left_ins_seq", "right_ins_seq", "site_info")
+EVENT_FIELDS = tuple(sorted(EVENT_INT32_FIELDS + EVENT_FLOAT32_FIELDS + EVENT_BOOL_FIELDS + EVENT_INT8_FIELDS +
+                           EVENT_OBJECT_FIELDS))  # column order of to_dict, which follows dir()
+_EVENT_TYPED_FIELDS = ((EVENT_INT32_FIELDS, np.int32), (EVENT_FLOAT32_FIELDS, np.float32),
+                       (EVENT_BOOL_FIELDS, np.bool_), (EVENT_INT8_FIELDS, np.int8))
+
+
+def events_to_columns(events):
+    """Columnar encoding of a list of EventResult, one typed numpy array per numeric field and a list per object
+    field. Numeric fields are copied from each event in C, in the order of the EVENT_*_FIELDS tuples; only object
+    fields go through Python attribute access. Used to send batches of calls between processes and to build the
+    output DataFrame"""
+    cdef EventResult e
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t n = len(events)
+    i32_arr = np.empty((len(EVENT_INT32_FIELDS), n), dtype=np.int32)
+    f32_arr = np.empty((len(EVENT_FLOAT32_FIELDS), n), dtype=np.float32)
+    b_arr = np.empty((len(EVENT_BOOL_FIELDS), n), dtype=np.bool_)
+    i8_arr = np.empty(n, dtype=np.int8)
+    cdef int32_t[:, ::1] i32 = i32_arr
+    cdef np.float32_t[:, ::1] f32 = f32_arr
+    cdef np.uint8_t[:, ::1] b = b_arr.view(np.uint8)
+    cdef int8_t[::1] i8 = i8_arr
+    for i in range(n):
+        e = events[i]
+        i32[0, i] = e.contig_ref_start
+        i32[1, i] = e.contig_ref_end
+        i32[2, i] = e.contig2_ref_start
+        i32[3, i] = e.contig2_ref_end
+        i32[4, i] = e.contig_lc
+        i32[5, i] = e.contig_rc
+        i32[6, i] = e.contig2_lc
+        i32[7, i] = e.contig2_rc
+        i32[8, i] = e.grp_id
+        i32[9, i] = e.event_id
+        i32[10, i] = e.n_expansion
+        i32[11, i] = e.stride
+        i32[12, i] = e.ref_poly_bases
+        i32[13, i] = e.su
+        i32[14, i] = e.pe
+        i32[15, i] = e.supp
+        i32[16, i] = e.sc
+        i32[17, i] = e.NP
+        i32[18, i] = e.maxASsupp
+        i32[19, i] = e.plus
+        i32[20, i] = e.minus
+        i32[21, i] = e.spanning
+        i32[22, i] = e.double_clips
+        i32[23, i] = e.n_unmapped_mates
+        i32[24, i] = e.n_small_tlen
+        i32[25, i] = e.bnd
+        i32[26, i] = e.ras
+        i32[27, i] = e.fas
+        i32[28, i] = e.cipos95A
+        i32[29, i] = e.cipos95B
+        i32[30, i] = e.posA
+        i32[31, i] = e.posB
+        i32[32, i] = e.svlen
+        i32[33, i] = e.query_gap
+        i32[34, i] = e.query_overlap
+        i32[35, i] = e.block_edge
+        i32[36, i] = e.ref_bases
+        i32[37, i] = e.remap_score
+        i32[38, i] = e.bad_clip_count
+        i32[39, i] = e.remap_ed
+        i32[40, i] = e.n_in_grp
+        f32[0, i] = e.contig_left_weight
+        f32[1, i] = e.contig_right_weight
+        f32[2, i] = e.contig2_left_weight
+        f32[3, i] = e.contig2_right_weight
+        f32[4, i] = e.ref_rep
+        f32[5, i] = e.compress
+        f32[6, i] = e.NMpri
+        f32[7, i] = e.NMsupp
+        f32[8, i] = e.MAPQpri
+        f32[9, i] = e.MAPQsupp
+        f32[10, i] = e.NMbase
+        f32[11, i] = e.n_sa
+        f32[12, i] = e.n_xa
+        f32[13, i] = e.n_gaps
+        f32[14, i] = e.jitter
+        f32[15, i] = e.sqc
+        f32[16, i] = e.scw
+        f32[17, i] = e.clip_qual_ratio
+        f32[18, i] = e.outer_cn
+        f32[19, i] = e.inner_cn
+        f32[20, i] = e.fcc
+        f32[21, i] = e.rep
+        f32[22, i] = e.rep_sc
+        f32[23, i] = e.gc
+        f32[24, i] = e.neigh
+        f32[25, i] = e.neigh10kb
+        f32[26, i] = e.raw_reads_10kb
+        f32[27, i] = e.mcov
+        f32[28, i] = e.strand_binom_t
+        b[0, i] = e.preciseA
+        b[1, i] = e.preciseB
+        b[2, i] = e.linked
+        b[3, i] = e.modified
+        b[4, i] = e.remapped
+        i8[i] = e.svlen_precise
+    cols = {}
+    for arr, names in ((i32_arr, EVENT_INT32_FIELDS), (f32_arr, EVENT_FLOAT32_FIELDS), (b_arr, EVENT_BOOL_FIELDS)):
+        for j in range(len(names)):
+            cols[names[j]] = arr[j]
+    cols[EVENT_INT8_FIELDS[0]] = i8_arr
+    for name in EVENT_OBJECT_FIELDS:
+        cols[name] = [getattr(item, name) for item in events]
+    return cols
+
+
+def events_to_frame(events, exclude=()):
+    """DataFrame of a list of EventResult with one column per field, the same frame as
+    pd.DataFrame.from_records([to_dict(e) for e in events]) but built from events_to_columns"""
+    cols = events_to_columns(events)
+    data = {}
+    for name in EVENT_FIELDS:
+        if name in exclude:
+            continue
+        v = cols[name]
+        if isinstance(v, np.ndarray) and v.dtype != np.bool_:
+            v = v.astype(np.float64 if v.dtype == np.float32 else np.int64)
+        data[name] = v
+    return pd.DataFrame(data)
+
+
+def events_from_columns(cols):
+    """Inverse of events_to_columns"""
+    cdef int i
+    cdef int n = len(cols["svtype"])
+    events = [EventResult() for i in range(n)]
+    for names, _ in _EVENT_TYPED_FIELDS:
+        for name in names:
+            for e, v in zip(events, cols[name].tolist()):
+                setattr(e, name, v)
+    for name in EVENT_OBJECT_FIELDS:
+        for e, v in zip(events, cols[name]):
+            setattr(e, name, v)
+    return events
+
+
 @cython.auto_pickle(True)
 cdef class EventResult:
     """Data holder for classifying alignments into SV types"""
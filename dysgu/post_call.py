@@ -3,87 +3,156 @@ import numpy as np
 from dysgu.map_set_utils import echo
 from dysgu import re_map
 from dysgu.io_funcs import reverse_complement, intersecter
-from dysgu.assembler import compute_rep
-import zlib
+from dysgu.assembler import compute_rep_batch
+from dysgu.coverage import CoveragePyramid, median_batch
+from collections import defaultdict
+from itertools import accumulate
 import math
 import pickle
 import glob
 import gzip
+from scipy.special import gammaln
 import pandas as pd
-import warnings
 pd.options.mode.chained_assignment = None
-from dysgu.scikitbio._ssw_wrapper import StripedSmithWaterman
+from dysgu.scikitbio._ssw_wrapper import align_batch
+from dysgu.tree_ensemble import TreeEnsemble
 import os
 
 
 def get_badclip_metric(events, bad_clip_counter, bam, regions):
     bad_clip_counter.sort_arrays()
-    for e in events:
-        count = 0
+    queries = []
+    targets = []
+    owners = []
+    clip_events = []
+    q_tids = []
+    q_starts = []
+    q_ends = []
+    for count, e in enumerate(events):
         if e.chrA == e.chrB and abs(e.posB - e.posA) < 500:
-            start = min(e.posA, e.posB) - 500
-            end = max(e.posA, e.posB) + 500
             if not intersecter(regions, e.chrA, e.posA, e.posA + 1) and \
                 not intersecter(regions, e.chrB, e.posB, e.posB + 1):
-                count = bad_clip_counter.count_near(bam.gettid(e.chrA), start, end)
+                clip_events.append(count)
+                q_tids.append(bam.gettid(e.chrA))
+                q_starts.append(min(e.posA, e.posB) - 500)
+                q_ends.append(max(e.posA, e.posB) + 500)
         else:
-            c1, c2 = 0, 0
             if not intersecter(regions, e.chrA, e.posA, e.posA + 1):
-                c1 = bad_clip_counter.count_near(bam.gettid(e.chrA), e.posA - 500, e.posA + 500)
+                clip_events.append(count)
+                q_tids.append(bam.gettid(e.chrA))
+                q_starts.append(e.posA - 500)
+                q_ends.append(e.posA + 500)
             if not intersecter(regions, e.chrB, e.posB, e.posB + 1):
-                c2 = bad_clip_counter.count_near(bam.gettid(e.chrB), e.posB - 500, e.posB + 500)
-            count = c1 + c2
-        e.bad_clip_count = count
+                clip_events.append(count)
+                q_tids.append(bam.gettid(e.chrB))
+                q_starts.append(e.posB - 500)
+                q_ends.append(e.posB + 500)
         e.ras = 0
         e.fas = 0
         if e.spanning > 0:
             continue
 
-        max_score_rev = 0
-        max_score_forward = 0
-        if e.contig and len(e.contig) < 1000:
-            clip_res = re_map.get_clipped_seq(e.contig, e.posA, e.contig_ref_start, e.contig_ref_end)
-            if clip_res:
-                fc = clip_res[0]
-                rc = reverse_complement(fc, len(fc))
-                query = StripedSmithWaterman(e.contig, gap_extend_penalty=1, suppress_sequences=True)
-                align = query(rc)
-                if align.optimal_alignment_score > max_score_rev:
-                    max_score_rev = align.optimal_alignment_score
-                align = query(fc)
-                if align.optimal_alignment_score > max_score_forward:
-                    max_score_forward = align.optimal_alignment_score
-
-        if e.contig2 and len(e.contig2) < 1000:
-            clip_res = re_map.get_clipped_seq(e.contig2, e.posB, e.contig2_ref_start, e.contig2_ref_end)
-            if clip_res:
-                fc = clip_res[0]
-                rc = reverse_complement(fc, len(fc))
-                query = StripedSmithWaterman(e.contig2, gap_extend_penalty=1, suppress_sequences=True)
-                align = query(rc)
-                if align.optimal_alignment_score > max_score_rev:
-                    max_score_rev = align.optimal_alignment_score
-                align = query(fc)
-                if align.optimal_alignment_score > max_score_forward:
-                    max_score_forward = align.optimal_alignment_score
-
-        e.ras = max_score_rev
-        e.fas = max_score_forward
+        # align the reverse complement and forward soft-clip back to its own contig, batched below
+        for contig, pos, ref_start, ref_end in ((e.contig, e.posA, e.contig_ref_start, e.contig_ref_end),
+                                                (e.contig2, e.posB, e.contig2_ref_start, e.contig2_ref_end)):
+            if contig and len(contig) < 1000:
+                clip_res = re_map.get_clipped_seq(contig, pos, ref_start, ref_end)
+                if clip_res:
+                    fc = clip_res[0]
+                    queries.append(contig)
+                    targets += [reverse_complement(fc, len(fc)), fc]
+                    owners.append(e)
+
+    near = bad_clip_counter.count_near_batch(q_tids, q_starts, q_ends)
+    clip_counts = np.bincount(np.asarray(clip_events, dtype=np.int64), weights=near, minlength=len(events))
+    for e, count in zip(events, clip_counts.astype(np.int64).tolist()):
+        e.bad_clip_count = count
+
+    if queries:
+        scores = align_batch(queries, targets, np.repeat(np.arange(len(queries)), 2),
+                             gap_extend_penalty=1)["optimal_alignment_score"]
+        for e, rev, fwd in zip(owners, scores[0::2].tolist(), scores[1::2].tolist()):
+            if rev > e.ras:
+                e.ras = rev
+            if fwd > e.fas:
+                e.fas = fwd
 
     return events
 
 
+class CoverageTracks(object):
+    """Chromosome coverage arrays from a working directory, keyed by chromosome name. Tracks are memory-mapped
+    on first access, and summary statistics are read from the .stats file written alongside each track"""
+    def __init__(self, temp_dir):
+        self.paths = {}
+        self.arrays = {}
+        self.pyramids = {}
+        self.stats = {}
+        for pth in glob.glob(temp_dir + "/*.dysgu_chrom.bin"):
+            chrom_name = pth.split("/")[-1].split(".")[0]
+            self.paths[chrom_name] = pth
+
+    def __contains__(self, chrom):
+        return chrom in self.paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __getitem__(self, chrom):
+        if chrom not in self.arrays:
+            pth = self.paths[chrom]
+            if os.path.getsize(pth) == 0:
+                self.arrays[chrom] = np.zeros(0, dtype="int16")
+            else:
+                # copy-on-write so the array can back a writable memoryview, pages are only read when touched
+                self.arrays[chrom] = np.memmap(pth, dtype="int16", mode="c")
+        return self.arrays[chrom]
+
+    def pyramid(self, chrom):
+        if chrom not in self.pyramids:
+            self.pyramids[chrom] = CoveragePyramid(self[chrom])
+        return self.pyramids[chrom]
+
+    def window_medians(self, windows):
+        """Median coverage of a list of (chrom, start, end) windows, -1 for empty windows. One vectorised call is
+        made per chromosome"""
+        result = np.full(len(windows), -1, dtype=np.float64)
+        by_chrom = defaultdict(list)
+        for i, w in enumerate(windows):
+            by_chrom[w[0]].append(i)
+        for chrom, idxs in by_chrom.items():
+            result[idxs] = median_batch(self[chrom], [windows[i][1] for i in idxs], [windows[i][2] for i in idxs])
+        return result
+
+    def median(self, chrom):
+        """Median of the non-zero coverage bins"""
+        if chrom not in self.stats:
+            stats = {}
+            stats_pth = self.paths[chrom] + ".stats"
+            if os.path.exists(stats_pth):
+                with open(stats_pth, "r") as f:
+                    for line in f:
+                        k, v = line.split("\t")
+                        stats[k] = float(v)
+            if "median" not in stats:  # track written by an older version
+                v = self[chrom]
+                stats["median"] = np.median(v[v > 0])
+            self.stats[chrom] = stats
+        return self.stats[chrom]["median"]
+
+
 class CoverageAnalyser(object):
     def __init__(self, temp_dir):
         self.pad_size = 1000
         self.temp_dir = temp_dir
         self.chrom_cov_arrays = {}
         if os.path.exists(self.temp_dir):
-            for pth in glob.glob(self.temp_dir + "/*.dysgu_chrom.bin"):
-                chrom_name = pth.split("/")[-1].split(".")[0]
-                self.chrom_cov_arrays[chrom_name] = np.fromfile(pth, dtype="int16")
+            self.chrom_cov_arrays = CoverageTracks(self.temp_dir)
             if self.chrom_cov_arrays:
-                logging.info("Loaded n={} chromosome coverage arrays from {}".format(len(self.chrom_cov_arrays), self.temp_dir))
+                logging.info("Found n={} chromosome coverage arrays in {}".format(len(self.chrom_cov_arrays), self.temp_dir))
         else:
             logging.warning("Coverage track not loaded, working directory does not exist {}".format(self.temp_dir))
 
@@ -92,36 +161,63 @@ class CoverageAnalyser(object):
             e.fcc = -1
             e.inner_cn = -1
             e.outer_cn = -1
-        for e in events:
-            if e.svtype == "DEL" or e.svtype == "DUP" or e.svtype == "INV":
-                if e.svlen > 2000 or abs(e.posB - e.posA) > 2000:
-                    self.process_two_windows(e)
-                else:
-                    self.process_one_window(e)
-            elif e.svtype == "INS":
-                self.process_insertion(e)
+        if not self.chrom_cov_arrays:
+            return events
+        plans = [self.event_windows(e) for e in events]
+        medians = self.chrom_cov_arrays.window_medians([w for kind, windows in plans if kind for w in windows])
+        medians = medians.tolist()
+        i = 0
+        for e, (kind, windows) in zip(events, plans):
+            if not kind:
+                continue
+            m = medians[i:i + len(windows)]
+            i += len(windows)
+            if kind == "one":
+                self.process_one_window(e, *m)
+            elif kind == "two":
+                self.process_two_windows(e, *m)
             else:
-                self.process_two_windows(e)
+                self.process_insertion(e, *m)
         return events
 
-    def process_one_window(self, e):
-        start, end = e.posA, e.posB
-        if end < start:
-            s = start
-            start = end
-            end = s
-        if self.chrom_cov_arrays:
-            if e.chrA in self.chrom_cov_arrays:
-                arr = self.chrom_cov_arrays[e.chrA]
-                starting_pos = 0
+    def event_windows(self, e):
+        """The copy-number estimate used for an event and the (chrom, start, end) windows it needs the median
+        coverage of, or (None, None) if the event gets no estimate"""
+        if e.svtype == "DEL" or e.svtype == "DUP" or e.svtype == "INV":
+            if e.svlen > 2000 or abs(e.posB - e.posA) > 2000:
+                kind = "two"
             else:
-                return -1
+                kind = "one"
+        elif e.svtype == "INS":
+            kind = "ins"
         else:
-            return -1
+            kind = "two"
+        pad_size = self.pad_size
+
+        if kind == "one":
+            if e.chrA not in self.chrom_cov_arrays:
+                return None, None
+            start, end = e.posA, e.posB
+            if end < start:
+                start, end = end, start
+            return kind, [(e.chrA, start - pad_size, start), (e.chrA, end, end + pad_size), (e.chrA, start, end)]
+
+        if kind == "two":
+            if e.chrA not in self.chrom_cov_arrays or e.chrB not in self.chrom_cov_arrays:
+                return None, None
+            start, end = e.posA, e.posB
+            if e.chrA == e.chrB and end < start:
+                start, end = end, start
+            return kind, [(e.chrA, start - pad_size, start), (e.chrA, start, start + pad_size),
+                          (e.chrB, end - pad_size, end), (e.chrB, end, end + pad_size)]
+
+        if e.svlen > 10000 or e.chrA not in self.chrom_cov_arrays:
+            return None, None
+        pad = e.svlen if e.svlen_precise else 100
+        return kind, [(e.chrA, e.posA - pad_size, e.posA), (e.chrA, e.posA - pad, e.posA),
+                      (e.chrA, e.posA, e.posA + pad_size), (e.chrA, e.posA, e.posA + pad)]
 
-        left = median(arr, start - starting_pos - self.pad_size, start - starting_pos)
-        right = median(arr, end - starting_pos, end - starting_pos + self.pad_size)
-        middle = median(arr, start - starting_pos, end - starting_pos)
+    def process_one_window(self, e, left, right, middle):
         if left == -1 or right == -1 or middle == -1:
             return -1
 
@@ -143,28 +239,7 @@ class CoverageAnalyser(object):
             e.inner_cn = sides
         e.fcc = fc
 
-    def process_two_windows(self, e):
-        start, end = e.posA, e.posB
-        if e.chrA == e.chrB and end < start:
-            s = start
-            start = end
-            end = s
-        if self.chrom_cov_arrays:
-            try:
-                arr1 = self.chrom_cov_arrays[e.chrA]
-                if e.chrA == e.chrB:
-                    arr2 = arr1
-                else:
-                    arr2 = self.chrom_cov_arrays[e.chrB]
-            except KeyError:
-                return -1
-        else:
-            return -1
-
-        left1 = median(arr1, start - self.pad_size, start)
-        right1 = median(arr1, start, start + self.pad_size)
-        left2 = median(arr2, end - self.pad_size, end)
-        right2 = median(arr2, end, end + self.pad_size)
+    def process_two_windows(self, e, left1, right1, left2, right2):
         if left1 == -1 or left2 == -1 or right1 == -1 or right2 == -1:
             return -1
 
@@ -203,26 +278,7 @@ class CoverageAnalyser(object):
 
         e.fcc = fc
 
-    def process_insertion(self, e):
-        if e.svlen > 10000:
-            return -1
-
-        if self.chrom_cov_arrays:
-            if e.chrA in self.chrom_cov_arrays:
-                arr = self.chrom_cov_arrays[e.chrA]
-                starting_pos = 0
-            else:
-                return -1
-        else:
-            return -1
-
-        pad = e.svlen if e.svlen_precise else 100
-
-        left = median(arr, e.posA - starting_pos - self.pad_size, e.posA - starting_pos)
-        left_svlen = median(arr, e.posA - pad - starting_pos, e.posA - starting_pos)
-        right = median(arr, e.posA - starting_pos, e.posA - starting_pos + self.pad_size)
-        right_svlen = median(arr, e.posA - starting_pos, e.posA - starting_pos + pad)
-
+    def process_insertion(self, e, left, left_svlen, right, right_svlen):
         fcc = -1
         inner = 1
         outer = 1
@@ -239,33 +295,32 @@ class CoverageAnalyser(object):
         e.inner_cn = inner
         e.fcc = fcc
 
-    def _get_cov(self, cn, chrom_a, chrom_b, chrom_medians):
+    def _get_cov(self, cn, chrom_a, chrom_b):
+        median_a = self.chrom_cov_arrays.median(chrom_a)
         if chrom_a == chrom_b:
-            if chrom_medians[chrom_a]:
-                m = cn / chrom_medians[chrom_a]
+            if median_a:
+                m = cn / median_a
             else:
                 m = -1
-                logging.warning("Chromosome median {}: {}".format(chrom_a, chrom_medians[chrom_a]))
+                logging.warning("Chromosome median {}: {}".format(chrom_a, median_a))
         else:
-            m1 = chrom_medians[chrom_a]
-            m2 = chrom_medians[chrom_b]
+            m1 = median_a
+            m2 = self.chrom_cov_arrays.median(chrom_b)
             if m1 and m2:
                 m = cn / ((m1 + m2) / 2)
             else:
                 m = 0
-                logging.warning("Chromosome median {}: {}, {}: {}".format(chrom_a, chrom_medians[chrom_a],
-                                                                          chrom_b, chrom_medians[chrom_b]))
+                logging.warning("Chromosome median {}: {}, {}: {}".format(chrom_a, m1, chrom_b, m2))
         return m
 
     def normalize_coverage_values(self, events):
         if not self.chrom_cov_arrays:
             return events
-        chrom_medians = {k: np.median(v[v > 0]) for k, v in self.chrom_cov_arrays.items()}
         for e in events:
             if e.outer_cn > 0:
-                e.outer_cn = self._get_cov(e.outer_cn, e.chrA, e.chrB, chrom_medians)
+                e.outer_cn = self._get_cov(e.outer_cn, e.chrA, e.chrB)
             if e.inner_cn > 0:
-                e.inner_cn = self._get_cov(e.inner_cn, e.chrA, e.chrB, chrom_medians)
+                e.inner_cn = self._get_cov(e.inner_cn, e.chrA, e.chrB)
         return events
 
 
@@ -281,6 +336,8 @@ def filter_auto_min_support(events):
 
 
 def ref_repetitiveness(events, ref_genome):
+    targets = []
+    seqs = []
     for e in events:
         e.ref_rep = 0
         if e.svlen < 150 and e.svtype == "DEL":
@@ -288,58 +345,47 @@ def ref_repetitiveness(events, ref_genome):
                 ref_seq = ref_genome.fetch(e.chrA, e.posA, e.posB).upper()
             except ValueError:  # todo out or range, needs fixing
                 continue
-            e.ref_rep = compute_rep(ref_seq)
+            targets.append(e)
+            seqs.append(ref_seq)
+    for e, rep in zip(targets, compute_rep_batch(seqs)):
+        e.ref_rep = rep
     return events
 
 
-def median(arr, start, end):
-    s = int(start / 10)
-    e = int(end / 10)
-    if s > e:
-        s1 = s
-        s = e
-        e = s1
-    if s < 1:
-        s = 1
-    if e > len(arr):
-        e = len(arr)
-    if e > s:
-        # m = np.mean(arr[s:e])
-        # if m == m:
-        #     return m
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=RuntimeWarning)
-            m = np.median(arr[s:e])
-            if m == m:
-                return m
-    return -1
-
-
-def nCk(n,k):
-    f = math.factorial
-    return f(n) // f(k) // f(n-k)
-
-
-def binom_prob(n, k, p):
-    # If n is > 1000, set it to 1000 so our Factorial doesn't blow up
-    n = n if n <= 1000 else 1000
-    binom = 0
-    q = 1-p
-    while k < n:
-        binom += nCk(n, k) * q**(n-k) * p**k
-        k += 1
-    return binom
+STRAND_BINOM_MAX_N = 1000  # read counts are capped before the strand bias test
+_strand_tail = np.zeros((1, 2))
+
+
+def strand_tail_table(max_n):
+    """Table of binomial(n, 0.5) tail probabilities, T[n, k] = sum of P(X = j) for k <= j < n. Tails are summed
+    over exact binomial coefficients so each entry is correctly rounded. The table is extended as larger n are
+    needed"""
+    global _strand_tail
+    if max_n >= len(_strand_tail):
+        max_n = max(max_n, min(2 * len(_strand_tail), STRAND_BINOM_MAX_N))
+        table = np.zeros((max_n + 1, max_n + 2))
+        row = [1]
+        for n in range(1, max_n + 1):
+            row = [1] + [row[i] + row[i + 1] for i in range(n - 1)] + [1]
+            tails = list(accumulate(reversed(row[:n])))[::-1]
+            table[n, :n] = np.ldexp([float(i) for i in tails], -n)
+        _strand_tail = table
+    return _strand_tail
+
+
+def strand_binom(plus, minus):
+    """Binomial test for strand bias over arrays of plus and minus strand read counts"""
+    k = np.maximum(plus, minus)
+    n = np.minimum(plus + minus, STRAND_BINOM_MAX_N)
+    table = strand_tail_table(int(n.max()) if len(n) else 0)
+    return np.where(k > 0, table[n, np.minimum(k, n)], 1)
 
 
 def strand_binom_t(events):
     # perform a binomial test for strand bias
-    for e in events:
-        k = max(e.plus, e.minus)
-        if k > 0:
-            n = e.plus + e.minus
-            e.strand_binom_t = binom_prob(n, k, 0.5)
-        else:
-            e.strand_binom_t = 1
+    plus, minus = event_arrays(events, ("plus", "minus"), np.int64)
+    for e, p in zip(events, strand_binom(plus, minus).tolist()):
+        e.strand_binom_t = p
     return events
 
 
@@ -375,6 +421,22 @@ def get_ref_base(events, ref_genome, symbolic_sv_size):
     return events
 
 
+def reference_spans(events, symbolic_sv_size):
+    """The (chrom, start, end) windows fetched by ref_repetitiveness and get_ref_base"""
+    spans = []
+    for e in events:
+        posA = max(e.posA, 1)
+        if e.svlen < 150 and e.svtype == "DEL":
+            spans.append((e.chrA, e.posA, e.posB))
+        if e.ref_seq:
+            continue
+        if symbolic_sv_size != -1 and e.svtype != "INS" and e.svtype != "TRA" and e.svlen < symbolic_sv_size:
+            spans.append((e.chrA, posA, e.posB))
+        else:
+            spans.append((e.chrA, posA - 1, posA))
+    return spans
+
+
 # from svtyper with minor modifications
 # https://github.com/hall-lab/svtyper/blob/master/svtyper/singlesample.py
 # efficient combinatorial function to handle extremely large numbers
@@ -461,148 +523,97 @@ def get_gt_metric(events, add_gt=False):
     return events
 
 
-def del_like(r):
-    ocn = r.outer_cn
-    icn = r.inner_cn
-    lower_cn = min(ocn, icn)
-    t = None
-    if r.inner_cn > r.outer_cn * 1.25:
-        try:
-            t = ((r.inner_cn - r.outer_cn) / (r.inner_cn + r.outer_cn)) * r.outer_cn
-        except ZeroDivisionError:
-            t = None
-
-    if bool(r.contig) ^ bool(r.contig2):
-        m = 2. * (r.sc + r.bnd - r.supp)
+# Probability of an alt read for het and hom-alt genotypes
+GT_P_ALT = {"DEL": (0.5, 0.9), "TRA": (0.5, 0.9), "INS": (0.4, 0.9), "INV": (0.4, 0.9), "BND": (0.4, 0.9),
+            "DUP": (0.6, 0.2)}  # duplications are non-destructive
+GT_LOG_P = {k: (math.log(a, 10), math.log(1 - a, 10), math.log(b, 10), math.log(1 - b, 10)) for k, (a, b) in GT_P_ALT.items()}
+
+
+def event_arrays(events, names, dtype):
+    return [np.fromiter((getattr(e, k) for e in events), dtype=dtype, count=len(events)) for k in names]
+
+
+def support_counts(events, mode):
+    """Reference and variant read counts used for genotyping each event. Deletion-like events use the
+    copy-number and read support of the call, other events are counted from insertion-like support"""
+    outer_cn, inner_cn = event_arrays(events, ("outer_cn", "inner_cn"), np.float64)
+    su, pe, spanning, supp, sc, bnd, remap_score, NP = event_arrays(events, ("su", "pe", "spanning", "supp", "sc", "bnd",
+                                                                               "remap_score", "NP"), np.int64)
+    one_contig = np.array([bool(e.contig) ^ bool(e.contig2) for e in events], dtype=bool)
+    del_like = np.isin([e.svtype for e in events], ("DEL", "TRA"))
+    lower_cn = np.minimum(outer_cn, inner_cn)
+    higher_cn = np.maximum(outer_cn, inner_cn)
+    clip_excess = sc + bnd - supp
+    m = np.where(one_contig, 2. * clip_excess, clip_excess)
+    mr = np.maximum(lower_cn - m, 0)
+    pe_like = (pe > 0) | (spanning > 0)
+    pe_supp = pe + spanning * 0.5
+    cn_sum = inner_cn + outer_cn
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = ((inner_cn - outer_cn) / cn_sum) * outer_cn
+        cn_ratio = np.where(outer_cn > 0, inner_cn / outer_cn, 2)
+
+    # deletion-like
+    t_del = np.where((inner_cn > outer_cn * 1.25) & (cn_sum != 0), t, mr)
+    remap_supp = np.where(bnd == 0, np.maximum(sc, supp), np.where(one_contig, 2.5, 3.5) * clip_excess)
+    conds = [pe_like, remap_score > 0, supp > 0, NP > 0, (inner_cn != -1) & (inner_cn < su),
+             (outer_cn != -1) & (inner_cn != -1)]
+    ref_del = np.select(conds, [lower_cn, lower_cn, t_del, lower_cn, inner_cn, outer_cn], 0)
+    alt_del = np.select(conds, [pe_supp, remap_supp, supp, NP * 2, su, inner_cn], 0)
+
+    if mode == "pe":
+        t_ins = np.where((cn_ratio > 1.25) & (cn_sum != 0), t, mr)
+        conds = [cn_ratio > 1.75, pe_like, remap_score > 0, supp > 0, NP > 0, inner_cn > su]
+        ref_ins = np.select(conds, [np.maximum(0, inner_cn - (2. * (inner_cn - outer_cn))), lower_cn, mr, t_ins,
+                                    lower_cn - NP * 2, inner_cn - su], 0)
+        alt_ins = np.select(conds, [su, pe_supp, m, supp, NP * 2, su], 0)
     else:
-        m = r.sc + r.bnd - r.supp
-    mr = lower_cn - m
-    mr = 0 if mr < 0 else mr
-    if r.pe > 0 or r.spanning > 0:
-        variant_supp = r.pe + r.spanning * 0.5
-        ref_supp = lower_cn
-
-    elif r.remap_score > 0:
-        if r.bnd == 0:
-            variant_supp = max(r.sc, r.supp)
-        else:
-            if bool(r.contig) ^ bool(r.contig2):
-                m = 2.5 * (r.sc + r.bnd - r.supp)
-            else:
-                m = 3.5 * (r.sc + r.bnd - r.supp)
-            variant_supp = m
-        ref_supp = lower_cn
-
-    elif r.supp > 0:
-        variant_supp = r.supp
-        if t is not None:
-            ref_supp = t
-        else:
-            ref_supp = mr
-
-    elif r.NP > 0:
-        variant_supp = r.NP * 2
-        ref_supp = lower_cn
-    elif r.inner_cn != -1 and r.inner_cn < r.su:
-        variant_supp = r.su
-        ref_supp = r.inner_cn
-    elif r.outer_cn != -1 and r.inner_cn != -1:
-        variant_supp = r.inner_cn
-        ref_supp = r.outer_cn
-    else:
-        return 0, 0
-
-    return round(ref_supp), round(variant_supp)
+        sup = su - spanning
+        alt_ins = np.maximum(np.trunc(higher_cn - lower_cn), sup)
+        ref_ins = np.maximum(np.trunc(higher_cn - sup), 0)
 
+    ref = np.rint(np.where(del_like, ref_del, ref_ins)).astype(np.int64)
+    alt = np.rint(np.where(del_like, alt_del, alt_ins)).astype(np.int64)
+    return ref, alt
 
-def ins_like(r):
-    ocn = r.outer_cn
-    icn = r.inner_cn
-    lower_cn = min(ocn, icn)
-    t = None
-    if r.outer_cn > 0:
-        cn_ratio = r.inner_cn / r.outer_cn
-    else:
-        cn_ratio = 2
 
-    if cn_ratio > 1.25:
-        try:
-            t = ((r.inner_cn - r.outer_cn) / (r.inner_cn + r.outer_cn)) * r.outer_cn
-        except ZeroDivisionError:
-            t = None
+def log_choose_array(n, k):
+    # log10 binomial coefficients, 0 where k is outside 0..n
+    valid = (k >= 0) & (k <= n) & (n > 0)
+    n = np.where(valid, n, 0)
+    k = np.where(valid, k, 0)
+    return np.where(valid, (gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)) / math.log(10), 0)
 
-    if bool(r.contig) ^ bool(r.contig2):
-        m = 2. * (r.sc + r.bnd - r.supp)
-    else:
-        m = r.sc + r.bnd - r.supp
-    mr = lower_cn - m
-    mr = 0 if mr < 0 else mr
-
-    if cn_ratio > 1.75:
-        ref_support = max(0, r.inner_cn - (2. * (r.inner_cn - r.outer_cn)))
-        variant_support = r.su
-
-    elif r.pe > 0 or r.spanning > 0:
-        variant_support = r.pe + r.spanning * 0.5
-        ref_support = lower_cn
-
-    elif r.remap_score > 0:
-        variant_support = m
-        ref_support = mr
-
-    elif r.supp > 0:
-        variant_support = r.supp
-        if t is not None:
-            ref_support = t
-        else:
-            ref_support = mr
 
-    elif r.NP > 0:
-        variant_support = r.NP * 2
-        ref_support = lower_cn - variant_support
-
-    elif r.inner_cn > r.su:
-        variant_support = r.su
-        ref_support = r.inner_cn - r.su
-    else:
-        return 0, 0
-
-    return round(ref_support), round(variant_support)
+def bayes_gt_arrays(ref, alt, svtypes):
+    """log10 likelihoods of the het and hom-alt genotypes given arrays of ref and alt read counts"""
+    coef = np.array([GT_LOG_P[s] for s in svtypes], dtype=np.float64).reshape(-1, 4)
+    log_combo = log_choose_array(ref + alt, alt)
+    lp_het = log_combo + alt * coef[:, 0] + ref * coef[:, 1]
+    lp_homalt = log_combo + alt * coef[:, 2] + ref * coef[:, 3]
+    return lp_het, lp_homalt
 
 
-def ins_like_non_pe(r):
-    ocn = r.outer_cn
-    icn = r.inner_cn
-    lower_cn = min(ocn, icn)
-    higher_cn = max(ocn, icn)
-    sup = r.su - r.spanning
-    support_reads = max(int((higher_cn - lower_cn)), sup)
-    ref = int(higher_cn - sup)
-    if ref < 0:
-        ref = 0
-    return round(ref), round(support_reads)
-
-
-def bayes_gt2(ref, alt, is_dup, a, b):
-    if is_dup:  # specialized logic to handle non-destructive events such as duplications
-        p_alt = b
-    else:
-        p_alt = a
-    total = ref + alt
-    log_combo = log_choose(total, alt)
-    lp_het = log_combo + alt * math.log(p_alt[0], 10) + ref * math.log(1 - p_alt[0], 10)
-    lp_homalt = log_combo + alt * math.log(p_alt[1], 10) + ref * math.log(1 - p_alt[1], 10)
-    return lp_het, lp_homalt
+def genotype_arrays(ref, alt, svtypes):
+    """Genotype calls for arrays of ref and alt read counts. Returns (gt, gq, called) where gt is 1 for het and 2
+    for hom-alt, gq is the phred-scaled genotype quality and called is False if no genotype could be assigned"""
+    ref = np.asarray(ref, dtype=np.int64)
+    alt = np.asarray(alt, dtype=np.int64)
+    lp_het, lp_homalt = bayes_gt_arrays(ref, alt, svtypes)
+    best = np.maximum(lp_het, lp_homalt)
+    second_best = np.minimum(lp_het, lp_homalt)
+    with np.errstate(under="ignore", over="ignore"):
+        p_het = np.power(10., lp_het)
+        p_homalt = np.power(10., lp_homalt)
+    # likelihoods that overflow are not counted, as with the scalar OverflowError handling
+    gt_sum = np.where(np.isinf(p_het), 0, p_het) + np.where(np.isinf(p_homalt), 0, p_homalt)
+    called = (ref + alt > 0) & (gt_sum > 0)
+    gq = np.minimum(-10 * (second_best - best), 200).astype(np.int64)
+    gt = np.where(lp_het >= lp_homalt, 1, 2)
+    return gt, gq, called
 
 
 def get_gt_metric2(events, mode, add_gt=True):
-    params = {"DEL,TRA": [[0.5, 0.9], [0.2, 1 / 3.0]],
-              "INS,DUP,INV,BND": [[0.4, 0.9], [0.6, 0.2]]}
-    pp = {}
-    for k, v in params.items():
-        for kk in k.split(","):
-            pp[kk] = v
-
     if add_gt:
         pass
     else:
@@ -610,70 +621,37 @@ def get_gt_metric2(events, mode, add_gt=True):
             e.GQ = '.'
             e.GT = './.'
         return events
+    if not events:
+        return events
 
-    for e in events:
-        a_params, b_params = pp[e.svtype]
-        if e.svtype == "DEL" or e.svtype == "TRA":
-            ref, support_reads = del_like(e)
+    ref, alt = support_counts(events, mode)
+    gt, gq, called = genotype_arrays(ref, alt, [e.svtype for e in events])
+    for e, g, q, c in zip(events, gt.tolist(), gq.tolist(), called.tolist()):
+        if c:
+            e.GQ = q
+            e.GT = '0/1' if g == 1 else '1/1'
         else:
-            if mode == "pe":
-                ref, support_reads = ins_like(e)
-            else:
-                ref, support_reads = ins_like_non_pe(e)
-        if ref + support_reads <= 0:
             e.GQ = '.'
             e.GT = './.'
-            continue
+    return events
 
-        gt_lplist = bayes_gt2(ref, support_reads, e.svtype == "DUP", a_params, b_params)
-        best, second_best = sorted([(i, j) for i, j in enumerate(gt_lplist)], key=lambda x: x[1], reverse=True)[0:2]
-        gt_idx = best[0]
-        gt_sum = 0
-        for gt in gt_lplist:
-            try:
-                gt_sum += 10**gt
-            except OverflowError:
-                gt_sum += 0
-        if gt_sum > 0:
-            # gt_sum_log = math.log(gt_sum, 10)
-            # sample_qual = abs(-10 * (gt_lplist[0] - gt_sum_log))  # phred-scaled probability site is non-reference in this sample
-            phred_gq = min(-10 * (second_best[1] - best[1]), 200)
-            e.GQ = int(phred_gq)
-            if gt_idx == 0:
-                e.GT = '0/1'
-            elif gt_idx == 1:
-                e.GT = '1/1'
-        else:
-            e.GQ = '.'
-            e.GT = './.'
 
-    return events
+# Model feature names mapped to EventResult fields
+MODEL_FEATURES = dict(zip(
+    ['NMS',    'SQC', 'CIPOS95',  'CIEND95',  'GC', 'REP', 'REPSC',  'SU', 'WR',       'SR',   'SC', 'NEXP',        'RPOLY',          'STRIDE', 'SVTYPE', 'SVLEN', 'NMP',   'NMB',    'MAPQP',   'MAPQS',    'NP', 'MAS',       'BE',         'COV',            'MCOV', 'NEIGH', 'NEIGH10',   'RB',        'PS',   'MS',    'NG',     'NSA',  'NXA',  'NMU',              'NDC',          'RMS',         'RED',      'BCC',            'STL',          'BND', 'SCW', 'RAS', 'FAS', 'OL',            'FCC', 'CMP',     'NG',        'RR',      'JIT',    'SBT',            'SQR'],
+    ['NMsupp', 'sqc', 'cipos95A', 'cipos95B', 'gc', 'rep', 'rep_sc', 'su', 'spanning', 'supp', 'sc', 'n_expansion', 'ref_poly_bases', 'stride', 'svtype', 'svlen', 'NMpri', 'NMbase', 'MAPQpri', 'MAPQsupp', 'NP', 'maxASsupp', 'block_edge', 'raw_reads_10kb', 'mcov', 'neigh', 'neigh10kb', 'ref_bases', 'plus', 'minus', 'n_gaps', 'n_sa', 'n_xa', 'n_unmapped_mates', 'double_clips', 'remap_score', 'remap_ed', 'bad_clip_count', 'n_small_tlen', 'bnd', 'scw', 'ras', 'fas', "query_overlap", 'fcc', 'compress', "n_in_grp", 'ref_rep', 'jitter', 'strand_binom_t', 'clip_qual_ratio']
+             ))
 
+SVTYPE_CODES = {"DEL": 1, "INS": 2, "DUP": 3, "INV": 4, "TRA": 2, "INV:DUP": 2, "BND": 4}
 
-def compressability(events):
-    for e in events:
-        c1 = []
-        if e.contig:
-            cont = e.contig.upper().encode("ascii")
-            b = bytes(cont)
-            c1.append(len(zlib.compress(b)) / len(b))
-        if e.contig2:
-            cont = e.contig2.upper().encode("ascii")
-            b = bytes(cont)
-            c1.append(len(zlib.compress(b)) / len(b))
-        if c1:
-            e.compress = round((sum(c1) / len(c1)) * 100, 2)
-        else:
-            e.compress = 0
-    return events
+_model_cache = {}  # unpickled models, keyed by path
+_scorer_cache = {}  # (path, model key) -> (compiled ensemble or None, categories)
 
 
-def apply_model(df, mode, contigs, diploid, thresholds, model_path=None):
-    if model_path is None:
-        pth = os.path.dirname(os.path.abspath(__file__))
-        pth = f"{pth}/dysgu_model.1.pkl.gz"
-    else:
-        pth = model_path
+def load_model(pth):
+    """Load a pickled model file once per process"""
+    if pth in _model_cache:
+        return _model_cache[pth]
     assert os.path.exists(pth)
     logging.info(f"Loading Model: {pth}")
     if pth.endswith(".pkl.gz"):
@@ -688,6 +666,54 @@ def apply_model(df, mode, contigs, diploid, thresholds, model_path=None):
             raise RuntimeError("Failed to load model")
     else:
         raise ValueError("Model must be pickle file with .pkl or .pkl.gz extension")
+    _model_cache[pth] = models
+    return models
+
+
+def model_scorer(pth, models, model_key, cols):
+    """Compiled tree ensemble for a classifier plus the training categories of its categorical columns. The
+    ensemble is None if the classifier cannot be compiled, in which case the LightGBM booster is used"""
+    key = (pth, model_key)
+    if key in _scorer_cache:
+        return _scorer_cache[key]
+    booster = models[model_key].booster_
+    cat_cols = [c for c in cols if c in models["cats"]]
+    categories = dict(zip(cat_cols, booster.pandas_categorical or []))
+    try:
+        ensemble = TreeEnsemble.from_booster(booster)
+    except ValueError:
+        ensemble = None
+    _scorer_cache[key] = ensemble, categories
+    return _scorer_cache[key]
+
+
+def feature_matrix(data, cols, categories):
+    """Model features as a C-contiguous float32 matrix. data is a DataFrame of event records or a sequence of
+    EventResult. Categorical columns are coded as the index of the value in the training categories, or NaN if
+    the value was not seen during training, as LightGBM does for pandas categoricals"""
+    X = np.empty((len(data), len(cols)), dtype=np.float32)
+    is_frame = isinstance(data, pd.DataFrame)
+    for j, col in enumerate(cols):
+        field = MODEL_FEATURES[col]
+        values = data[field] if is_frame else [getattr(e, field) for e in data]
+        if col == "SVTYPE":
+            values = [SVTYPE_CODES[i] for i in values]
+        elif col == "SVLEN":
+            values = [i if i == i and i is not None else -1 for i in values]
+        if col in categories:
+            codes = {v: k for k, v in enumerate(categories[col])}
+            values = [codes.get(i if i == i and i is not None else 0, np.nan) for i in values]
+        X[:, j] = values
+    return X
+
+
+def apply_model(df, mode, contigs, diploid, thresholds, model_path=None, procs=1):
+    if model_path is None:
+        pth = os.path.dirname(os.path.abspath(__file__))
+        pth = f"{pth}/dysgu_model.1.pkl.gz"
+    else:
+        pth = model_path
+    models = load_model(pth)
 
     if diploid == 'False' and contigs == 'False':
         raise NotImplemented("Choose either diploid == False or contigs == False, not both")
@@ -699,23 +725,13 @@ def apply_model(df, mode, contigs, diploid, thresholds, model_path=None):
     cols = models[col_key]
     logging.info(f"Model config: {mode}, diploid: {diploid}, contig features: {contigs}. N features: {len(cols)}")
 
-    c = dict(zip(
-        ['NMS',    'SQC', 'CIPOS95',  'CIEND95',  'GC', 'REP', 'REPSC',  'SU', 'WR',       'SR',   'SC', 'NEXP',        'RPOLY',          'STRIDE', 'SVTYPE', 'SVLEN', 'NMP',   'NMB',    'MAPQP',   'MAPQS',    'NP', 'MAS',       'BE',         'COV',            'MCOV', 'NEIGH', 'NEIGH10',   'RB',        'PS',   'MS',    'NG',     'NSA',  'NXA',  'NMU',              'NDC',          'RMS',         'RED',      'BCC',            'STL',          'BND', 'SCW', 'RAS', 'FAS', 'OL',            'FCC', 'CMP',     'NG',        'RR',      'JIT',    'SBT',            'SQR'],
-        ['NMsupp', 'sqc', 'cipos95A', 'cipos95B', 'gc', 'rep', 'rep_sc', 'su', 'spanning', 'supp', 'sc', 'n_expansion', 'ref_poly_bases', 'stride', 'svtype', 'svlen', 'NMpri', 'NMbase', 'MAPQpri', 'MAPQsupp', 'NP', 'maxASsupp', 'block_edge', 'raw_reads_10kb', 'mcov', 'neigh', 'neigh10kb', 'ref_bases', 'plus', 'minus', 'n_gaps', 'n_sa', 'n_xa', 'n_unmapped_mates', 'double_clips', 'remap_score', 'remap_ed', 'bad_clip_count', 'n_small_tlen', 'bnd', 'scw', 'ras', 'fas', "query_overlap", 'fcc', 'compress', "n_in_grp", 'ref_rep', 'jitter', 'strand_binom_t', 'clip_qual_ratio']
-                 ))
-
-    X = df[[c[i] for i in cols]]
-    X.columns = cols
-    keys = {"DEL": 1, "INS": 2, "DUP": 3, "INV": 4, "TRA": 2, "INV:DUP": 2, "BND": 4}
-
-    X["SVTYPE"] = [keys[i] for i in X["SVTYPE"]]
-    X["SVLEN"] = [i if i == i and i is not None else -1 for i in X["SVLEN"]]
-
-    for c in models["cats"]:  # categorical data
-        if c in X:
-            X[c] = [i if i == i and i is not None else 0 for i in X[c]]
-            X[c] = X[c].astype("category")
-    pred = np.round(models[model_key].predict_proba(X)[:, 1], 3)
+    ensemble, categories = model_scorer(pth, models, model_key, cols)
+    X = feature_matrix(df, cols, categories)
+    if ensemble is not None:
+        prob = ensemble.predict_proba(X, procs)
+    else:
+        prob = models[model_key].booster_.predict(X)
+    pred = np.round(prob, 3)
     df = df.assign(prob=pred)
     df = df.assign(filter=["PASS" if ((svt in thresholds and i >= thresholds[svt]) or (svt not in thresholds and i >= 0.5)) else "lowProb" for svt, i in zip(df["svtype"], pred)])
     return df
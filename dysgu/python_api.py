@@ -8,7 +8,7 @@ from collections import defaultdict
 
 from dysgu.cluster import pipe1, merge_events
 from dysgu import post_call as post_call_metrics
-from dysgu.map_set_utils import to_dict, merge_intervals
+from dysgu.map_set_utils import merge_intervals, events_to_frame
 from dysgu.io_funcs import to_vcf
 from dysgu.io_funcs import get_bed_regions as load_bed
 from dysgu.view import vcf_to_df, dotdict, set_numeric
@@ -27,7 +27,7 @@ def dysgu_default_args():
             'reference': None, 'working_directory': 'tempfile',
             'sv_aligns': None, 'ibam': None, 'sites': None, 'sites_prob': 0.6,
             'sites_pass_only': True, 'parse_probs': False, 'all_sites': False, 'pfix': 'dysgu_reads', 'mode': 'pe',
-            'spd': 0.3, 'template_size': '', 'regions': None, 'regions_mm_only': False, 'procs': 1, 'merge_within': True,
+            'spd': 0.3, 'template_size': '', 'regions': None, 'regions_mm_only': False, 'procs': 1, 'read_threads': 1, 'component_threads': 1, 'merge_within': True,
             'merge_dist': None, 'paired': True, 'contigs': True, 'diploid': True, 'metrics': True,
             'add_gt': True, 'keep_small': False, 'low_mem': False, 'clean': False, 'add_kind': True, 'verbosity': 2,
             'thresholds': {'DEL': 0.45, 'INS': 0.45, 'INV': 0.45, 'DUP': 0.45, 'TRA': 0.45},
@@ -348,7 +348,7 @@ class DysguSV:
                   "contig2_right_weight", "contig_lc", "contig_left_weight", "contig_rc", "contig_ref_end",
                   "contig_ref_start", "contig_right_weight", "modified", "preciseA",
                   "preciseB", "query_gap", "remapped", "site_info"}  # "partners",
-        df = pd.DataFrame.from_records([{k: v for k, v in to_dict(e).items() if k not in unused} for e in events])
+        df = events_to_frame(events, exclude=unused)
 
         df = self.apply_model(df)
         args = self.args
@@ -412,6 +412,7 @@ class DysguSV:
 
         """
         args = self.args
-        df = post_call_metrics.apply_model(df, args["pl"], args["contigs"], args["diploid"], args["thresholds"])
+        df = post_call_metrics.apply_model(df, args["pl"], args["contigs"], args["diploid"], args["thresholds"],
+                                           procs=args["procs"])
         return df
 
@@ -1,11 +1,16 @@
 from dysgu.scikitbio._ssw_wrapper import StripedSmithWaterman
 # from skbio.alignment import StripedSmithWaterman
-from dysgu.map_set_utils import is_overlapping, echo
+from dysgu.map_set_utils import is_overlapping, echo, events_to_columns, events_from_columns
 from dysgu.coverage import merge_intervals
 from dysgu.assembler import compute_rep
+from dysgu.io_funcs import load_gap_index
 import math
 import edlib
 import logging
+import multiprocessing
+
+
+REMAP_MIN_EVENTS = 1000  # below this soft-clips are re-aligned in-process
 
 
 def get_clipped_seq(cont, position, cont_ref_start, cont_ref_end):
@@ -345,7 +350,7 @@ def process_contig(e, cont, break_position, clip_res, gstart, ref_seq_big, idx):
     return to_add, skip_event, high_quality_clip, clip_length
 
 
-def remap_soft_clips(events, ref_genome, keep_unmapped=True, min_support=3):
+def remap_soft_clips(events, ref_genome, keep_unmapped=True, min_support=3, procs=1):
 
     new_events = []
     ref_locs = []
@@ -399,6 +404,7 @@ def remap_soft_clips(events, ref_genome, keep_unmapped=True, min_support=3):
             elif e.site_info:
                 new_events.append(e)  # keep anyway if linked to site
 
+    groups = []
     for chrom, gstart, gend, grp_idxs in merge_intervals(ref_locs, pad=1500, add_indexes=True):
         if gstart < 0:
             gstart = 0
@@ -410,58 +416,123 @@ def remap_soft_clips(events, ref_genome, keep_unmapped=True, min_support=3):
             logging.warning("Error fetching reference chromosome: {}".format(chrom), errors)
             continue
 
+        # process longest soft-clip first
+        clips = []
         for index in grp_idxs:
+            cr = [(idx, clip_results[(index, idx)]) for idx in "AB" if (index, idx) in clip_results]
+            clips.append(sorted(cr, key=lambda x: len(x[1][0]), reverse=True))
+        groups.append((gstart, ref_seq_big, grp_idxs, clips))
 
-            e = events[index]
-            to_add = False
-            high_quality_clip = False
-            skip_event = False
-            max_clip_length = 0
+    n_remap = sum(len(g[2]) for g in groups)
+    if procs > 1 and n_remap >= REMAP_MIN_EVENTS:
+        keeps = remap_groups_parallel(events, groups, keep_unmapped, min_support, procs)
+    else:
+        keeps = [remap_group([events[i] for i in grp_idxs], gstart, ref_seq_big, clips, keep_unmapped, min_support)
+                 for gstart, ref_seq_big, grp_idxs, clips in groups]
 
-            e.scw = max(e.contig_left_weight, e.contig_right_weight)
-
-            # process longest soft-clip first
-            cr = [(idx, clip_results[(index, idx)]) for idx in "AB" if (index, idx) in clip_results]
-            cr = sorted(cr, key=lambda x: len(x[1][0]), reverse=True)
-            clip_res = None
-            for idx, clip_res in cr:
-
-                to_add, skip_event, hq, clip_length = process_contig(e,
-                                                                     e.contig if idx == "A" else e.contig2,
-                                                                     e.posA if idx == "A" else e.posB, clip_res,
-                                                                     gstart, ref_seq_big, idx)
-
-                if not high_quality_clip and hq:
-                    high_quality_clip = True
-
-                if to_add:
-                    new_events.append(e)
-                    break
-                elif skip_event:
-                    break
-                if clip_length > max_clip_length:
-                    max_clip_length = clip_length
-            # echo(e.posA, e.site_info, not to_add, not skip_event, high_quality_clip, keep_unmapped, max_clip_length >= 18, e.su)
-            if not to_add and not skip_event and high_quality_clip and keep_unmapped and max_clip_length >= 18:
-                # basic filter
-                support_thresh = min_support + 4 if not e.site_info else 1
-                if e.su > support_thresh:
-                    if clip_res[1] == 0:
-                        e.left_ins_seq = clip_res[0]
-                    if clip_res[1] == 1:
-                        e.right_ins_seq = clip_res[0]
-
-                    new_events.append(e)
+    for (_, _, grp_idxs, _), group_keeps in zip(groups, keeps):
+        for index, keep in zip(grp_idxs, group_keeps):
+            if keep:
+                new_events.append(events[index])
 
     return new_events
 
 
-def drop_svs_near_reference_gaps(events, paired_end, ref_genome, drop_gaps):
+def remap_group(group_events, gstart, ref_seq_big, clips, keep_unmapped, min_support):
+    # re-align the soft-clips of events sharing a merged reference window, returns a keep flag per event
+    keeps = []
+    for e, cr in zip(group_events, clips):
+        to_add = False
+        high_quality_clip = False
+        skip_event = False
+        max_clip_length = 0
+
+        e.scw = max(e.contig_left_weight, e.contig_right_weight)
+
+        clip_res = None
+        for idx, clip_res in cr:
+
+            to_add, skip_event, hq, clip_length = process_contig(e,
+                                                                 e.contig if idx == "A" else e.contig2,
+                                                                 e.posA if idx == "A" else e.posB, clip_res,
+                                                                 gstart, ref_seq_big, idx)
+
+            if not high_quality_clip and hq:
+                high_quality_clip = True
+
+            if to_add:
+                break
+            elif skip_event:
+                break
+            if clip_length > max_clip_length:
+                max_clip_length = clip_length
+
+        keep = to_add
+        if not to_add and not skip_event and high_quality_clip and keep_unmapped and max_clip_length >= 18:
+            # basic filter
+            support_thresh = min_support + 4 if not e.site_info else 1
+            if e.su > support_thresh:
+                if clip_res[1] == 0:
+                    e.left_ins_seq = clip_res[0]
+                if clip_res[1] == 1:
+                    e.right_ins_seq = clip_res[0]
+                keep = True
+        keeps.append(keep)
+    return keeps
+
+
+def remap_batch_job(job):
+    cols, batch_groups, keep_unmapped, min_support = job
+    batch_events = events_from_columns(cols)
+    keeps = []
+    i = 0
+    for gstart, ref_seq_big, clips in batch_groups:
+        keeps.append(remap_group(batch_events[i:i + len(clips)], gstart, ref_seq_big, clips, keep_unmapped,
+                                 min_support))
+        i += len(clips)
+    return events_to_columns(batch_events), keeps
+
+
+def remap_groups_parallel(events, groups, keep_unmapped, min_support, procs):
+    """Runs remap_group over batches of window groups in a process pool. Events are sent as columns and the
+    re-aligned events are written back into events, so output order matches the serial path"""
+    n_remap = sum(len(g[2]) for g in groups)
+    batch_size = max(1, n_remap // (procs * 4))
+    batches = []
+    current = []
+    n = 0
+    for g in groups:
+        current.append(g)
+        n += len(g[2])
+        if n >= batch_size:
+            batches.append(current)
+            current = []
+            n = 0
+    if current:
+        batches.append(current)
+
+    jobs = []
+    for batch in batches:
+        batch_events = [events[i] for g in batch for i in g[2]]
+        jobs.append((events_to_columns(batch_events), [(g[0], g[1], g[3]) for g in batch], keep_unmapped,
+                     min_support))
+    keeps = []
+    with multiprocessing.Pool(min(procs, len(jobs))) as pool:
+        for batch, (cols, batch_keeps) in zip(batches, pool.imap(remap_batch_job, jobs)):
+            remapped = iter(events_from_columns(cols))
+            for g in batch:
+                for index in g[2]:
+                    events[index] = next(remapped)
+            keeps += batch_keeps
+    return keeps
+
+
+def drop_svs_near_reference_gaps(events, paired_end, ref_genome, drop_gaps, work_dir=None):
 
     if not drop_gaps:
         return events
-    ref_locs = []
-    for count, e in enumerate(events):
+    tested = []
+    for e in events:
 
         if e.spanning > 0 or e.site_info:  # keeper is an event from --sites
             continue
@@ -474,38 +545,15 @@ def drop_svs_near_reference_gaps(events, paired_end, ref_genome, drop_gaps):
                     continue
             elif e.svlen < 1000:
                 continue
+        tested.append(e)
 
-        ref_locs.append((e.chrA, e.posA - 250, e.posA + 250, count))
-        ref_locs.append((e.chrB, e.posB - 250, e.posB + 250, count))
-
-    if len(ref_locs) == 0:
+    if not tested:
         return events
-
-    bad_i = set([])
-    for chrom, gstart, gend, grp_idxs in merge_intervals(ref_locs, pad=0, add_indexes=True):
-
-        s_gi = set(grp_idxs)
-        s_gi -= bad_i
-        if len(s_gi) == 0:
-            continue
-
-        if gstart < 0:
-            gstart = 0
-        try:
-            ref_seq_big = ref_genome.fetch(chrom, gstart, gend).upper()
-        except (ValueError, KeyError, IndexError) as errors:
-            # Might be different reference genome version, compared to bam genome
-            logging.warning("Error fetching reference chromosome: {}".format(chrom), errors)
-            continue
-        try:
-            if ref_seq_big[0] == "N" or ref_seq_big[-1] == "N" or ref_seq_big[int(len(ref_seq_big) / 2)] == "N":
-                bad_i |= s_gi
-
-        except IndexError:
-            e = events[grp_idxs[0]]
-            logging.warning(
-                f'Index error for event region {chrom}:{gstart}-{gend}, event loci: {e.chrA} {e.posA} {e.chrB} {e.posB}')
-
-    new_events = [events[i] for i in range(len(events)) if i not in bad_i]
-
-    return new_events
+    # only chromosomes with events to test are indexed
+    gaps = load_gap_index(ref_genome, work_dir)
+    gaps.ensure([c for e in tested for c in (e.chrA, e.chrB)])
+    drop = set()
+    for e in tested:
+        if gaps.overlaps(e.chrA, e.posA - 250, e.posA + 250) or gaps.overlaps(e.chrB, e.posB - 250, e.posB + 250):
+            drop.add(id(e))
+    return [e for e in events if id(e) not in drop]
@@ -31,9 +31,9 @@ cdef extern from "ssw.h":
                              const cnp.int32_t readLen,
                              const cnp.int8_t* mat,
                              const cnp.int32_t n,
-                             const cnp.int8_t score_size)
+                             const cnp.int8_t score_size) nogil
 
-    cdef void init_destroy(s_profile* p)
+    cdef void init_destroy(s_profile* p) nogil
 
     cdef s_align* ssw_align(const s_profile* prof,
                             const cnp.int8_t* ref,
@@ -43,9 +43,9 @@ cdef extern from "ssw.h":
                             const cnp.uint8_t flag,
                             const cnp.uint16_t filters,
                             const cnp.int32_t filterd,
-                            const cnp.int32_t maskLen)
+                            const cnp.int32_t maskLen) nogil
 
-    cdef void align_destroy(s_align* a)
+    cdef void align_destroy(s_align* a) nogil
 
 np_aa_table = np.array([
     23, 23, 23, 23, 23, 23, 23, 23, 23, 23, 23, 23, 23, 23, 23, 23,
@@ -707,3 +707,130 @@ cdef class StripedSmithWaterman:
                 py_list_matrix[i] = dict2d[row][column]
                 i += 1
         return py_list_matrix
+
+
+def nt_match_matrix(match_score, mismatch_score):
+    """Flattened 5x5 ACGTN scoring matrix, N scores 0 against everything"""
+    matrix = np.full((5, 5), mismatch_score, dtype=np.int8)
+    np.fill_diagonal(matrix, match_score)
+    matrix[4, :] = 0
+    matrix[:, 4] = 0
+    return matrix.ravel()
+
+
+def pack_sequences(seqs):
+    """Packs nucleotide strings into one int8 buffer of SSW base codes, with int64 offsets into the buffer"""
+    offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+    if len(seqs):
+        np.cumsum([len(i) for i in seqs], out=offsets[1:])
+    codes = np.asarray(np_nt_table, dtype=np.int8)[np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8)]
+    return np.ascontiguousarray(codes), offsets
+
+
+def align_batch(queries, targets, query_index,
+                gap_open_penalty=5,
+                gap_extend_penalty=2,
+                score_size=2,
+                mask_length=15,
+                mask_auto=True,
+                score_only=True,
+                match_score=2,
+                mismatch_score=-3,
+                zero_index=True):
+    """Align many nucleotide targets, each against the query at query_index[i], without holding the GIL.
+
+    Parameters match those of StripedSmithWaterman. Each query profile is built once and re-used for all targets
+    paired with it. With score_only=True the best alignment beginning positions and cigar are skipped, so
+    query_begin and target_begin are -1.
+
+    Parameters
+    ----------
+    queries : list of str
+    targets : list of str
+    query_index : array-like of int
+        Index into queries for each target
+
+    Returns
+    -------
+    dict of numpy.ndarray
+        Keys optimal_alignment_score, suboptimal_alignment_score, query_begin, query_end, target_begin,
+        target_end_optimal and target_end_suboptimal, one entry per target
+
+    """
+    if gap_open_penalty <= 0:
+        raise ValueError("`gap_open_penalty` must be > 0")
+    if gap_extend_penalty <= 0:
+        raise ValueError("`gap_extend_penalty` must be > 0")
+    cdef cnp.int8_t[::1] q_codes, t_codes, matrix
+    cdef cnp.int64_t[::1] q_offsets, t_offsets, order
+    q_arr, q_off = pack_sequences(queries)
+    t_arr, t_off = pack_sequences(targets)
+    q_codes = q_arr
+    t_codes = t_arr
+    q_offsets = q_off
+    t_offsets = t_off
+    matrix = nt_match_matrix(match_score, mismatch_score)
+    qidx = np.asarray(query_index, dtype=np.int64)
+    if len(qidx) != len(targets):
+        raise ValueError("query_index must have one entry per target")
+    if len(qidx) and (qidx.min() < 0 or qidx.max() >= len(queries)):
+        raise IndexError("query_index out of range")
+    order = np.argsort(qidx, kind="stable")
+    cdef cnp.int64_t[::1] q_of = qidx
+
+    cdef Py_ssize_t n = len(targets)
+    res = {name: np.full(n, -1, dtype=np.int32) for name in ("optimal_alignment_score", "suboptimal_alignment_score",
+                                                             "query_begin", "query_end", "target_begin",
+                                                             "target_end_optimal", "target_end_suboptimal")}
+    res["optimal_alignment_score"][:] = 0
+    res["suboptimal_alignment_score"][:] = 0
+    cdef cnp.int32_t[::1] score1 = res["optimal_alignment_score"]
+    cdef cnp.int32_t[::1] score2 = res["suboptimal_alignment_score"]
+    cdef cnp.int32_t[::1] q_begin = res["query_begin"]
+    cdef cnp.int32_t[::1] q_end = res["query_end"]
+    cdef cnp.int32_t[::1] t_begin = res["target_begin"]
+    cdef cnp.int32_t[::1] t_end = res["target_end_optimal"]
+    cdef cnp.int32_t[::1] t_end2 = res["target_end_suboptimal"]
+
+    cdef cnp.uint8_t gap_o = gap_open_penalty
+    cdef cnp.uint8_t gap_e = gap_extend_penalty
+    cdef cnp.uint8_t flag = 0 if score_only else 0x1
+    cdef cnp.int8_t s_size = score_size
+    cdef cnp.int32_t min_mask = mask_length
+    cdef bint auto = mask_auto
+    cdef int start_at = 0 if zero_index else 1
+    cdef cnp.int32_t mask, q_len, t_len
+    cdef Py_ssize_t k, i, current = -1
+    cdef s_profile *profile = NULL
+    cdef s_align *a
+    with nogil:
+        for k in range(n):
+            i = order[k]
+            if q_of[i] != current:
+                if profile != NULL:
+                    init_destroy(profile)
+                    profile = NULL
+                current = q_of[i]
+                q_len = <cnp.int32_t>(q_offsets[current + 1] - q_offsets[current])
+                if q_len > 0:
+                    profile = ssw_init(&q_codes[0] + q_offsets[current], q_len, &matrix[0], 5, s_size)
+                mask = <cnp.int32_t>(q_len / 2) if auto else min_mask
+                if mask < min_mask:
+                    mask = min_mask
+            t_len = <cnp.int32_t>(t_offsets[i + 1] - t_offsets[i])
+            if profile == NULL or t_len == 0:
+                continue
+            a = ssw_align(profile, &t_codes[0] + t_offsets[i], t_len, gap_o, gap_e, flag, 0, 0, mask)
+            if a == NULL:
+                continue
+            score1[i] = a.score1
+            score2[i] = a.score2
+            q_end[i] = a.read_end1 + start_at
+            t_end[i] = a.ref_end1 + start_at
+            t_end2[i] = a.ref_end2 + start_at
+            q_begin[i] = a.read_begin1 + start_at if a.read_begin1 >= 0 else -1
+            t_begin[i] = a.ref_begin1 + start_at if a.ref_begin1 >= 0 else -1
+            align_destroy(a)
+        if profile != NULL:
+            init_destroy(profile)
+    return res
@@ -0,0 +1,46 @@
+import unittest
+import numpy as np
+from scipy.cluster.hierarchy import linkage, fcluster
+from dysgu.call_component import single_linkage_clusters
+
+
+def canonical(labels):
+    # relabel clusters in order of first appearance
+    seen = {}
+    return [seen.setdefault(i, len(seen)) for i in labels]
+
+
+class TestSingleLinkage(unittest.TestCase):
+    """ single_linkage_clusters gives the same flat clusters as scipy"""
+    def check(self, coords, cut):
+        expected = fcluster(linkage(coords, "single"), cut, "distance")
+        self.assertEqual(canonical(single_linkage_clusters(coords, cut)), canonical(expected))
+
+    def test_random(self):
+        rng = np.random.default_rng(0)
+        for cut in (1, 10.5, 300):
+            for n in (2, 10, 200):
+                self.check(rng.uniform(0, cut * 20, (n, 2)), cut)
+
+    def test_grid_aligned(self):
+        rng = np.random.default_rng(1)
+        for cut in (1, 5, 300):
+            self.check(rng.integers(0, 30, (300, 2)).astype(float) * cut / 3, cut)
+
+    def test_ties(self):
+        # many pairs exactly cut apart, including along the cell diagonal
+        rng = np.random.default_rng(2)
+        for cut in (1, 5, 300):
+            for step in (cut, cut / 2, cut / np.sqrt(2)):
+                self.check(rng.integers(0, 12, (200, 2)).astype(float) * step, cut)
+
+    def test_dense_cells(self):
+        # large cell pairs are checked with a KD-tree
+        rng = np.random.default_rng(3)
+        a = rng.uniform(0, 0.5, (600, 2))
+        self.check(np.vstack([a, a + [0, 1.45]]), 1.)
+        self.check(np.vstack([a, rng.uniform(0, 0.5, (600, 2)) + [0.2, 1.2]]), 1.)
+
+
+if __name__ == "__main__":
+    unittest.main()
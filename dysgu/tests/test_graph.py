@@ -0,0 +1,73 @@
+import os
+import unittest
+from tempfile import TemporaryDirectory
+from click.testing import CliRunner
+from dysgu import graph
+from dysgu.cluster import ComponentRing
+from dysgu.main import cli
+
+
+def components_from_small_bam(tmp):
+    """proc_component results, and the NodeToName they index, from a single process run on small.bam"""
+    test = os.path.abspath(os.path.dirname(__file__))
+    found = []
+    proc_component = graph.proc_component
+
+    def capture(node_to_name, *args, **kwargs):
+        res = proc_component(node_to_name, *args, **kwargs)
+        if res:
+            found.append((res, node_to_name))
+        return res
+
+    graph.proc_component = capture
+    try:
+        result = CliRunner().invoke(cli, ["run", "-x", "--drop-gaps", "False", "--procs", "1",
+                                          "-o", os.path.join(tmp, "out.vcf"), test + "/ref.fa",
+                                          os.path.join(tmp, "wd"), test + "/small.bam"])
+    finally:
+        graph.proc_component = proc_component
+    assert result.exit_code == 0, result.output
+    return found
+
+
+class TestComponentBuffer(unittest.TestCase):
+    """ components survive encode_component and decode_component, inline and through a ComponentRing"""
+    def check(self, d, decoded):
+        self.assertEqual([sorted(map(int, p)) for p in d["parts"]],
+                         [sorted(map(int, p)) for p in decoded["parts"]])
+        self.assertEqual(set(d["s_between"]), set(decoded["s_between"]))
+        for k, (a, b) in d["s_between"].items():
+            self.assertEqual(sorted(map(int, a)), sorted(map(int, decoded["s_between"][k][0])))
+            self.assertEqual(sorted(map(int, b)), sorted(map(int, decoded["s_between"][k][1])))
+        self.assertEqual(set(d["s_within"]), set(decoded["s_within"]))
+        for k, v in d["s_within"].items():
+            self.assertEqual(sorted(map(int, v)), sorted(map(int, decoded["s_within"][k])))
+        self.assertEqual(set(d["n2n"]), set(decoded["n2n"]))
+        for k, name in d["n2n"].items():
+            self.assertEqual(name.as_tuple(), decoded["n2n"][k].as_tuple())
+
+    def test_round_trip(self):
+        with TemporaryDirectory() as tmp:
+            found = components_from_small_bam(tmp)
+            self.assertTrue(found)
+            buffers = []
+            for d, node_to_name in found:
+                # reads are looked up from the read arena by the worker, not sent in the buffer
+                d = {k: v for k, v in d.items() if k != "reads"}
+                buffers.append((d, graph.encode_component(d, node_to_name)))
+            for d, buf in buffers:
+                self.check(d, graph.decode_component(buf))
+            # a small ring, so blocks wrap around its end
+            size = 2 * max(len(buf) for _, buf in buffers) + 1024
+            ring = ComponentRing(os.path.join(tmp, "components.ring"), size)
+            worker_ring = ComponentRing(os.path.join(tmp, "components.ring"))
+            for d, buf in buffers * 5:
+                offset, length = ring.put(buf)
+                self.check(d, graph.decode_component(worker_ring.get(offset, length)))
+                worker_ring.release(offset)
+            worker_ring.close()
+            ring.close(remove=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
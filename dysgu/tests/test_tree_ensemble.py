@@ -0,0 +1,64 @@
+import os
+import unittest
+import numpy as np
+import pandas as pd
+from dysgu.post_call import load_model
+from dysgu.tree_ensemble import TreeEnsemble
+
+model_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dysgu_model.1.pkl.gz")
+
+
+def split_values(node, values):
+    # thresholds of each numerical split in a dumped tree
+    if "split_index" not in node:
+        return
+    if node["decision_type"] != "==":
+        values[node["split_feature"]].append(node["threshold"])
+    split_values(node["left_child"], values)
+    split_values(node["right_child"], values)
+
+
+def random_rows(booster, cats, n, rng):
+    """Random feature rows near the split thresholds, with NaN and zero values, and categorical values that were
+    seen in training, unseen or missing. Returns the float32 matrix and the DataFrame given to LightGBM"""
+    names = booster.feature_name()
+    values = [[] for _ in names]
+    for tree in booster.dump_model()["tree_info"]:
+        split_values(tree["tree_structure"], values)
+    categories = dict(zip([c for c in names if c in cats], booster.pandas_categorical or []))
+    X = np.empty((n, len(names)), dtype=np.float32)
+    df = {}
+    for j, name in enumerate(names):
+        if name in categories:
+            choices = list(categories[name]) + [max(categories[name]) + 5, np.nan]
+            col = rng.choice(choices, n)
+            codes = {v: k for k, v in enumerate(categories[name])}
+            X[:, j] = [codes.get(v, np.nan) for v in col]
+            df[name] = pd.Categorical(col)
+            continue
+        thresholds = np.array(values[j] or [0.])
+        col = rng.choice(thresholds, n) + rng.choice([-1., -1e-3, 0., 1e-3, 1.], n)
+        col[rng.random(n) < 0.1] = 0
+        col[rng.random(n) < 0.1] = np.nan
+        X[:, j] = col
+        df[name] = X[:, j].astype(np.float64)
+    return X, pd.DataFrame(df, columns=names)
+
+
+class TestTreeEnsemble(unittest.TestCase):
+    """ the compiled ensemble gives the same probabilities as LightGBM for every shipped classifier"""
+    def test_predict_proba(self):
+        models = load_model(model_path)
+        rng = np.random.default_rng(0)
+        for key, clf in models.items():
+            if not key.endswith(("classifier", "classifier_no_contigs", "classifier_nodip")):
+                continue
+            X, df = random_rows(clf.booster_, models["cats"], 2000, rng)
+            ensemble = TreeEnsemble.from_booster(clf.booster_)
+            expected = clf.predict_proba(df)[:, 1]
+            np.testing.assert_array_equal(ensemble.predict_proba(X), expected, err_msg=key)
+            np.testing.assert_array_equal(ensemble.predict_proba(X, threads=3), expected, err_msg=key)
+
+
+if __name__ == "__main__":
+    unittest.main()
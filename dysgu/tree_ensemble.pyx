@@ -0,0 +1,150 @@
+#cython: language_level=3, boundscheck=False, wraparound=False
+"""
+Scores rows of a float32 feature matrix with a binary LightGBM tree ensemble, without pandas or the LightGBM
+predictor. Trees are flattened from Booster.dump_model into node arrays and walked using the same decision rules
+as LightGBM, so raw scores are summed in the same order and probabilities match Booster.predict
+"""
+
+import numpy as np
+cimport numpy as np
+from dysgu.map_set_utils import run_chunked
+from libc.math cimport exp, fabs, isnan
+from libc.stdint cimport uint8_t, uint32_t, int32_t
+from libcpp.vector cimport vector
+
+
+cdef double K_ZERO_THRESHOLD = <float>1e-35  # LightGBM kZeroThreshold, a float constant
+cdef uint8_t MISSING_NONE = 0
+cdef uint8_t MISSING_ZERO = 1
+cdef uint8_t MISSING_NAN = 2
+cdef uint8_t FLAG_CATEGORICAL = 1
+cdef uint8_t FLAG_DEFAULT_LEFT = 2
+DEF ROW_BLOCK = 64
+
+MISSING_TYPES = {"None": MISSING_NONE, "Zero": MISSING_ZERO, "NaN": MISSING_NAN}
+
+
+cdef struct Node:
+    double threshold
+    int32_t feature, left, right  # children >= 0 are node indexes, negative values are ~leaf indexes
+    int32_t cat_start, cat_end  # categorical splits: range of the category bitset in cat_bits
+    uint8_t flags, missing
+
+
+cdef class TreeEnsemble:
+    """Binary tree ensemble flattened into a node array, a leaf value array and the root node of each tree"""
+    cdef public int n_features, n_trees
+    cdef public double sigmoid
+    cdef public object feature_names
+    cdef vector[Node] nodes
+    cdef vector[int32_t] roots
+    cdef vector[double] leaf_value
+    cdef vector[uint32_t] cat_bits
+
+    def __init__(self, model):
+        if model["objective"].split(" ")[0] != "binary" or model["num_tree_per_iteration"] != 1:
+            raise ValueError("Only binary tree ensembles are supported")
+        self.sigmoid = 1
+        for item in model["objective"].split(" ")[1:]:
+            if item.startswith("sigmoid:"):
+                self.sigmoid = float(item.split(":")[1])
+        self.feature_names = model["feature_names"]
+        self.n_features = len(self.feature_names)
+        self.n_trees = len(model["tree_info"])
+        for tree in model["tree_info"]:
+            self.roots.push_back(self._add(tree["tree_structure"]))
+        self.cat_bits.push_back(0)
+
+    cdef int32_t _add(self, dict node):
+        cdef Node n
+        cdef int32_t idx
+        if "split_index" not in node:
+            self.leaf_value.push_back(node["leaf_value"])
+            return ~(<int32_t>self.leaf_value.size() - 1)
+        n.feature = node["split_feature"]
+        n.missing = MISSING_TYPES[node["missing_type"]]
+        n.flags = FLAG_DEFAULT_LEFT if node["default_left"] else 0
+        n.threshold = 0
+        n.cat_start = 0
+        n.cat_end = 0
+        if node["decision_type"] == "==":
+            n.flags |= FLAG_CATEGORICAL
+            cats = [int(v) for v in str(node["threshold"]).split("||")]
+            words = [0] * (max(cats) // 32 + 1)
+            for v in cats:
+                words[v // 32] |= 1 << (v % 32)
+            n.cat_start = self.cat_bits.size()
+            for w in words:
+                self.cat_bits.push_back(w)
+            n.cat_end = self.cat_bits.size()
+        else:
+            n.threshold = node["threshold"]
+        idx = self.nodes.size()
+        self.nodes.push_back(n)
+        self.nodes[idx].left = self._add(node["left_child"])
+        self.nodes[idx].right = self._add(node["right_child"])
+        return idx
+
+    @classmethod
+    def from_booster(cls, booster):
+        return cls(booster.dump_model())
+
+    cdef inline int32_t _leaf(self, const float *row, int32_t node) nogil:
+        cdef const Node *n
+        cdef double fval
+        cdef int iv, word
+        while node >= 0:
+            n = &self.nodes[node]
+            fval = row[n.feature]
+            if n.flags & FLAG_CATEGORICAL:
+                # NaN and negative categories go right, as in LightGBM
+                if isnan(fval):
+                    node = n.right
+                    continue
+                iv = <int>fval
+                word = iv >> 5
+                if iv >= 0 and word < n.cat_end - n.cat_start and (self.cat_bits[n.cat_start + word] >> (iv & 31)) & 1:
+                    node = n.left
+                else:
+                    node = n.right
+                continue
+            # the LightGBM predictor drops features within K_ZERO_THRESHOLD of zero, so they are read as zero
+            if (isnan(fval) and n.missing != MISSING_NAN) or fabs(fval) <= K_ZERO_THRESHOLD:
+                fval = 0
+            if (n.missing == MISSING_ZERO and fabs(fval) <= K_ZERO_THRESHOLD) or (n.missing == MISSING_NAN and isnan(fval)):
+                node = n.left if n.flags & FLAG_DEFAULT_LEFT else n.right
+            elif fval <= n.threshold:
+                node = n.left
+            else:
+                node = n.right
+        return ~node
+
+    cdef void _score(self, const float[:, ::1] X, double[::1] out, Py_ssize_t start, Py_ssize_t end) nogil:
+        # Rows are scored in blocks, tree by tree, so each tree stays in cache. Leaf values are still added to the
+        # raw score of each row in tree order
+        cdef Py_ssize_t i, block, block_end
+        cdef int t
+        cdef double raw[ROW_BLOCK]
+        for block in range(start, end, ROW_BLOCK):
+            block_end = min(block + ROW_BLOCK, end)
+            for i in range(block, block_end):
+                raw[i - block] = 0
+            for t in range(self.n_trees):
+                for i in range(block, block_end):
+                    raw[i - block] += self.leaf_value[self._leaf(&X[i, 0], self.roots[t])]
+            for i in range(block, block_end):
+                out[i] = 1.0 / (1.0 + exp(-self.sigmoid * raw[i - block]))
+
+    def _score_chunk(self, const float[:, ::1] X, double[::1] out, Py_ssize_t start, Py_ssize_t end):
+        with nogil:
+            self._score(X, out, start, end)
+
+    def predict_proba(self, X, int threads=1):
+        """Probability of the positive class for each row of X, a C-contiguous float32 matrix with columns in
+        feature_names order. Rows are split between threads when threads > 1"""
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f"Expected a matrix with {self.n_features} columns")
+        out = np.empty(X.shape[0], dtype=np.float64)
+        run_chunked(self._score_chunk, (X, out), X.shape[0], threads)
+        return out
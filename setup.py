@@ -86,7 +86,7 @@ if "--conda-prefix" in argv or os.getenv('PREFIX'):
     else:
         raise ValueError("prefix path does not exists")
 
-    libraries = ["hts"]
+    libraries = ["hts", "z"]  # zlib is also used directly by assembler
     library_dirs = [f"{prefix}/lib", numpy.get_include()] + pysam.get_include()
     include_dirs = [numpy.get_include(), root,
                     f"{prefix}/include/htslib", f"{prefix}/include"] + pysam.get_include()
@@ -113,7 +113,7 @@ else:
         print("Using packaged htslib")
         htslib = os.path.join(root, "dysgu/htslib")
 
-    libraries = [f"{htslib}/hts"]
+    libraries = [f"{htslib}/hts", "z"]
     library_dirs = [htslib, numpy.get_include(), f"{htslib}/htslib"] + pysam.get_include()
     include_dirs = [numpy.get_include(), root,
                     f"{htslib}/htslib", f"{htslib}/cram"] + pysam.get_include()
@@ -143,7 +143,7 @@ ext_modules.append(Extension(f"dysgu.scikitbio._ssw_wrapper",
 
 # Dysgu modules
 for item in ["sv2bam", "io_funcs", "graph", "coverage", "assembler", "call_component",
-             "map_set_utils", "cluster", "sv_category", "extra_metrics"]:  # "post_call_metrics",
+             "map_set_utils", "cluster", "sv_category", "extra_metrics", "tree_ensemble"]:  # "post_call_metrics",
 
     ext_modules.append(Extension(f"dysgu.{item}",
                                  [f"dysgu/{item}.pyx"],